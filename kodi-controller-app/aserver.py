@@ -0,0 +1,398 @@
+#!/usr/bin/python
+# coding: utf-8
+# Asynchronous server: the same /{SECRET}/... routes as run.py on aiohttp with non-blocking Kodi client,
+# so slow Kodi holds no worker threads. Start instead of run.py:
+#   python aserver.py
+import asyncio
+import functools
+import json
+import logging
+import time
+from datetime import datetime
+
+from aiohttp import web
+
+import config as cfg
+import channels
+import logs
+import metrics
+import run
+from kodi import AsyncKodiClient, KodiError
+
+# Non-blocking Kodi clients by room, state mirrors and TV sources are shared with run.py
+clients = {room.name: AsyncKodiClient(room.url, timeout=getattr(cfg, 'KODITIMEOUT', 5),
+                                      limit=getattr(cfg, 'KODICONNECTIONS', 32))
+           for room in run.rooms}
+routes = web.RouteTableDef()
+log = logging.getLogger('aserver')
+
+
+def reply(text, status=200):
+    # Same content type as Flask gives to string responses
+    return web.Response(text=text, status=status, content_type='text/html')
+
+
+def not_found():
+    return reply("Record not found", 400)
+
+
+def argument(request, name="request"):
+    """
+    :return:
+    query argument or None if it is missing, empty or a "{value}" placeholder
+    """
+    value = request.query.get(name)
+    return None if value in [None, "", "{value}"] else value
+
+
+def room_route(rule):
+    """
+    Register handler of {cfg.SECRET}/{rule} for the default room and of {cfg.SECRET}/{room}/{rule}
+    for the named one, the handler gets request and Room.
+    """
+    def register(handler):
+        @functools.wraps(handler)
+        async def view(request):
+            room = run.rooms.get(request.match_info.get('room'))
+            if room is None:
+                return not_found()
+            return await handler(request, room)
+        routes.get('/{}/{}'.format(cfg.SECRET, rule))(view)
+        routes.get('/{}/{{room}}/{}'.format(cfg.SECRET, rule))(view)
+        return handler
+    return register
+
+
+@web.middleware
+async def instrument(request, handler):
+    started = time.time()
+    try:
+        return await handler(request)
+    finally:
+        route = 'unknown' if request.match_info.http_exception is not None else handler.__name__
+        metrics.request_seconds.observe(time.time() - started, route)
+
+
+@routes.get('/')
+async def entry_point(request):
+    return reply('Hello World!')
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/channel?request={value} -> Virtual device / TV / Control canals
+@room_route('channel')
+async def chan_point(request, room):
+    chan = argument(request)
+    if chan is None:
+        chan = await get_chan(room)
+        log.debug("get channel: %s", chan)
+        return reply('{{"value": {}}}'.format(chan))
+
+    log.info(u'command> channel %s', chan)
+    try:
+        if room.commands is not None:
+            # Answered at once, a zap still waiting is dropped
+            room.commands.submit('channel', room.kodi.player_open, int(chan))
+        else:
+            await clients[room.name].player_open(chan)
+    except (KodiError, ValueError):
+        return not_found()
+    log.info("set channel %s", chan)
+    return reply('{{"value": {}}}'.format(chan))
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/label?request={in}
+# NB: This rule NOT for use via virtual device
+@room_route('label')
+async def label_point(request, room):
+    label = argument(request)
+    if label is None:
+        label = await get_label(room)
+        log.debug(u'get label: "%s"', label)
+        return reply(u'{{"value": "{}"}}'.format(label))
+
+    label = label.upper().replace(u'ПОСТАВЬ КАНАЛ', '').lstrip()
+    log.info(u'command> label %s', label)
+    if label != "":
+        found = channels.get_index().resolve(label)
+        if found is not None:
+            channel_id, channel_label = found
+            log.info(u'\t%s', channel_label)
+            try:
+                if room.commands is not None:
+                    room.commands.submit('channel', room.kodi.player_open, channel_id)
+                else:
+                    await clients[room.name].player_open(channel_id)
+            except KodiError:
+                return not_found()
+            log.info("set channel %s", channel_id)
+            return reply('{{"value": {}}}'.format(channel_id))
+
+        log.warning(u'NB: Consider register alias for "%s"', label)
+    return not_found()
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/volume?request={value} -> Virtual device / TV / Volume
+@room_route('volume')
+async def volume_point(request, room):
+    volume = argument(request)
+    if volume is None:
+        volume = await get_volume(room)
+        log.debug(u'get volume: %s', volume)
+        return reply(u'{{"value": {}}}'.format(volume))
+
+    log.info(u'command> volume %s', volume)
+    try:
+        if room.commands is not None:
+            # Answered at once, the latest volume of a burst wins
+            room.commands.submit('volume', room.set_volume, int(volume))
+        else:
+            room.state.update(volume=await clients[room.name].set_volume(volume))
+    except (KodiError, ValueError):
+        return not_found()
+    log.info("set volume %s", volume)
+    return reply('{{"value": {}}}'.format(volume))
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/power?request={value} -> Virtual device / TV / Power
+@room_route('power')
+async def power_point(request, room):
+    power = argument(request)
+    if power is None:
+        log.debug(u'get power: true')
+        return reply(json.dumps({'value': True}))
+
+    log.info(u'command> power %s', power)
+    if power == "0":
+        try:
+            await clients[room.name].shutdown()
+        except KodiError:
+            return not_found()
+        log.info("set power %s", power)
+        return reply(json.dumps({'value': False}))
+    if power == "1":
+        log.info("set power %s", power)
+        return reply(json.dumps({'value': True}))
+    return not_found()
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/mute?request={value} -> Virtual device / TV / Mute
+@room_route('mute')
+async def mute_point(request, room):
+    mute = argument(request)
+    muted = await get_mute(room)
+    if mute is None:
+        log.debug(u'get mute: %s', "1" if muted else "0")
+        return reply(u'{{"value": {}}}'.format("1" if muted else "0"))
+
+    log.info(u'command> mute %s', mute)
+    # Issue mute only if need it
+    if mute != ("1" if muted else "0"):
+        try:
+            muted = await clients[room.name].set_mute(mute == "1")
+        except KodiError:
+            return not_found()
+        room.state.update(muted=muted)
+        log.info("set mute %s", "1" if muted else "0")
+    else:
+        log.info("leave mute %s", "1" if muted else "0")
+    return reply('{{"value": {}}}'.format("1" if muted else "0"))
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/source?request={value} -> Virtual device / TV / Source
+@room_route('source')
+async def source_point(request, room):
+    source = argument(request)
+    if source is None:
+        log.debug(u'get source: %s', room.tv['source'])
+        return reply(u'{{"value": "{}"}}'.format(room.tv['source']))
+
+    log.info(u'command> source %s', source)
+    # Issue source only if it's a valid source (1..10)
+    if source in ['one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'ten']:
+        room.tv['source'] = source
+        return reply(u'{{"value": "{}"}}'.format(room.tv['source']))
+    return not_found()
+
+
+def programs(category=None, filter_program=None, now=False, limit=None, cursor=None):
+    # Blocking database query, run on executor threads each with its own session
+    import helpers
+    metrics.db_begin()
+    with run.app.app_context():
+        try:
+            if category is None:
+                return helpers.get_programs(), helpers.programs_cache.stats()
+            return helpers.get_program_page(category, filter_program, now, limit, cursor), \
+                helpers.programs_cache.stats()
+        finally:
+            helpers.db.session.remove()
+            usage = metrics.db_end()
+            metrics.request_db_queries.observe(usage[0], 'category_point')
+            metrics.request_db_seconds.observe(usage[1], 'category_point')
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}/category?request={}&filter_program={}&now={0|1}[&limit={}&cursor={}&fields={}]
+# With limit the response has "cursor" to pass for the next page, null on the last page
+# NB: This rule NOT for use via virtual device
+@routes.get('/{}/category'.format(cfg.SECRET))
+async def category_point(request):
+    import helpers
+    start_ts = datetime.now()
+    loop = asyncio.get_running_loop()
+    category = argument(request)
+    if category is None:
+        categories, _ = await loop.run_in_executor(None, programs)
+        log.debug(u'get categories: "%s"', u', '.join(categories))
+        return reply(json.dumps({'value': categories}))
+    try:
+        limit, cursor, fields = helpers.page_arguments(request.query)
+    except ValueError:
+        return not_found()
+    (categories, next_cursor), stats = await loop.run_in_executor(
+        None, programs, category, request.query.get("filter_program"), request.query.get("now") == '1', limit, cursor)
+    log.debug(u'get programs: "%s" in %s sec., cache %s', len(categories),
+              (datetime.now() - start_ts).total_seconds(), stats)
+    extra = {} if limit is None else {'cursor': next_cursor}
+    response = web.StreamResponse(headers={'Content-Type': 'text/html; charset=utf-8'})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    for chunk in helpers.dump_programs(categories, fields, **extra):
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/status -> channel, label, volume and mute in one Kodi round-trip
+# NB: This rule NOT for use via virtual device
+@room_route('status')
+async def status_point(request, room):
+    if room.state.connected:
+        values = room.state.snapshot()
+        result = {'channel': values['channel'], 'label': values['label'],
+                  'volume': values['volume'], 'mute': "1" if values['muted'] else "0"}
+        log.debug(u'get status: %s', result)
+        return reply(json.dumps(result))
+    try:
+        kodi = clients[room.name]
+        item, props = await kodi.batch([('Player.GetItem', {'properties': [], 'playerid': 1}),
+                                        ('Application.GetProperties', {'properties': ['volume', 'muted']})])
+    except KodiError:
+        return not_found()
+    result = {'channel': -1, 'label': "", 'volume': -1, 'mute': "0"}
+    if not isinstance(item, KodiError):
+        result['channel'] = item['item'].get('id', 0)
+        result['label'] = item['item'].get('label', "")
+    if not isinstance(props, KodiError):
+        result['volume'] = props['volume']
+        result['mute'] = "1" if props['muted'] else "0"
+    log.debug(u'get status: %s', result)
+    return reply(json.dumps(result))
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}/refresh[?request={catalog|xmltv|all}] -> statistics of background catalog
+# and XMLTV refresh, after running the requested jobs at once
+# NB: This rule NOT for use via virtual device
+@routes.get('/{}/refresh'.format(cfg.SECRET))
+async def refresh_point(request):
+    worker = run.refresh_worker
+    if worker is None:
+        return not_found()
+    name = argument(request)
+    if name is not None:
+        if name != 'all' and name not in worker.stats():
+            return not_found()
+        # Jobs block, run them on an executor thread
+        if not await asyncio.get_running_loop().run_in_executor(None, worker.run_now,
+                                                               None if name == 'all' else name):
+            return reply('Refresh in progress', 503)
+    return reply(json.dumps(worker.stats()))
+
+
+def linkage():
+    import helpers
+    with run.app.app_context():
+        try:
+            return helpers.get_linkage()
+        finally:
+            helpers.db.session.remove()
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}/linkage -> matched, alias matched and unmatched Kodi and XMLTV channels
+# NB: This rule NOT for use via virtual device
+@routes.get('/{}/linkage'.format(cfg.SECRET))
+async def linkage_point(request):
+    return reply(json.dumps(await asyncio.get_running_loop().run_in_executor(None, linkage)))
+
+
+# Return current playing channel id or -1
+async def get_chan(room):
+    if room.state.connected:
+        return room.state.get('channel')
+    try:
+        item = await clients[room.name].player_get_item()
+    except KodiError:
+        return -1
+    try:
+        return item["item"]["id"]
+    except KeyError:
+        return '0'
+
+
+# Return current playing channel label or ""
+async def get_label(room):
+    if room.state.connected:
+        return room.state.get('label')
+    try:
+        return (await clients[room.name].player_get_item())["item"]["label"]
+    except (KodiError, KeyError):
+        return ""
+
+
+# Return current volume or "-1"
+async def get_volume(room):
+    if room.state.connected:
+        return room.state.get('volume')
+    try:
+        return (await clients[room.name].get_properties(["volume"]))["volume"]
+    except (KodiError, KeyError):
+        return "-1"
+
+
+# Return True if Kodi is muted
+async def get_mute(room):
+    if room.state.connected:
+        return room.state.get('muted')
+    try:
+        return (await clients[room.name].get_properties(["muted"]))["muted"]
+    except (KodiError, KeyError):
+        return False
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}/metrics -> request, Kodi, database and refresh metrics for Prometheus
+# NB: This rule NOT for use via virtual device
+@routes.get('/{}/metrics'.format(cfg.SECRET))
+async def metrics_point(request):
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def close_kodi(application):
+    for kodi in clients.values():
+        await kodi.close()
+
+
+def make_app():
+    metrics.instrument_db()
+    application = web.Application(middlewares=[instrument])
+    application.add_routes(routes)
+    application.on_cleanup.append(close_kodi)
+    return application
+
+
+if __name__ == '__main__':
+    logs.setup(cfg)
+    run.start_services()
+    try:
+        web.run_app(make_app(), host='0.0.0.0', port=cfg.PORT)
+    finally:
+        run.stop_services()
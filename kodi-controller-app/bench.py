@@ -0,0 +1,1221 @@
+#!/usr/bin/python
+# coding: utf-8
+# Benchmarks, run from kodi-controller-app directory:
+#   python bench.py xmltv --channels 300 --programs 2000
+#   python bench.py ingest --channels 100 --programs 2000
+#   python bench.py kodi --latency 0.005
+#   python bench.py monitor --latency 0.005
+#   python bench.py aliases --aliases 5000
+#   python bench.py snapshot --channels 250 --programs 2000
+#   python bench.py server --latency 0.05 --concurrency 400
+#   python bench.py rooms --rooms 8
+#   python bench.py routes --latency 0.005
+#   python bench.py refresh --channels 100 --programs 2000
+#   python bench.py feed --out xmltv.xml.gz --channels 300
+#   python bench.py --json results.json suite
+#   python bench.py compare previous.json results.json
+# Query plans of /category are checked by tests/test_plan.py
+import argparse
+import gzip
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape
+
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return usage / (1024.0 * 1024.0) if sys.platform == 'darwin' else usage / 1024.0
+
+
+def write_xmltv(path, channels, programs, categories=40):
+    """
+    Write synthetic gzip compressed XMLTV feed.
+    :param path: output file
+    :param channels: number of channels
+    :param programs: number of programs per channel
+    :param categories: number of distinct categories
+    :return:
+    uncompressed size in bytes
+    """
+    base = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=12)
+    size = 0
+    with gzip.open(path, 'wb', compresslevel=1) as out:
+        def emit(text):
+            data = text.encode('utf-8')
+            out.write(data)
+            return len(data)
+
+        size += emit(u'<?xml version="1.0" encoding="utf-8"?>\n'
+                     u'<tv generator-info-name="bench">\n')
+        for c in range(channels):
+            size += emit(u'<channel id="{0}"><display-name lang="ru">Канал {0}</display-name>'
+                         u'</channel>\n'.format(c + 1))
+        for c in range(channels):
+            ts = base
+            for p in range(programs):
+                stop = ts + timedelta(minutes=30)
+                size += emit(u'<programme start="{}" stop="{}" channel="{}">'
+                             u'<title lang="ru">{}</title><desc lang="ru">{}</desc>'
+                             u'<category lang="ru">{}</category></programme>\n'
+                             .format(ts.strftime('%Y%m%d%H%M%S +0300'), stop.strftime('%Y%m%d%H%M%S +0300'),
+                                     c + 1, escape(u'Передача {} & {}'.format(p, c)),
+                                     u'Описание передачи ' * 8, u'Категория {}'.format((c + p) % categories)))
+                ts = stop
+        size += emit(u'</tv>\n')
+    return size
+
+
+def feed_fixture(args, name, categories=40):
+    """
+    Synthetic feed of args.channels x args.programs, kept in the temp dir under a name with these sizes,
+    so runs with other sizes do not reuse it. --fixture path is used as given, --regenerate writes it anew.
+    :return:
+    path of the feed
+    """
+    path = getattr(args, 'fixture', None) or os.path.join(tempfile.gettempdir(), 'bench_{}_{}x{}x{}.xml.gz'.format(
+        name, args.channels, args.programs, categories))
+    if not os.path.isfile(path) or args.regenerate:
+        started = time.time()
+        size = write_xmltv(path, args.channels, args.programs, categories)
+        print('fixture {}: {:.1f} MB uncompressed, written in {:.1f} sec.'.format(
+            path, size / 1048576.0, time.time() - started))
+    return path
+
+
+def bench_xmltv(args):
+    import epg
+
+    path = feed_fixture(args, 'xmltv')
+
+    rss_before = peak_rss_mb()
+    started = time.time()
+    counts = {'tv': 0, 'channel': 0, 'programme': 0}
+    with gzip.open(path, 'rb') as feed:
+        for kind, _ in epg.iter_xmltv(feed):
+            counts[kind] += 1
+    elapsed = time.time() - started
+    print('parsed {} channels, {} programs in {:.2f} sec., peak RSS {:.1f} MB (before {:.1f} MB)'.format(
+        counts['channel'], counts['programme'], elapsed, peak_rss_mb(), rss_before))
+    return {'programs': counts['programme'], 'parse_sec': elapsed, 'peak_rss_mb': peak_rss_mb()}
+
+
+def bench_parse(args):
+    """
+    Programme parsing and timestamp normalization: server process vs worker processes.
+    """
+    import epg
+
+    path = feed_fixture(args, 'xmltv')
+    results = {}
+    serial = None
+    print('{:>8} {:>10} {:>12} {:>8}'.format('workers', 'sec.', 'programs/s', 'speedup'))
+    for workers in args.workers:
+        count = 0
+        started = time.time()
+        with gzip.open(path, 'rb') as feed:
+            if workers <= 1:
+                for kind, item in epg.iter_xmltv(feed):
+                    # The same conversion ProgramLoader.add does
+                    if kind == 'programme' and item['category'] is not None:
+                        (int(item['channel']), epg.parse_time(item['start']), epg.parse_time(item['stop']),
+                         item['title'], item['title'].upper(), item['desc'], item['category'])
+                        count += 1
+            else:
+                for kind, rows in epg.iter_xmltv_parallel(feed, workers, args.chunk * 1024 * 1024):
+                    if kind == 'programmes':
+                        count += len(rows)
+        elapsed = time.time() - started
+        if serial is None:
+            serial = elapsed
+        print('{:>8} {:>10.2f} {:>12.0f} {:>7.2f}x'.format(workers, elapsed, count / elapsed, serial / elapsed))
+        results['workers_{}_sec'.format(workers)] = elapsed
+    results['programs'] = count
+    results['cpus'] = os.cpu_count()
+    return results
+
+
+def bench_db(path):
+    """
+    Point the application at a scratch SQLite database.
+    :return:
+    application context, already pushed
+    """
+    import run
+    import helpers  # noqa: register models
+    if os.path.isfile(path):
+        os.remove(path)
+    run.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(os.path.abspath(path))
+    ctx = run.app.app_context()
+    ctx.push()
+    run.db.create_all()
+    return ctx
+
+
+def legacy_load(feed):
+    # Per-row ORM loading as it was done before ProgramLoader
+    from dateutil.parser import parse as duparse
+    import epg
+    from helpers import db, Category, Program
+    index = 0
+    for kind, pr in epg.iter_xmltv(feed):
+        if kind != 'programme':
+            continue
+        a_category = Category.query.filter(Category.name == pr['category']).first()
+        if a_category is None:
+            a_category = Category(name=pr['category'])
+            db.session.add(a_category)
+        db.session.add(Program(channel=int(pr['channel']), title=pr['title'],
+                               start=duparse(pr['start']), stop=duparse(pr['stop']),
+                               desc=pr['desc'], category=a_category))
+        index += 1
+        if index % 1024 == 0:
+            db.session.commit()
+    db.session.commit()
+    return index
+
+
+def bulk_load(feed):
+    import epg
+    from helpers import db, ProgramLoader
+    loader = ProgramLoader(db.session)
+    for kind, pr in epg.iter_xmltv(feed):
+        if kind == 'programme':
+            loader.add(pr)
+    loader.flush()
+    db.session.commit()
+    return loader.count
+
+
+def bench_ingest(args):
+    path = feed_fixture(args, 'ingest')
+
+    results = {}
+    for name, load in (('bulk', bulk_load), ('legacy', legacy_load)):
+        if name == 'legacy' and args.skip_legacy:
+            continue
+        ctx = bench_db(os.path.join(tempfile.gettempdir(), 'bench_ingest_{}.db'.format(name)))
+        started = time.time()
+        with gzip.open(path, 'rb') as feed:
+            count = load(feed)
+        results[name] = time.time() - started
+        ctx.pop()
+        print('{}: {} programs in {:.2f} sec., {:.0f} programs/sec.'.format(
+            name, count, results[name], count / results[name]))
+    if 'legacy' in results:
+        print('speedup {:.1f}x'.format(results['legacy'] / results['bulk']))
+    return {'{}_sec'.format(name): elapsed for name, elapsed in results.items()}
+
+
+# Command name, JSON-RPC method and params, as sent by run.py handlers
+KODI_COMMANDS = [('channel', 'Player.Open', {'item': {'channelid': 2}}),
+                 ('volume', 'Application.SetVolume', {'volume': 40}),
+                 ('mute', 'Application.SetMute', {'mute': 'toggle'}),
+                 ('get item', 'Player.GetItem', {'properties': [], 'playerid': 1}),
+                 ('get volume', 'Application.GetProperties', {'properties': ['volume']})]
+
+
+def bench_kodi(args):
+    import asyncio
+    import json
+    import requests
+    import fakekodi
+    from kodi import KodiClient, AsyncKodiClient
+
+    server, url = fakekodi.start(groups=args.groups, channels=args.groups * 10, latency=args.latency,
+                                 group_latency=args.group_latency)
+
+    def legacy(method, params):
+        # Former run.py style: new connection per request
+        requests.post('{}/jsonrpc'.format(url),
+                      data=json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': method, 'params': params}))
+
+    client = KodiClient(url, pool_size=max(4, args.workers))
+    results = {}
+    print('{:<12} {:>12} {:>12}'.format('command', 'legacy ms', 'pooled ms'))
+    for name, method, params in KODI_COMMANDS:
+        timings = []
+        for call in (legacy, lambda m, p: client.call(m, p)):
+            call(method, params)
+            started = time.time()
+            for _ in range(args.requests):
+                call(method, params)
+            timings.append((time.time() - started) * 1000.0 / args.requests)
+        print('{:<12} {:>12.3f} {:>12.3f}'.format(name, timings[0], timings[1]))
+        results['{}_legacy_ms'.format(name.replace(' ', '_'))] = timings[0]
+        results['{}_pooled_ms'.format(name.replace(' ', '_'))] = timings[1]
+
+    # Catalog refresh: one PVR.GetChannels per group vs single batch vs parallel calls
+    groups = client.get_channel_groups('tv')['channelgroups']
+    calls = [('PVR.GetChannels', {'channelgroupid': x['channelgroupid']}) for x in groups]
+    started = time.time()
+    for method, params in calls:
+        client.call(method, params)
+    sequential = time.time() - started
+    started = time.time()
+    client.batch(calls)
+    batched = time.time() - started
+    started = time.time()
+    client.parallel(calls, workers=args.workers)
+    parallel = time.time() - started
+    print('catalog of {} groups: sequential {:.1f} ms, batch {:.1f} ms, {} parallel {:.1f} ms'.format(
+        len(groups), sequential * 1000.0, batched * 1000.0, args.workers, parallel * 1000.0))
+    client.close()
+
+    async def concurrent():
+        aclient = AsyncKodiClient(url, limit=args.concurrency)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def one(method, params):
+            async with semaphore:
+                await aclient.call(method, params)
+
+        started = time.time()
+        await asyncio.gather(*[one(method, params) for _ in range(args.requests)
+                               for _, method, params in KODI_COMMANDS])
+        elapsed = time.time() - started
+        await aclient.close()
+        return elapsed
+
+    total = args.requests * len(KODI_COMMANDS)
+    elapsed = asyncio.run(concurrent())
+    print('async: {} commands, concurrency {} in {:.2f} sec., {:.0f} commands/sec.'.format(
+        total, args.concurrency, elapsed, total / elapsed))
+    server.shutdown()
+    results.update(catalog_sequential_ms=sequential * 1000.0, catalog_batch_ms=batched * 1000.0,
+                   catalog_parallel_ms=parallel * 1000.0, async_commands_per_sec=total / elapsed)
+    return results
+
+
+def wait_for(condition, timeout=5.0):
+    started = time.time()
+    while not condition():
+        if time.time() - started > timeout:
+            raise RuntimeError('timed out')
+        time.sleep(0.001)
+    return time.time() - started
+
+
+def bench_monitor(args):
+    """
+    State mirror against fake Kodi: GET latency from the mirror vs polling Kodi,
+    propagation of changes made behind our back and resync after reconnect.
+    """
+    import fakekodi
+    from kodi import KodiClient
+    from monitor import KodiMonitor, KodiState
+
+    server, url = fakekodi.start(latency=args.latency)
+    listener = fakekodi.start_notifications(server.kodi)
+    client = KodiClient(url)
+    remote = KodiClient(url)
+    state = KodiState()
+    monitor = KodiMonitor(client, '127.0.0.1', listener.getsockname()[1], state, reconnect=0.1)
+    monitor.start()
+    wait_for(lambda: state.connected)
+
+    calls = [('Player.GetItem', {'properties': [], 'playerid': 1}),
+             ('Application.GetProperties', {'properties': ['volume', 'muted']})]
+    started = time.time()
+    for _ in range(args.requests):
+        client.batch(calls)
+    polled = (time.time() - started) * 1e6 / args.requests
+    started = time.time()
+    for _ in range(args.requests):
+        state.snapshot()
+    mirrored = (time.time() - started) * 1e6 / args.requests
+    print('status: polling Kodi {:.1f} us, mirror {:.2f} us'.format(polled, mirrored))
+
+    # Physical remote: changes are made by another client
+    remote.player_open(7)
+    channel_seen = wait_for(lambda: state.get('channel') == 7)
+    print('channel change seen in {:.1f} ms'.format(channel_seen * 1000.0))
+    remote.set_volume(11)
+    volume_seen = wait_for(lambda: state.get('volume') == 11)
+    print('volume change seen in {:.1f} ms'.format(volume_seen * 1000.0))
+
+    # Changes made while disconnected are picked up by resync
+    server.kodi.disconnect()
+    wait_for(lambda: not state.connected)
+    remote.set_volume(22)
+    remote.player_open(9)
+    elapsed = wait_for(lambda: state.connected and state.get('volume') == 22 and state.get('channel') == 9)
+    print('resync after reconnect in {:.1f} ms: {}'.format(elapsed * 1000.0, state.snapshot()))
+    monitor.stop()
+    server.shutdown()
+    return {'polled_us': polled, 'mirror_us': mirrored, 'channel_seen_ms': channel_seen * 1000.0,
+            'volume_seen_ms': volume_seen * 1000.0, 'resync_ms': elapsed * 1000.0}
+
+
+def bench_aliases(args):
+    """
+    Spoken label resolution: former scan of ALIASES vs ChannelIndex probe.
+    """
+    import random
+    from channels import ChannelIndex
+
+    kodi_channels = [(i + 1, u'Канал {}'.format(i + 1)) for i in range(args.channels)]
+    per_channel = max(1, args.aliases // args.channels)
+    table = {label: [u'ПСЕВДОНИМ {} {}'.format(channel_id, n) for n in range(per_channel)]
+             for channel_id, label in kodi_channels}
+    queries = [random.choice(table[random.choice(kodi_channels)[1]]) for _ in range(args.requests)]
+
+    def legacy(label):
+        # Scan as label_point did before the index, without its per-candidate DB queries
+        label_aliases = [label]
+        for alias in table:
+            if label in table[alias]:
+                label_aliases.append(alias)
+        return label_aliases
+
+    started = time.time()
+    index = ChannelIndex.build(kodi_channels, table, {})
+    build = time.time() - started
+    timings = []
+    for resolve in (legacy, index.resolve):
+        started = time.time()
+        for label in queries:
+            resolve(label)
+        timings.append((time.time() - started) * 1e6 / len(queries))
+    print('{} aliases of {} channels, index built in {:.1f} ms'.format(
+        per_channel * args.channels, args.channels, build * 1000.0))
+    print('per label: scan {:.1f} us, index {:.2f} us'.format(*timings))
+
+    # Misrecognized labels: one letter replaced, resolved by fuzzy matching
+    misheard = []
+    for label in queries:
+        position = random.randrange(len(label))
+        misheard.append(label[:position] + u'Ы' + label[position + 1:])
+    started = time.time()
+    resolved = sum(1 for label in misheard if index.resolve(label) is not None)
+    fuzzy = (time.time() - started) * 1e6 / len(misheard)
+    print('fuzzy: {:.1f} us per label, {} of {} resolved'.format(fuzzy, resolved, len(misheard)))
+    return {'build_ms': build * 1000.0, 'scan_us': timings[0], 'index_us': timings[1], 'fuzzy_us': fuzzy,
+            'fuzzy_resolved': float(resolved) / len(misheard)}
+
+
+def bench_linkage(args):
+    """
+    Kodi and XMLTV channel reconciliation: former alias scan vs channels.reconcile() with report.
+    """
+    from channels import reconcile
+
+    kodi_channels = [(i + 1, u'Канал {}'.format(i + 1)) for i in range(args.channels)]
+    # Every fifth XMLTV channel differs and is linked by alias, every tenth Kodi channel has no XMLTV one
+    xmltv_channels = [(i + 1, u'{} HD'.format(label) if i % 5 == 0 else label)
+                      for i, (_, label) in enumerate(kodi_channels) if i % 10 != 9]
+    aliases_xmltv = {u'{} HD'.format(label).upper(): label for i, (_, label) in enumerate(kodi_channels) if i % 5 == 0}
+    # Aliases of existing and of missing channels
+    table = {u'Канал {}'.format(i * 2 + 1): [u'ПСЕВДОНИМ {}'.format(i)] for i in range(args.channels)}
+
+    started = time.time()
+    # Alias check as cat_chans did before
+    invalid = []
+    for alias in list(table)[:args.legacy]:
+        if len([x for x in kodi_channels if x[1].upper() == alias.upper()]) == 0:
+            invalid.append(alias)
+    legacy = (time.time() - started) * len(table) / min(len(table), args.legacy)
+    started = time.time()
+    links, report = reconcile(kodi_channels, xmltv_channels, table, aliases_xmltv)
+    elapsed = time.time() - started
+    print('{} Kodi and {} XMLTV channels, {} aliases'.format(len(kodi_channels), len(xmltv_channels), len(table)))
+    print('alias scan {:.1f} ms (estimated from {}), reconcile {:.1f} ms: {} links, {} alias matched, '
+          '{} Kodi unmatched, {} aliases unmatched'.format(
+              legacy * 1000.0, min(len(table), args.legacy), elapsed * 1000.0, len(links),
+              len(report['xmltv']['alias_matched']), len(report['kodi']['unmatched']),
+              len(report['aliases_unmatched'])))
+    return {'scan_ms': legacy * 1000.0, 'reconcile_ms': elapsed * 1000.0}
+
+
+def load_linked(args, name, categories=40):
+    """
+    Scratch database loaded from synthetic feed, every XMLTV channel linked to a Kodi channel.
+    :return:
+    application context
+    """
+    import helpers
+    from helpers import db, ChannelLink
+
+    path = feed_fixture(args, name, categories)
+    ctx = bench_db(os.path.join(tempfile.gettempdir(), 'bench_{}.db'.format(name)))
+    helpers.migrate_db()
+    started = time.time()
+    with gzip.open(path, 'rb') as feed:
+        count = bulk_load(feed)
+    db.session.execute(ChannelLink.__table__.insert(),
+                       [{'xmltv_id': c + 1, 'channel_id': c + 1, 'label': u'Канал {}'.format(c + 1)}
+                        for c in range(args.channels)])
+    db.session.commit()
+    print('{} programs loaded in {:.1f} sec.'.format(count, time.time() - started))
+    return ctx
+
+
+def bench_snapshot(args):
+    """
+    On air and next programs: SQLite queries vs in-memory snapshot, snapshot build time and memory.
+    """
+    import contextlib
+    import io
+    import tracemalloc
+    import helpers
+
+    ctx = load_linked(args, 'snapshot')
+    helpers.cfg.EPG_SNAPSHOT = True
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.time()
+    helpers.load_snapshot()
+    build = time.time() - started
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    snapshot = helpers.epg_snapshot
+    print('snapshot of {} programs, {} titles built in {:.2f} sec. (traced), {:.1f} MB, {:.0f} bytes per program'.format(
+        snapshot.count, len(snapshot.titles), build, size / 1048576.0, float(size) / max(snapshot.count, 1)))
+
+    categories = [u'Категория {}'.format(x) for x in range(40)]
+    now = datetime.now()
+    results = {'build_sec': build, 'bytes_per_program': float(size) / max(snapshot.count, 1)}
+    lookups = [('on_air', lambda category: snapshot.on_air(category, u'', now)),
+               ('next', lambda category: snapshot.upcoming(category, u'', now, 1))]
+    for name, lookup in lookups:
+        started = time.time()
+        for _ in range(args.requests):
+            for category in categories:
+                lookup(category)
+        results['{}_ms'.format(name)] = (time.time() - started) * 1000.0 / (args.requests * len(categories))
+        print('snapshot {}: {:.3f} ms per category'.format(name, results['{}_ms'.format(name)]))
+
+    # Whole get_programs call without cache: SQLite vs snapshot
+    for name, current in (('sqlite', None), ('snapshot', snapshot)):
+        helpers.epg_snapshot = current
+        started = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for category in categories:
+                helpers.query_programs(category, None, True)
+        results['query_{}_ms'.format(name)] = (time.time() - started) * 1000.0 / len(categories)
+        print('query_programs now, {}: {:.2f} ms per category'.format(name, results['query_{}_ms'.format(name)]))
+    ctx.pop()
+    return results
+
+
+def bench_category(args):
+    """
+    Broad /category request: whole result encoded at once as before vs streamed vs first page,
+    time and peak traced memory, from SQLite and from snapshot. Pages walked to the end must give the whole result.
+    """
+    import collections
+    import json
+    import tracemalloc
+    import helpers
+
+    ctx = load_linked(args, 'category', args.categories)
+    category = u'Категория 1'
+
+    def whole():
+        return len(json.dumps({'value': helpers.query_programs(category, None, args.now)}))
+
+    def streamed():
+        return sum(len(x) for x in helpers.dump_programs(helpers.query_programs(category, None, args.now)))
+
+    def page():
+        programs, cursor = helpers.get_program_page(category, None, args.now, args.limit)
+        return sum(len(x) for x in helpers.dump_programs(programs, ('channel', 'title'), cursor=cursor))
+
+    results = {}
+    for mode in ('sqlite', 'snapshot'):
+        helpers.epg_snapshot = None
+        if mode == 'snapshot':
+            helpers.cfg.EPG_SNAPSHOT = True
+            helpers.load_snapshot()
+        for name, request in (('whole', whole), ('streamed', streamed), ('page', page)):
+            helpers.programs_cache.clear()
+            tracemalloc.start()
+            started = time.time()
+            size = request()
+            elapsed = time.time() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results['{}_{}_ms'.format(mode, name)] = elapsed * 1000.0
+            results['{}_{}_peak_mb'.format(mode, name)] = peak / 1048576.0
+            print('{:<8} {:<8} {:>9.1f} ms {:>8.1f} MB peak {:>10} bytes'.format(
+                mode, name, elapsed * 1000.0, peak / 1048576.0, size))
+
+        # Pages in order must be the whole result, ties of the whole result are in no particular order
+        helpers.programs_cache.clear()
+        programs = helpers.query_programs(category, None, args.now)
+        walked, cursor, pages = [], None, 0
+        while True:
+            chunk, cursor = helpers.get_program_page(category, None, args.now, args.walk, helpers.decode_cursor(
+                cursor, args.now) if cursor else None)
+            walked.extend(chunk)
+            pages += 1
+            if cursor is None:
+                break
+        # Time before start or stop depends on the time of the call
+        field = 'stop' if args.now else 'start'
+        same = collections.Counter((x['channel'], x['title'], x['start']) for x in walked) == \
+            collections.Counter((x['channel'], x['title'], x['start']) for x in programs)
+        ordered = [x[field] for x in walked] == [x[field] for x in programs]
+        if not same or not ordered:
+            raise RuntimeError('{}: {} pages differ from the whole result'.format(mode, pages))
+        print('{:<8} {} programs in {} pages of {}, same as whole result'.format(mode, len(walked), pages, args.walk))
+    results['programs'] = len(walked)
+    ctx.pop()
+    return results
+
+
+def startup_child(args):
+    # One server start in a fresh process: EPG from SQLite, from snapshot built in memory or from snapshot file
+    started = time.time()
+    import config as cfg
+    import run
+    import helpers
+    run.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(args.db)
+    cfg.EPG_SNAPSHOT = args.child == 'memory'
+    cfg.EPG_SNAPSHOT_FILE = args.file if args.child == 'mmap' else None
+    with run.app.app_context():
+        if args.child == 'mmap':
+            helpers.open_snapshot()
+        else:
+            helpers.load_snapshot()
+        ready = time.time() - started
+        helpers.query_programs(u'Категория 1', None, True)
+        first = time.time() - started
+        queries = time.time()
+        for category in range(40):
+            helpers.query_programs(u'Категория {}'.format(category), None, False)
+        queries = (time.time() - queries) * 1000.0 / 40
+    with open('/proc/self/statm') as f:
+        rss = int(f.read().split()[1]) * resource.getpagesize() / 1048576.0
+    return {'ready_sec': ready, 'first_query_sec': first, 'query_next_ms': queries, 'rss_mb': rss}
+
+
+def bench_startup(args):
+    """
+    Server start until the first /category answer and memory after 40 queries:
+    SQLite vs snapshot built from SQLite vs snapshot file mapped to memory.
+    """
+    import json
+    import subprocess
+
+    if args.child:
+        print(json.dumps(startup_child(args)))
+        return None
+    import helpers
+    from helpers import db, ChannelLink
+    path = feed_fixture(args, 'startup')
+    args.db = os.path.join(tempfile.gettempdir(), 'bench_startup.db')
+    args.file = os.path.join(tempfile.gettempdir(), 'bench_startup.snapshot')
+    ctx = bench_db(args.db)
+    helpers.migrate_db()
+    with gzip.open(path, 'rb') as feed:
+        count = bulk_load(feed)
+    db.session.execute(ChannelLink.__table__.insert(),
+                       [{'xmltv_id': c + 1, 'channel_id': c + 1, 'label': u'Канал {}'.format(c + 1)}
+                        for c in range(args.channels)])
+    db.session.commit()
+    helpers.cfg.EPG_SNAPSHOT_FILE = args.file
+    helpers.load_snapshot()
+    ctx.pop()
+    print('{} programs, snapshot file {:.1f} MB'.format(count, os.path.getsize(args.file) / 1048576.0))
+    results = {}
+    print('{:<8} {:>10} {:>16} {:>14} {:>8}'.format('mode', 'ready s', 'first answer s', 'next ms', 'RSS MB'))
+    for mode in ('sqlite', 'memory', 'mmap'):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), 'startup', '--child', mode,
+                                       '--db', args.db, '--file', args.file])
+        child = json.loads(out.decode().strip().splitlines()[-1])
+        print('{:<8} {:>10.3f} {:>16.3f} {:>14.2f} {:>8.1f}'.format(
+            mode, child['ready_sec'], child['first_query_sec'], child['query_next_ms'], child['rss_mb']))
+        results.update(('{}_{}'.format(mode, k), v) for k, v in child.items())
+    return results
+
+
+def bench_server(args):
+    """
+    Routes under load with slow Kodi: waitress threads (run.py) vs aiohttp (aserver.py).
+    """
+    import asyncio
+    import threading
+    import aiohttp
+    import fakekodi
+    import config as cfg
+
+    kodi_server, url = fakekodi.start(latency=args.latency)
+    # Before run and aserver create their Kodi clients
+    cfg.KODIURL = url
+    cfg.KODITCPPORT = None
+    import run
+    import aserver
+    from aiohttp import web
+    from waitress import create_server
+
+    import logging
+    # Queue depth warnings on every request under overload
+    logging.getLogger('waitress').setLevel(logging.ERROR)
+    sync_server = create_server(run.app, host='127.0.0.1', port=0, threads=args.threads)
+    threading.Thread(target=sync_server.run, name='waitress', daemon=True).start()
+
+    async_loop = asyncio.new_event_loop()
+    runner = web.AppRunner(aserver.make_app(), access_log=None)
+    async_loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    async_loop.run_until_complete(site.start())
+    async_port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=async_loop.run_forever, name='aserver', daemon=True).start()
+
+    paths = ['/{}/channel'.format(cfg.SECRET), '/{}/volume'.format(cfg.SECRET),
+             '/{}/channel?request=2'.format(cfg.SECRET), '/{}/volume?request=30'.format(cfg.SECRET)]
+
+    async def load(port):
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        timeout = aiohttp.ClientTimeout(total=120)
+        latencies = []
+        errors = [0]
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def one(path):
+                async with semaphore:
+                    started = time.time()
+                    try:
+                        async with session.get('http://127.0.0.1:{}{}'.format(port, path)) as r:
+                            await r.read()
+                            if r.status != 200:
+                                errors[0] += 1
+                    except aiohttp.ClientError:
+                        errors[0] += 1
+                    latencies.append(time.time() - started)
+
+            started = time.time()
+            await asyncio.gather(*[one(paths[i % len(paths)]) for i in range(args.requests)])
+            elapsed = time.time() - started
+        latencies.sort()
+        return elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], errors[0]
+
+    import contextlib
+    import io
+    print('{} requests, concurrency {}, Kodi latency {:.0f} ms'.format(
+        args.requests, args.concurrency, args.latency * 1000.0))
+    results = {}
+    for name, port in (('waitress', sync_server.effective_port), ('aiohttp', async_port)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed, p50, p99, errors = asyncio.run(load(port))
+        print('{:<12} {:>8.0f} req/sec., p50 {:>7.1f} ms, p99 {:>7.1f} ms, {} errors'.format(
+            name, args.requests / elapsed, p50 * 1000.0, p99 * 1000.0, errors))
+        results.update({'{}_req_per_sec'.format(name): args.requests / elapsed, '{}_p50_ms'.format(name): p50 * 1000.0,
+                        '{}_p99_ms'.format(name): p99 * 1000.0, '{}_errors'.format(name): errors})
+    sync_server.close()
+    async_loop.call_soon_threadsafe(async_loop.stop)
+    kodi_server.shutdown()
+    return results
+
+
+def bench_rooms(args):
+    """
+    Several Kodi instances in one process: memory per room and routes addressed per room.
+    """
+    import contextlib
+    import io
+    import tracemalloc
+    import fakekodi
+    import config as cfg
+
+    servers = [fakekodi.start(latency=args.latency) for _ in range(args.rooms)]
+    cfg.KODIS = {'room{}'.format(i): url for i, (_, url) in enumerate(servers)}
+    cfg.KODITCPPORT = None
+    tracemalloc.start()
+    import run
+    import rooms
+    loaded = tracemalloc.get_traced_memory()[0]
+    # One more set of rooms: Kodi client, state mirror and TV source each
+    extra = rooms.from_config(cfg)
+    per_room = float(tracemalloc.get_traced_memory()[0] - loaded) / len(extra)
+    tracemalloc.stop()
+    print('{} rooms: application {:.1f} MB, {:.1f} KB per room, EPG and aliases are shared'.format(
+        args.rooms, loaded / 1048576.0, per_room / 1024.0))
+
+    client = run.app.test_client()
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.time()
+        for i in range(args.requests):
+            name = 'room{}'.format(i % args.rooms)
+            client.get('/{}/{}/channel?request={}'.format(cfg.SECRET, name, i % 50 + 1))
+        elapsed = time.time() - started
+    print('{} channel commands over {} rooms: {:.2f} ms per command, calls per Kodi {}'.format(
+        args.requests, args.rooms, elapsed * 1000.0 / args.requests,
+        [server.kodi.calls for server, _ in servers]))
+    for server, _ in servers:
+        server.shutdown()
+    return {'kb_per_room': per_room / 1024.0, 'command_ms': elapsed * 1000.0 / args.requests}
+
+
+def bench_commands(args):
+    """
+    Bursts of /volume and /channel requests against slow Kodi: answered after the Kodi call vs command queue.
+    """
+    import contextlib
+    import io
+    import fakekodi
+    import config as cfg
+
+    server, url = fakekodi.start(latency=args.latency)
+    # Before run creates its Kodi clients
+    cfg.KODIURL = url
+    cfg.KODIS = None
+    cfg.KODITCPPORT = None
+    import run
+    room = run.rooms.default
+    queue = room.commands
+    client = run.app.test_client()
+    bursts = [('volume', [x % 100 for x in range(args.burst)]), ('channel', [x % 50 + 1 for x in range(args.burst)])]
+    results = {}
+    for mode in ('direct', 'queue'):
+        room.commands = queue if mode == 'queue' else None
+        for kind, values in bursts:
+            calls = server.kodi.calls
+            timings = []
+            started = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for value in values:
+                    sent = time.time()
+                    r = client.get('/{}/{}?request={}'.format(cfg.SECRET, kind, value))
+                    timings.append(time.time() - sent)
+                    if r.status_code != 200:
+                        raise RuntimeError(u'{} answered {}: {}'.format(kind, r.status_code, r.get_data(as_text=True)))
+                    time.sleep(args.interval)
+            if room.commands is not None and not room.commands.join_pending(60):
+                raise RuntimeError('{} commands are not done'.format(kind))
+            done = time.time() - started
+            state = server.kodi.state
+            last = state['volume'] if kind == 'volume' else state['channel']['channelid']
+            if last != values[-1]:
+                raise RuntimeError('{} {}: Kodi has {}, {} expected'.format(mode, kind, last, values[-1]))
+            timings.sort()
+            key = '{}_{}'.format(mode, kind)
+            results[key + '_ack_ms'] = sum(timings) * 1000.0 / len(timings)
+            results[key + '_done_sec'] = done
+            results[key + '_kodi_calls'] = server.kodi.calls - calls
+            print('{:<6} {:<7} {} requests: answer {:.1f} ms mean, {:.1f} ms p99, Kodi done in {:.2f} sec. '
+                  'with {} calls'.format(mode, kind, len(values), results[key + '_ack_ms'],
+                                         timings[int(len(timings) * 0.99)] * 1000.0, done,
+                                         results[key + '_kodi_calls']))
+    stats = queue.stats()
+    results['coalesced_share'] = float(stats['coalesced']) / max(stats['submitted'], 1)
+    print('queue: {submitted} submitted, {coalesced} coalesced, {executed} executed, {failed} failed'.format(**stats))
+    server.shutdown()
+    return results
+
+
+def bench_feed(args):
+    """
+    Write synthetic XMLTV feed for manual runs of helpers.py or fakekodi.py setups.
+    """
+    started = time.time()
+    size = write_xmltv(args.out, args.channels, args.programs, args.categories)
+    print('{}: {} channels, {} programs, {:.1f} MB uncompressed, {:.1f} MB gzip in {:.1f} sec.'.format(
+        args.out, args.channels, args.channels * args.programs, size / 1048576.0,
+        os.path.getsize(args.out) / 1048576.0, time.time() - started))
+    return {'programs': args.channels * args.programs, 'uncompressed_mb': size / 1048576.0,
+            'gzip_mb': os.path.getsize(args.out) / 1048576.0}
+
+
+def serve_feed(path):
+    """
+    Serve XMLTV file over local HTTP with Last-Modified, so refresh goes through download and 304.
+    :return:
+    (server, url of the file)
+    """
+    import functools
+    import threading
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=os.path.dirname(path)))
+    threading.Thread(target=server.serve_forever, name='feed', daemon=True).start()
+    return server, 'http://127.0.0.1:{}/{}'.format(server.server_address[1], os.path.basename(path))
+
+
+def start_app(args, name):
+    """
+    Fake Kodi and local XMLTV feed, application pointed at them with a scratch database.
+    :return:
+    (application context, fake Kodi server, feed server)
+    """
+    import fakekodi
+    import config as cfg
+
+    path = os.path.join(tempfile.gettempdir(), 'bench_{}.xml.gz'.format(name))
+    write_xmltv(path, args.channels, args.programs)
+    kodi_server, url = fakekodi.start(groups=args.groups, channels=args.channels, latency=args.latency)
+    feed_server, cfg.TVGURL = serve_feed(path)
+    # Before run creates its Kodi clients
+    cfg.KODIURL = url
+    cfg.KODIS = None
+    cfg.KODITCPPORT = None
+    ctx = bench_db(os.path.join(tempfile.gettempdir(), 'bench_{}.db'.format(name)))
+    import helpers
+    helpers.migrate_db()
+    return ctx, kodi_server, feed_server
+
+
+def bench_refresh(args):
+    """
+    Refresh jobs end to end: XMLTV download and ingest, not modified feed, Kodi channel catalog.
+    """
+    import contextlib
+    import io
+
+    ctx, kodi_server, feed_server = start_app(args, 'refresh')
+    import helpers
+    import metrics
+    results = {}
+    for name, job in (('xmltv', helpers.get_xmltv), ('xmltv_not_modified', helpers.get_xmltv),
+                      ('catalog', helpers.cat_chans)):
+        before = {k: v[1] for k, v in metrics.ingest_phase_seconds.values.items()}
+        started = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = job()
+        results['{}_sec'.format(name)] = time.time() - started
+        phases = ['{} {:.2f}'.format(phase, total - before.get((job_name, phase), 0.0))
+                  for (job_name, phase), (_, total) in sorted(metrics.ingest_phase_seconds.values.items())
+                  if total != before.get((job_name, phase), 0.0)]
+        print('{}: {} rows in {:.2f} sec. ({})'.format(name, rows, results['{}_sec'.format(name)],
+                                                     ', '.join(phases)))
+    results['programs'] = args.channels * args.programs
+    ctx.pop()
+    kodi_server.shutdown()
+    feed_server.shutdown()
+    return results
+
+
+def bench_routes(args):
+    """
+    Every run.py route over HTTP through waitress, against fake Kodi and a database loaded from synthetic feed.
+    """
+    import contextlib
+    import io
+    import threading
+    import requests
+    import config as cfg
+
+    ctx, kodi_server, feed_server = start_app(args, 'routes')
+    import helpers
+    with contextlib.redirect_stdout(io.StringIO()):
+        helpers.get_xmltv()
+        helpers.cat_chans()
+    ctx.pop()
+    import run
+    from waitress import create_server
+    server = create_server(run.app, host='127.0.0.1', port=0)
+    threading.Thread(target=server.run, name='waitress', daemon=True).start()
+
+    base = 'http://127.0.0.1:{}/{}'.format(server.effective_port, cfg.SECRET)
+    routes = [('channel', '/channel'), ('channel_set', '/channel?request=7'),
+              ('label', '/label'), ('label_set', u'/label?request=Канал 9'),
+              ('volume', '/volume'), ('volume_set', '/volume?request=30'),
+              ('power', '/power'), ('mute', '/mute'), ('mute_set', '/mute?request=0'),
+              ('source', '/source'), ('source_set', '/source?request=two'),
+              ('categories', '/category'), ('category_now', u'/category?request=Категория 1&now=1'),
+              ('category_next', u'/category?request=Категория 1'),
+              ('category_filter', u'/category?request=Категория 1&filter_program=ПЕРЕДАЧА 1'),
+              ('category_page', u'/category?request=Категория 1&limit=20&fields=channel,title'),
+              ('status', '/status'), ('linkage', '/linkage'), ('metrics', '/metrics')]
+    session = requests.Session()
+    results = {}
+    lines = ['{:<16} {:>9} {:>9} {:>9}'.format('route', 'mean ms', 'p50 ms', 'p99 ms')]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, path in routes:
+            timings = []
+            for _ in range(args.requests):
+                started = time.time()
+                r = session.get(base + path)
+                timings.append(time.time() - started)
+                if r.status_code != 200:
+                    raise RuntimeError(u'{} answered {}: {}'.format(path, r.status_code, r.text))
+            timings.sort()
+            results['{}_ms'.format(name)] = sum(timings) * 1000.0 / len(timings)
+            lines.append('{:<16} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                name, results['{}_ms'.format(name)], timings[len(timings) // 2] * 1000.0,
+                timings[int(len(timings) * 0.99)] * 1000.0))
+    print('\n'.join(lines))
+    kodi_server.shutdown()
+    feed_server.shutdown()
+    return results
+
+
+def bench_storage(args):
+    """
+    Reads during a full XMLTV ingest: /category latency and errors while the refresh job writes.
+    Results cache is off, every request reads SQLite.
+    """
+    import random
+    import threading
+    import config as cfg
+
+    cfg.DB_WAL = not args.no_wal
+    ctx, kodi_server, feed_server = start_app(args, 'storage')
+    import helpers
+    import run
+    helpers.get_xmltv()
+    helpers.cat_chans()
+    print('journal mode: {}'.format(helpers.db.session.execute(helpers.db.text('PRAGMA journal_mode')).scalar()))
+    base = '/{}'.format(cfg.SECRET)
+    stopped = threading.Event()
+    timings = []
+    errors = []
+
+    def path(rnd):
+        # Categories list, future and on air programs: all, by full text index, by LIKE, paged
+        kind = rnd.randrange(5)
+        if kind == 0:
+            return base + '/category'
+        query = u'{}/category?request=Категория {}&now={}'.format(base, rnd.randrange(40), rnd.randrange(2))
+        if kind == 1:
+            return query + u'&filter_program=ПЕРЕДАЧА {}'.format(rnd.randrange(args.programs))
+        if kind == 2:
+            return query + u'&filter_program=ПЕ'
+        if kind == 3:
+            return query + '&limit=20'
+        return query
+
+    def hammer(number):
+        client = run.app.test_client()
+        rnd = random.Random(number)
+        while not stopped.is_set():
+            started = time.time()
+            try:
+                r = client.get(path(rnd))
+                if r.status_code != 200:
+                    errors.append(r.status_code)
+            except Exception as e:
+                errors.append(repr(e))
+            timings.append(time.time() - started)
+
+    # Full ingest again: forget the feed validators
+    helpers.FeedState.query.delete()
+    helpers.db.session.commit()
+    helpers.programs_cache.clear()
+    # Nothing is kept, every request goes to SQL
+    helpers.programs_cache.maxsize = 0
+    threads = [threading.Thread(target=hammer, args=(i,)) for i in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    started = time.time()
+    rows = helpers.get_xmltv()
+    ingest = time.time() - started
+    stopped.set()
+    for thread in threads:
+        thread.join()
+    timings.sort()
+    results = {'ingest_sec': ingest, 'requests': len(timings), 'errors': len(errors),
+               'p50_ms': timings[len(timings) // 2] * 1000.0, 'p99_ms': timings[int(len(timings) * 0.99)] * 1000.0,
+               'max_ms': timings[-1] * 1000.0}
+    print('ingest of {} programs in {:.2f} sec. with {} readers: {} requests, {} errors, '
+          'p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(rows, ingest, args.readers, len(timings), len(errors),
+                                                             results['p50_ms'], results['p99_ms'], results['max_ms']))
+    if errors:
+        print('first error: {}'.format(errors[0]))
+    print('results cache: {}'.format(helpers.programs_cache.stats()))
+    ctx.pop()
+    kodi_server.shutdown()
+    feed_server.shutdown()
+    return results
+
+
+# Quick set of benchmarks for comparison between versions, each in its own process
+SUITE = [['kodi', '--requests', '100'], ['monitor'], ['aliases'], ['linkage'],
+         ['routes'], ['refresh', '--channels', '100', '--programs', '500'], ['storage', '--programs', '300'],
+         ['snapshot', '--channels', '100', '--programs', '500', '--requests', '20'],
+         ['category', '--channels', '50', '--programs', '500'],
+         ['startup', '--channels', '100', '--programs', '500'],
+         ['server', '--requests', '1000', '--concurrency', '200'], ['rooms'], ['commands', '--burst', '20']]
+
+
+def bench_suite(args):
+    import json
+    import subprocess
+
+    results = {}
+    for command in SUITE:
+        out = os.path.join(tempfile.gettempdir(), 'bench_suite_{}.json'.format(command[0]))
+        print('== {}'.format(' '.join(command)))
+        sys.stdout.flush()
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '--json', out] + command)
+        with open(out) as f:
+            results[command[0]] = json.load(f)['results']
+    return results
+
+
+def bench_compare(args):
+    """
+    Print change of every result between two --json reports, e.g. of the previous and current version.
+    """
+    import json
+
+    def flatten(path):
+        with open(path) as f:
+            report = json.load(f)
+        results = report['results'] if report['bench'] == 'suite' else {report['bench']: report['results']}
+        return report.get('revision'), {'{}.{}'.format(bench, key): value for bench, values in results.items()
+                                        for key, value in values.items()}
+
+    old_revision, old = flatten(args.old)
+    new_revision, new = flatten(args.new)
+    print('{:<40} {:>12} {:>12} {:>8}'.format('result', old_revision or 'old', new_revision or 'new', 'change'))
+    for key in sorted(set(old) & set(new)):
+        change = (new[key] - old[key]) * 100.0 / old[key] if old[key] else 0.0
+        print('{:<40} {:>12.3f} {:>12.3f} {:>+7.1f}%'.format(key, old[key], new[key], change))
+
+
+def environment():
+    import platform
+    import subprocess
+    try:
+        revision = subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'revision': revision, 'python': platform.python_version(), 'platform': platform.platform(),
+            'time': datetime.now().isoformat()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='kodi-controller benchmarks')
+    parser.add_argument('--json', help='write results to this file as JSON')
+    sub = parser.add_subparsers(dest='bench')
+    p = sub.add_parser('xmltv', help='streaming XMLTV parse: elapsed time and peak RSS')
+    p.add_argument('--channels', type=int, default=300)
+    p.add_argument('--programs', type=int, default=2000, help='programs per channel')
+    p.add_argument('--fixture', help='path to gzip XMLTV fixture, generated if missing')
+    p.add_argument('--regenerate', action='store_true')
+    p.set_defaults(func=bench_xmltv)
+    p = sub.add_parser('parse', help='programme parsing: server process vs 2, 4, 8 worker processes')
+    p.add_argument('--channels', type=int, default=300)
+    p.add_argument('--programs', type=int, default=2000, help='programs per channel')
+    p.add_argument('--fixture', help='path to gzip XMLTV fixture, generated if missing')
+    p.add_argument('--regenerate', action='store_true')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='first one is the baseline')
+    p.add_argument('--chunk', type=int, default=4, help='MB of XMLTV per worker task')
+    p.set_defaults(func=bench_parse)
+    p = sub.add_parser('ingest', help='Program/Category loading: bulk loader vs per-row ORM')
+    p.add_argument('--channels', type=int, default=100)
+    p.add_argument('--programs', type=int, default=2000, help='programs per channel')
+    p.add_argument('--fixture', help='path to gzip XMLTV fixture, generated if missing')
+    p.add_argument('--regenerate', action='store_true')
+    p.add_argument('--skip-legacy', action='store_true', help='do not run slow per-row ORM loading')
+    p.set_defaults(func=bench_ingest)
+    p = sub.add_parser('kodi', help='Kodi JSON-RPC command latency against fake Kodi')
+    p.add_argument('--requests', type=int, default=200, help='requests per command')
+    p.add_argument('--latency', type=float, default=0.0, help='fake Kodi latency, seconds')
+    p.add_argument('--concurrency', type=int, default=50, help='concurrent async commands')
+    p.add_argument('--groups', type=int, default=40, help='fake Kodi channel groups')
+    p.add_argument('--group-latency', type=float, default=0.0, help='fake Kodi PVR.GetChannels latency, seconds')
+    p.add_argument('--workers', type=int, default=4, help='parallel PVR.GetChannels calls')
+    p.set_defaults(func=bench_kodi)
+    p = sub.add_parser('monitor', help='Kodi state mirror against fake Kodi notifications')
+    p.add_argument('--requests', type=int, default=500)
+    p.add_argument('--latency', type=float, default=0.0, help='fake Kodi latency, seconds')
+    p.set_defaults(func=bench_monitor)
+    p = sub.add_parser('aliases', help='spoken label resolution: alias scan vs index')
+    p.add_argument('--aliases', type=int, default=5000)
+    p.add_argument('--channels', type=int, default=1000)
+    p.add_argument('--requests', type=int, default=2000)
+    p.set_defaults(func=bench_aliases)
+    p = sub.add_parser('linkage', help='Kodi and XMLTV channel reconciliation: alias scan vs report')
+    p.add_argument('--channels', type=int, default=10000)
+    p.add_argument('--legacy', type=int, default=500, help='aliases checked by former scan')
+    p.set_defaults(func=bench_linkage)
+    p = sub.add_parser('snapshot', help='on air programs: SQLite vs in-memory snapshot, memory per program')
+    p.add_argument('--channels', type=int, default=250)
+    p.add_argument('--programs', type=int, default=2000, help='programs per channel')
+    p.add_argument('--requests', type=int, default=100, help='lookups per category')
+    p.add_argument('--fixture', help='path to gzip XMLTV fixture, generated if missing')
+    p.add_argument('--regenerate', action='store_true')
+    p.set_defaults(func=bench_snapshot)
+    p = sub.add_parser('category', help='broad /category request: whole result vs streamed vs page')
+    p.add_argument('--channels', type=int, default=100)
+    p.add_argument('--programs', type=int, default=2000, help='programs per channel')
+    p.add_argument('--categories', type=int, default=4)
+    p.add_argument('--limit', type=int, default=50, help='programs per page')
+    p.add_argument('--walk', type=int, default=1000, help='programs per page when all pages are checked')
+    p.add_argument('--now', action='store_true', help='programs on air instead of future programs')
+    p.add_argument('--fixture', help='path to gzip XMLTV fixture, generated if missing')
+    p.add_argument('--regenerate', action='store_true')
+    p.set_defaults(func=bench_category)
+    p = sub.add_parser('startup', help='time to first /category answer and RSS: SQLite, snapshot, mapped file')
+    p.add_argument('--channels', type=int, default=250)
+    p.add_argument('--programs', type=int, default=2000, help='programs per channel')
+    p.add_argument('--regenerate', action='store_true')
+    p.add_argument('--child', choices=['sqlite', 'memory', 'mmap'], help=argparse.SUPPRESS)
+    p.add_argument('--db', help=argparse.SUPPRESS)
+    p.add_argument('--file', help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_startup)
+    p = sub.add_parser('server', help='routes under load with slow Kodi: waitress vs aiohttp server')
+    p.add_argument('--requests', type=int, default=2000)
+    p.add_argument('--concurrency', type=int, default=400, help='concurrent HTTP clients')
+    p.add_argument('--latency', type=float, default=0.05, help='fake Kodi latency, seconds')
+    p.add_argument('--threads', type=int, default=4, help='waitress threads, 4 is waitress default')
+    p.set_defaults(func=bench_server)
+    p = sub.add_parser('rooms', help='several Kodi instances in one process: memory per room, routing')
+    p.add_argument('--rooms', type=int, default=8)
+    p.add_argument('--requests', type=int, default=800)
+    p.add_argument('--latency', type=float, default=0.0, help='fake Kodi latency, seconds')
+    p.set_defaults(func=bench_rooms)
+    p = sub.add_parser('commands', help='bursts of volume and channel changes: direct Kodi calls vs command queue')
+    p.add_argument('--burst', type=int, default=50, help='requests per burst')
+    p.add_argument('--interval', type=float, default=0.02, help='seconds between requests, key repeat of a remote')
+    p.add_argument('--latency', type=float, default=0.05, help='fake Kodi latency, seconds')
+    p.set_defaults(func=bench_commands)
+    p = sub.add_parser('feed', help='write synthetic XMLTV feed')
+    p.add_argument('--out', default='xmltv.xml.gz')
+    p.add_argument('--channels', type=int, default=300)
+    p.add_argument('--programs', type=int, default=2000, help='programs per channel')
+    p.add_argument('--categories', type=int, default=40)
+    p.set_defaults(func=bench_feed)
+    for name, func, programs, help in (
+            ('routes', bench_routes, 200, 'every route over HTTP against fake Kodi and synthetic EPG'),
+            ('refresh', bench_refresh, 2000, 'XMLTV refresh from local HTTP and catalog from fake Kodi')):
+        p = sub.add_parser(name, help=help)
+        p.add_argument('--channels', type=int, default=100)
+        p.add_argument('--programs', type=int, default=programs, help='programs per channel')
+        p.add_argument('--groups', type=int, default=10, help='fake Kodi channel groups')
+        p.add_argument('--latency', type=float, default=0.0, help='fake Kodi latency, seconds')
+        if name == 'routes':
+            p.add_argument('--requests', type=int, default=200, help='requests per route')
+        p.set_defaults(func=func)
+    p = sub.add_parser('storage', help='reads during XMLTV ingest: latency and errors, WAL vs rollback journal')
+    p.add_argument('--channels', type=int, default=100)
+    p.add_argument('--programs', type=int, default=1000, help='programs per channel')
+    p.add_argument('--groups', type=int, default=10, help='fake Kodi channel groups')
+    p.add_argument('--latency', type=float, default=0.0, help='fake Kodi latency, seconds')
+    p.add_argument('--readers', type=int, default=4, help='threads requesting /category and /label')
+    p.add_argument('--no-wal', action='store_true', help='rollback journal as before')
+    p.set_defaults(func=bench_storage)
+    p = sub.add_parser('suite', help='quick run of all benchmarks, use with --json')
+    p.set_defaults(func=bench_suite)
+    p = sub.add_parser('compare', help='compare two --json reports')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.set_defaults(func=bench_compare)
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return
+    results = args.func(args)
+    if args.json:
+        import json
+        report = dict(environment(), bench=args.bench, results=results,
+                      args={k: v for k, v in vars(args).items() if k not in ('func', 'json')})
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/python
+# coding: utf-8
+# Resolution of spoken channel names to Kodi channels
+import heapq
+import re
+from collections import Counter, defaultdict
+from itertools import chain
+
+# Minimal similarity of fuzzy match, 1.0 is exact
+THRESHOLD = 0.7
+
+UNITS = [u'НОЛЬ', u'ОДИН', u'ДВА', u'ТРИ', u'ЧЕТЫРЕ', u'ПЯТЬ', u'ШЕСТЬ', u'СЕМЬ', u'ВОСЕМЬ', u'ДЕВЯТЬ',
+         u'ДЕСЯТЬ', u'ОДИННАДЦАТЬ', u'ДВЕНАДЦАТЬ', u'ТРИНАДЦАТЬ', u'ЧЕТЫРНАДЦАТЬ', u'ПЯТНАДЦАТЬ',
+         u'ШЕСТНАДЦАТЬ', u'СЕМНАДЦАТЬ', u'ВОСЕМНАДЦАТЬ', u'ДЕВЯТНАДЦАТЬ']
+TENS = [u'', u'', u'ДВАДЦАТЬ', u'ТРИДЦАТЬ', u'СОРОК', u'ПЯТЬДЕСЯТ', u'ШЕСТЬДЕСЯТ', u'СЕМЬДЕСЯТ',
+        u'ВОСЕМЬДЕСЯТ', u'ДЕВЯНОСТО']
+HUNDREDS = [u'', u'СТО', u'ДВЕСТИ', u'ТРИСТА', u'ЧЕТЫРЕСТА', u'ПЯТЬСОТ', u'ШЕСТЬСОТ', u'СЕМЬСОТ',
+            u'ВОСЕМЬСОТ', u'ДЕВЯТЬСОТ']
+
+# Latin to Cyrillic by sound, longest first; Cyrillic letters speech recognition confuses are folded
+TRANSLIT = [(u'SCH', u'Ш'), (u'SH', u'Ш'), (u'CH', u'Ч'), (u'ZH', u'Ж'), (u'KH', u'Х'), (u'TH', u'Т'),
+            (u'PH', u'Ф'), (u'TS', u'Ц'), (u'YA', u'Я'), (u'YU', u'Ю'), (u'OO', u'У'), (u'EE', u'И'),
+            (u'A', u'А'), (u'B', u'Б'), (u'C', u'К'), (u'D', u'Д'), (u'E', u'Е'), (u'F', u'Ф'),
+            (u'G', u'Г'), (u'H', u'Х'), (u'I', u'И'), (u'J', u'ДЖ'), (u'K', u'К'), (u'L', u'Л'),
+            (u'M', u'М'), (u'N', u'Н'), (u'O', u'О'), (u'P', u'П'), (u'Q', u'К'), (u'R', u'Р'),
+            (u'S', u'С'), (u'T', u'Т'), (u'U', u'У'), (u'V', u'В'), (u'W', u'В'), (u'X', u'КС'),
+            (u'Y', u'И'), (u'Z', u'З'), (u'Ё', u'Е'), (u'Й', u'И'), (u'Э', u'Е'), (u'Ъ', u''), (u'Ь', u'')]
+_translit = re.compile(u'|'.join(x for x, _ in TRANSLIT))
+_translit_map = dict(TRANSLIT)
+_number = re.compile(r'\d+')
+_roman = re.compile(u'(?<![A-ZА-Я])[IVX]+(?![A-ZА-Я])')
+ROMAN = {u'I': 1, u'V': 5, u'X': 10}
+_hd = re.compile(u'(^| )(HD|[ВО] ВЫСОКОМ КАЧЕСТВЕ)( |$)')
+_punctuation = re.compile(u'[^0-9A-ZА-ЯЁ ]+')
+
+
+def spell_number(number):
+    """
+    Russian cardinal for 0..999, digits as they are for bigger numbers.
+    """
+    if number < 20:
+        return UNITS[number]
+    if number >= 1000:
+        return u' '.join(UNITS[int(x)] for x in str(number))
+    words = [HUNDREDS[number // 100]]
+    number %= 100
+    if number < 20:
+        words.append(UNITS[number] if number else u'')
+    else:
+        words.extend([TENS[number // 10], UNITS[number % 10] if number % 10 else u''])
+    return u' '.join(x for x in words if x)
+
+
+def roman_to_int(text):
+    total = 0
+    for i, char in enumerate(text):
+        value = ROMAN[char]
+        total += -value if i + 1 < len(text) and ROMAN[text[i + 1]] > value else value
+    return total
+
+
+def phonetic(label):
+    """
+    Form of label for fuzzy matching: numerals spelled as words, Latin transliterated,
+    punctuation and HD marks dropped.
+    :param label: unicode string
+    :return:
+    (unicode string, True if label had HD mark)
+    """
+    text = _punctuation.sub(u' ', label.upper())
+    text = _roman.sub(lambda m: str(roman_to_int(m.group(0))), text)
+    text = _number.sub(lambda m: u' {} '.format(spell_number(int(m.group(0)))), text)
+    text = u' '.join(text.split())
+    hd = _hd.search(text) is not None
+    while _hd.search(text):
+        text = _hd.sub(u' ', text).strip()
+    text = _translit.sub(lambda m: _translit_map[m.group(0)], text)
+    return u' '.join(text.split()), hd
+
+
+def distance(a, b):
+    """
+    Levenshtein distance, bit-parallel algorithm of Myers/Hyyro: one pass of integer ops per char of b.
+    """
+    if not a:
+        return len(b)
+    peq = {}
+    for i, char in enumerate(a):
+        peq[char] = peq.get(char, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    last = 1 << (len(a) - 1)
+    pv, mv, score = full, 0, len(a)
+    for char in b:
+        eq = peq.get(char, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+    return score
+
+
+def similarity(a, b):
+    """
+    1 - Levenshtein distance / length of longer string.
+    """
+    if a == b:
+        return 1.0
+    longest = max(len(a), len(b))
+    if not longest:
+        return 1.0
+    return 1.0 - float(distance(a, b)) / longest
+
+
+def trigrams(text):
+    padded = u'  {} '.format(text)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class FuzzyMatcher(object):
+    """
+    Trigram index over phonetic forms of spoken names, candidates are ranked by edit distance.
+    """
+    candidates = 8
+    # Posting lists scanned per query, rarest trigrams first
+    budget = 2000
+
+    def __init__(self, entries, threshold=THRESHOLD):
+        """
+        :param entries: iterable of (spoken form, target)
+        :param threshold: minimal similarity of a match
+        """
+        self.threshold = threshold
+        self.keys = []
+        self.targets = []
+        self.key_grams = []
+        self.grams = defaultdict(list)
+        positions = {}
+        for spoken, target in entries:
+            key, hd = phonetic(spoken)
+            if not key:
+                continue
+            if key not in positions:
+                positions[key] = len(self.keys)
+                self.keys.append(key)
+                self.targets.append([])
+                grams = frozenset(trigrams(key))
+                self.key_grams.append(grams)
+                for gram in grams:
+                    self.grams[gram].append(positions[key])
+            targets = self.targets[positions[key]]
+            if (target, hd) not in targets:
+                targets.append((target, hd))
+
+    def match(self, label, k=3):
+        """
+        :param label: spoken label
+        :param k: number of results
+        :return:
+        list of (similarity, target) above threshold, best first
+        """
+        key, hd = phonetic(label)
+        grams = trigrams(key)
+        # Candidates share at least one of the rarest trigrams, common ones are skipped within budget
+        postings = sorted((self.grams[x] for x in grams if x in self.grams), key=len)
+        selected = []
+        scanned = 0
+        for posting in postings:
+            if selected and scanned + len(posting) > self.budget:
+                break
+            selected.append(posting)
+            scanned += len(posting)
+        shared = Counter(chain.from_iterable(selected))
+        # Dice coefficient on trigrams preselects candidates for edit distance
+        best = heapq.nlargest(self.candidates, (x for x, _ in shared.most_common(self.candidates * 4)),
+                              key=lambda x: 2.0 * len(grams & self.key_grams[x]) /
+                              (len(grams) + len(self.key_grams[x])))
+        results = []
+        seen = set()
+        for position in best:
+            score = similarity(key, self.keys[position])
+            # Short names differ by a letter or two from too many others
+            if score < (self.threshold if len(key) > 4 else max(self.threshold, 0.8)):
+                continue
+            targets = self.targets[position]
+            # Prefer HD or not HD channel as asked, when both share a name
+            targets = sorted(targets, key=lambda x: x[1] != hd)
+            target = targets[0][0]
+            if target not in seen:
+                seen.add(target)
+                results.append((score, target))
+        results.sort(key=lambda x: -x[0])
+        return results[:k]
+
+
+def normalize(label):
+    """
+    Canonical form of channel label or spoken alias: upper case, single spaces.
+    :param label: unicode string
+    :return:
+    unicode string
+    """
+    return u' '.join(label.upper().split())
+
+
+class ChannelIndex(object):
+    """
+    Reverse dictionary from normalized spoken form to (channel id, label) of a Kodi channel.
+    """
+    def __init__(self, lookup=None, threshold=THRESHOLD):
+        self.lookup = lookup or {}
+        self.fuzzy = FuzzyMatcher(self.lookup.items(), threshold)
+
+    @classmethod
+    def build(cls, channels, aliases, aliases_xmltv, threshold=THRESHOLD):
+        """
+        :param channels: iterable of (id, label) of Kodi channels
+        :param aliases: {Kodi label: [spoken aliases]}, see aliases.py
+        :param aliases_xmltv: {XMLTV label: Kodi label}, see aliases_xmltv.py
+        :return:
+        ChannelIndex, real labels take precedence over aliases
+        """
+        by_label = {}
+        for channel_id, label in channels:
+            by_label.setdefault(normalize(label), (channel_id, label))
+        lookup = dict(by_label)
+        for label, spoken in aliases.items():
+            target = by_label.get(normalize(label))
+            if target is not None:
+                for alias in spoken:
+                    lookup.setdefault(normalize(alias), target)
+        for xmltv_label, label in aliases_xmltv.items():
+            target = by_label.get(normalize(label))
+            if target is not None:
+                lookup.setdefault(normalize(xmltv_label), target)
+        return cls(lookup, threshold)
+
+    def resolve(self, label):
+        """
+        Exact match of label or alias, the best fuzzy match otherwise.
+        :param label: spoken label
+        :return:
+        (channel id, label) or None
+        """
+        found = self.lookup.get(normalize(label))
+        if found is None:
+            matches = self.fuzzy.match(label, 1)
+            if matches:
+                found = matches[0][1]
+        return found
+
+    def match(self, label, k=3):
+        """
+        :param label: spoken label
+        :param k: number of results
+        :return:
+        list of (similarity, (channel id, label)) above threshold, best first
+        """
+        return self.fuzzy.match(label, k)
+
+    def __len__(self):
+        return len(self.lookup)
+
+
+def reconcile(kodi_channels, xmltv_channels, aliases, aliases_xmltv):
+    """
+    Link XMLTV channels to Kodi channels by normalized label, ALIASES_XMLTV taking precedence,
+    and check registered aliases, in one pass over each list.
+    :param kodi_channels: iterable of (id, label) of Kodi channels
+    :param xmltv_channels: iterable of (id, label) of XMLTV channels
+    :param aliases: {Kodi label: [spoken aliases]}, see aliases.py
+    :param aliases_xmltv: {XMLTV label: Kodi label}, see aliases_xmltv.py
+    :return:
+    (links, report): links is {XMLTV id: (Kodi id, Kodi label)}, report lists matched, alias matched
+    and unmatched channels of both sides and aliases of missing Kodi channels
+    """
+    kodi_channels = list(kodi_channels)
+    by_label = {}
+    for channel_id, label in kodi_channels:
+        by_label.setdefault(normalize(label), (channel_id, label))
+    by_alias = {normalize(x): normalize(label) for x, label in aliases_xmltv.items()}
+
+    links = {}
+    xmltv = {'matched': [], 'alias_matched': [], 'unmatched': []}
+    # Kodi id: True if linked by label, False if only by alias
+    linked = {}
+    for xmltv_id, label in xmltv_channels:
+        key = normalize(label)
+        alias = by_alias.get(key)
+        target = by_label.get(key if alias is None else alias)
+        if target is None:
+            xmltv['unmatched'].append(label)
+            continue
+        links[xmltv_id] = target
+        xmltv['matched' if alias is None else 'alias_matched'].append(label)
+        linked[target[0]] = linked.get(target[0], False) or alias is None
+
+    kodi = {'matched': [], 'alias_matched': [], 'unmatched': []}
+    for channel_id, label in kodi_channels:
+        found = linked.get(channel_id)
+        kodi['unmatched' if found is None else 'matched' if found else 'alias_matched'].append(label)
+
+    report = {'kodi': dict(kodi, channels=len(kodi_channels)),
+              'xmltv': dict(xmltv, channels=len(xmltv['matched']) + len(xmltv['alias_matched']) +
+                            len(xmltv['unmatched'])),
+              'links': len(links),
+              'aliases_unmatched': sorted(x for x in aliases if normalize(x) not in by_label),
+              'aliases_xmltv_unmatched': sorted(x for x, label in aliases_xmltv.items()
+                                                if normalize(label) not in by_label)}
+    return links, report
+
+
+# Current index, replaced as a whole on rebuild so readers never see a partial one
+_index = ChannelIndex()
+
+
+def get_index():
+    return _index
+
+
+def set_index(index):
+    global _index
+    _index = index
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# coding: utf-8
+# Kodi commands of one room sent by a background thread: routes answer at once, and a burst of volume steps
+# or channel zaps reaches Kodi as its last command
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from kodi import KodiError
+
+log = logging.getLogger(__name__)
+
+
+class CommandQueue(threading.Thread):
+    """
+    Commands run one at a time in order of submission. A command still waiting is replaced by a newer one
+    of the same kind, which takes its turn at the end of the queue. The thread starts with the first command.
+    """
+    def __init__(self, name):
+        """
+        :param name: room name, label of metrics
+        """
+        super(CommandQueue, self).__init__(name='commands-{}'.format(name))
+        self.daemon = True
+        self.room = name
+        self.lock = threading.Condition()
+        # {kind: (callable, args, time queued)}
+        self.pending = OrderedDict()
+        self.running = None
+        self.counts = {'submitted': 0, 'coalesced': 0, 'executed': 0, 'failed': 0}
+
+    def submit(self, kind, func, *args):
+        """
+        Queue func(*args) in place of a waiting command of kind.
+        :param kind: e.g. 'volume', 'channel'
+        :return:
+        True if a waiting command was dropped
+        """
+        with self.lock:
+            replaced = self.pending.pop(kind, None) is not None
+            self.pending[kind] = (func, args, time.time())
+            self.counts['submitted'] += 1
+            if replaced:
+                self.counts['coalesced'] += 1
+                metrics.commands.inc(self.room, kind, 'coalesced')
+            metrics.command_queue_depth.set(len(self.pending), self.room)
+            if self.ident is None:
+                self.start()
+            self.lock.notify_all()
+        return replaced
+
+    def join_pending(self, timeout=None):
+        """
+        Wait until queued commands are done.
+        :return:
+        True if the queue is empty and idle
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while self.pending or self.running:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def stats(self):
+        """
+        :return:
+        counts of submitted, coalesced, executed and failed commands, queue depth and command in progress
+        """
+        with self.lock:
+            return dict(self.counts, depth=len(self.pending), running=self.running)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                kind, (func, args, queued) = self.pending.popitem(last=False)
+                self.running = kind
+                metrics.command_queue_depth.set(len(self.pending), self.room)
+            metrics.command_wait_seconds.observe(time.time() - queued, kind)
+            outcome = 'executed'
+            try:
+                func(*args)
+                log.debug(u'%s: %s %s done', self.room, kind, args)
+            except KodiError as e:
+                outcome = 'failed'
+                log.warning(u'%s: %s %s failed: %s', self.room, kind, args, e)
+            except Exception:
+                outcome = 'failed'
+                log.exception(u'%s: %s %s failed', self.room, kind, args)
+            metrics.commands.inc(self.room, kind, outcome)
+            with self.lock:
+                self.counts[outcome] += 1
+                self.running = None
+                self.lock.notify_all()
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+# coding: utf-8
+# Streaming XMLTV reader: http://wiki.xmltv.org/index.php/Main_Page/xmltvfileformat.html
+import collections
+import gzip
+import io
+import multiprocessing
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from dateutil.parser import parse as duparse
+
+import requests
+
+
+def open_feed(url, timeout=30, etag=None, last_modified=None):
+    """
+    Open XMLTV url as a file-like object decompressed on the fly, nothing is stored on disk.
+    :param url: XMLTV source, gzip compressed if it ends with .gz
+    :param timeout: connect/read timeout in seconds
+    :param etag: ETag of the last download, if any
+    :param last_modified: Last-Modified of the last download, if any
+    :return:
+    (response, file-like object), file-like object is None if the feed is not modified
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    response = requests.get(url, stream=True, timeout=timeout, headers=headers)
+    if response.status_code == 304:
+        return response, None
+    response.raise_for_status()
+    response.raw.decode_content = True
+    if url.endswith('.gz'):
+        return response, gzip.GzipFile(fileobj=response.raw)
+    return response, response.raw
+
+
+def _text(elem, tag):
+    child = elem.find(tag)
+    if child is None or child.text is None:
+        return None
+    return child.text
+
+
+def iter_xmltv(fileobj):
+    """
+    Parse XMLTV in a single pass, yielding elements as soon as they are closed.
+    Processed elements are dropped from the tree, so memory stays bounded whatever the feed size.
+    :param fileobj: file-like object with XMLTV content
+    :return:
+    generator of ('tv', attributes), ('channel', {'id', 'display-name'}) and
+    ('programme', {'channel', 'start', 'stop', 'title', 'desc', 'category'})
+    """
+    root = None
+    for event, elem in ET.iterparse(fileobj, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+                yield 'tv', dict(elem.attrib)
+            continue
+        if elem.tag == 'channel':
+            yield 'channel', {'id': elem.get('id'),
+                              'display-name': (_text(elem, 'display-name') or '').strip()}
+        elif elem.tag == 'programme':
+            yield 'programme', {'channel': elem.get('channel'),
+                                'start': elem.get('start'),
+                                'stop': elem.get('stop'),
+                                'title': _text(elem, 'title') or '',
+                                'desc': _text(elem, 'desc') or '',
+                                'category': _text(elem, 'category')}
+        else:
+            continue
+        # Drop processed element and its already parsed siblings
+        root.clear()
+
+
+def parse_time(value):
+    """
+    Parse XMLTV timestamp like "20210115063000 +0300" to naive local datetime of the feed.
+    Fixed-format fast path, dateutil is used only for irregular values.
+    :param value: XMLTV timestamp
+    :return:
+    datetime
+    """
+    try:
+        return datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                        int(value[8:10]), int(value[10:12]), int(value[12:14] or 0))
+    except (ValueError, TypeError):
+        return duparse(value).replace(tzinfo=None)
+
+
+# Decompressed bytes per chunk parsed by a worker process
+CHUNK_SIZE = 4 * 1024 * 1024
+_declaration = re.compile(br'^\s*<\?xml[^>]*\?>')
+
+
+def programme_row(elem):
+    """
+    :return:
+    (channel, start, stop, title, upper case title, desc, category) of <programme> element,
+    None if it has no category
+    """
+    category = _text(elem, 'category')
+    if category is None:
+        return None
+    title = _text(elem, 'title') or ''
+    return (int(elem.get('channel')), parse_time(elem.get('start')), parse_time(elem.get('stop')),
+            title, title.upper(), _text(elem, 'desc') or '', category)
+
+
+def parse_chunk(data):
+    """
+    Parse a well-formed piece of XMLTV with <programme> elements only, run in worker processes.
+    :return:
+    list of programme_row() tuples
+    """
+    rows = []
+    for elem in ET.fromstring(data).iter('programme'):
+        row = programme_row(elem)
+        if row is not None:
+            rows.append(row)
+    return rows
+
+
+def split_feed(fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Split XMLTV on <programme boundaries without parsing it.
+    :return:
+    generator of head (XMLTV up to the first programme, closed with </tv>), then programme chunks
+    each wrapped into XML declaration of the feed and <tv>
+    """
+    buf = b''
+    head = None
+    prefix = b''
+    while True:
+        block = fileobj.read(chunk_size)
+        buf += block
+        if head is None:
+            first = buf.find(b'<programme')
+            if first < 0 and block:
+                continue
+            if first < 0:
+                first = buf.rfind(b'</tv>')
+            head, buf = buf[:first], buf[first:]
+            declaration = _declaration.match(head)
+            prefix = (declaration.group(0) if declaration else b'') + b'<tv>'
+            yield head + b'</tv>'
+        if not block:
+            end = buf.rfind(b'</tv>')
+            if buf.find(b'<programme') >= 0:
+                yield prefix + buf[:end if end >= 0 else len(buf)] + b'</tv>'
+            return
+        cut = buf.rfind(b'<programme')
+        if cut > 0:
+            yield prefix + buf[:cut] + b'</tv>'
+            buf = buf[cut:]
+
+
+def iter_xmltv_parallel(fileobj, workers, chunk_size=CHUNK_SIZE):
+    """
+    Parse XMLTV like iter_xmltv() with programmes parsed by worker processes, the feed is read and split
+    by the calling process. Chunks in flight are bounded, so memory stays bounded too.
+    :param fileobj: file-like object with XMLTV content
+    :param workers: number of worker processes
+    :param chunk_size: decompressed bytes per chunk
+    :return:
+    generator of ('tv', attributes), ('channel', {'id', 'display-name'}) and
+    ('programmes', list of programme_row() tuples) in feed order
+    """
+    chunks = split_feed(fileobj, chunk_size)
+    # Header and channels, programmes start in the next chunk
+    for kind, item in iter_xmltv(io.BytesIO(next(chunks))):
+        yield kind, item
+    # Workers do not inherit threads and locks of the server process
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.submit(parse_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield 'programmes', pending.popleft().result()
+        while pending:
+            yield 'programmes', pending.popleft().result()
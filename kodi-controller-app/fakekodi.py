@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# coding: utf-8
+# Fake Kodi JSON-RPC server for benchmarks and manual testing:
+#   python fakekodi.py --port 8080 --groups 40 --channels 400 --latency 0.02 --group-latency 0.5
+import argparse
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeKodi(object):
+    """
+    In-memory Kodi state answering the JSON-RPC methods used by the controller.
+    """
+    def __init__(self, groups=4, channels=100, latency=0.0, group_latency=0.0):
+        self.latency = latency
+        # Kodi lists channels of a group slowly, batch members are answered one after another
+        self.group_latency = group_latency
+        self.lock = threading.Lock()
+        self.channels = [{'channelid': i + 1, 'label': u'Канал {}'.format(i + 1)} for i in range(channels)]
+        self.groups = [{'channelgroupid': g + 1, 'label': u'Группа {}'.format(g + 1)} for g in range(groups)]
+        self.state = {'channel': self.channels[0] if self.channels else None, 'volume': 50, 'muted': False}
+        self.calls = 0
+        self.subscribers = []
+        self.notifications = []
+
+    def notify(self, method, data):
+        """
+        Send notification to TCP subscribers, as Kodi does on port 9090.
+        """
+        message = json.dumps({'jsonrpc': '2.0', 'method': method,
+                              'params': {'sender': 'xbmc', 'data': data}}).encode('utf-8')
+        for sock in list(self.subscribers):
+            try:
+                sock.sendall(message)
+            except socket.error:
+                self.subscribers.remove(sock)
+
+    def disconnect(self):
+        """
+        Drop notification subscribers, like Kodi restart does.
+        """
+        for sock in self.subscribers:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+        del self.subscribers[:]
+
+    def group_channels(self, channelgroupid):
+        return [x for x in self.channels if x['channelid'] % len(self.groups) == channelgroupid - 1]
+
+    def handle(self, method, params):
+        with self.lock:
+            self.calls += 1
+            if method == 'Player.Open':
+                channelid = params['item']['channelid']
+                found = [x for x in self.channels if x['channelid'] == channelid]
+                if not found:
+                    raise ValueError('Invalid channelid')
+                self.state['channel'] = found[0]
+                self.notifications.append(('Player.OnPlay', {
+                    'item': {'id': channelid, 'type': 'channel', 'title': found[0]['label']},
+                    'player': {'playerid': 1, 'speed': 1}}))
+                return 'OK'
+            if method == 'Player.GetItem':
+                chan = self.state['channel'] or {'channelid': 0, 'label': ''}
+                return {'item': {'id': chan['channelid'], 'label': chan['label'], 'type': 'channel'}}
+            if method == 'Application.GetProperties':
+                props = {'volume': self.state['volume'], 'muted': self.state['muted']}
+                return {k: props[k] for k in params['properties'] if k in props}
+            if method == 'Application.SetVolume':
+                self.state['volume'] = params['volume']
+                self.notifications.append(('Application.OnVolumeChanged',
+                                           {'volume': self.state['volume'], 'muted': self.state['muted']}))
+                return self.state['volume']
+            if method == 'Application.SetMute':
+                mute = params['mute']
+                self.state['muted'] = not self.state['muted'] if mute == 'toggle' else bool(mute)
+                self.notifications.append(('Application.OnVolumeChanged',
+                                           {'volume': self.state['volume'], 'muted': self.state['muted']}))
+                return self.state['muted']
+            if method == 'System.Shutdown':
+                return 'OK'
+            if method == 'PVR.GetChannelGroups':
+                return {'channelgroups': self.groups, 'limits': {'total': len(self.groups)}}
+            if method == 'PVR.GetChannels':
+                channels = self.group_channels(params['channelgroupid'])
+                return {'channels': channels, 'limits': {'total': len(channels)}}
+        raise LookupError('Method not found')
+
+    def dispatch(self, request):
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        if self.group_latency and request.get('method') == 'PVR.GetChannels':
+            time.sleep(self.group_latency)
+        try:
+            response['result'] = self.handle(request.get('method'), request.get('params') or {})
+        except LookupError as e:
+            response['error'] = {'code': -32601, 'message': str(e)}
+        except (ValueError, KeyError, TypeError) as e:
+            response['error'] = {'code': -32602, 'message': 'Invalid params: {}'.format(e)}
+        with self.lock:
+            notifications, self.notifications = self.notifications, []
+        for method, data in notifications:
+            self.notify(method, data)
+        return response
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        kodi = self.server.kodi
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if kodi.latency:
+            time.sleep(kodi.latency)
+        try:
+            js = json.loads(body)
+            if isinstance(js, list):
+                answer = [kodi.dispatch(x) for x in js]
+            else:
+                answer = kodi.dispatch(js)
+        except ValueError:
+            answer = {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32700, 'message': 'Parse error'}}
+        data = json.dumps(answer).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+def start(port=0, **kwargs):
+    """
+    Start fake Kodi in a daemon thread.
+    :param port: 0 to pick a free port
+    :param kwargs: FakeKodi arguments
+    :return:
+    (server, url)
+    """
+    server = Server(('127.0.0.1', port), Handler)
+    server.kodi = FakeKodi(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, name='fakekodi')
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def start_notifications(kodi, port=0):
+    """
+    Accept notification subscribers for FakeKodi in a daemon thread.
+    :param kodi: FakeKodi instance
+    :param port: 0 to pick a free port
+    :return:
+    listening socket
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(16)
+
+    def accept():
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except socket.error:
+                kodi.disconnect()
+                return
+            kodi.subscribers.append(sock)
+
+    thread = threading.Thread(target=accept, name='fakekodi-notifications')
+    thread.daemon = True
+    thread.start()
+    return listener
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fake Kodi JSON-RPC server')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--groups', type=int, default=4)
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--group-latency', type=float, default=0.0, help='seconds added to every PVR.GetChannels')
+    parser.add_argument('--tcp-port', type=int, default=9090, help='notifications port')
+    args = parser.parse_args()
+    server, url = start(args.port, groups=args.groups, channels=args.channels, latency=args.latency,
+                        group_latency=args.group_latency)
+    start_notifications(server.kodi, args.tcp_port)
+    print('Fake Kodi at {}/jsonrpc, notifications at port {}'.format(url, args.tcp_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,20 +1,39 @@
 #!/usr/bin/python
 # coding: utf-8
+import base64
+import functools
+import heapq
 import json
+import logging
+import math
 import os.path
-from icecream import ic
+import time
 from datetime import datetime
-from dateutil.parser import parse as duparse
 from dateutil.tz import tzoffset
 
-import requests
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import or_
 
-from run import db
+from run import db, kodi, reader
+from kodi import KodiError
 import config as cfg
 import aliases
+import channels
+import epg
+import metrics
+import snapshot
+import storage
+from cache import TTLCache
 from aliases_xmltv import ALIASES_XMLTV
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger('helpers')
+# Every program found by get_programs(), enable with LOG_LEVELS = {'helpers.programs': 'DEBUG'}
+programs_log = logging.getLogger('helpers.programs')
 
 # https://www.freecodecamp.org/news/sqlalchemy-makes-etl-magically-easy-ab2bd0df928/
 # db = SQLAlchemy(app)
@@ -22,80 +41,95 @@ from aliases_xmltv import ALIASES_XMLTV
 #     run.db.create_all()
 
 
+def fetch_channels(groups, workers=None):
+    """
+    Get channels of groups with PVR.GetChannels per group, up to workers (CATALOG_WORKERS) groups at once.
+    A failed group is logged and skipped.
+    :return:
+    (Kodi channels in groups order, a channel of several groups is listed once; True if no group failed)
+    """
+    answers = kodi.parallel([('PVR.GetChannels', {'channelgroupid': group['channelgroupid']}) for group in groups],
+                            workers=workers or getattr(cfg, 'CATALOG_WORKERS', 4))
+    result = {}
+    failed = 0
+    for group, answer in zip(groups, answers):
+        if isinstance(answer, KodiError):
+            log.warning(u'Skip channel group %s: %s', group['label'], answer)
+            failed += 1
+            continue
+        for channel in answer.get('channels', []):
+            result.setdefault(channel['channelid'], channel)
+    if groups and failed == len(groups):
+        raise KodiError(u'PVR.GetChannels: all {} channel groups failed'.format(len(groups)))
+    return list(result.values()), failed == 0
+
+
+def store_channels(channels, complete=True):
+    """
+    Replace Channel content with Kodi channels. If some groups failed (not complete), channels are
+    added or relabeled and the stored ones are kept: channels of the failed groups stay until a complete refresh.
+    """
+    if complete:
+        Channel.query.delete()
+        db.session.add_all(Channel(id=x['channelid'], label=x['label']) for x in channels)
+    else:
+        for x in channels:
+            db.session.merge(Channel(id=x['channelid'], label=x['label']))
+
+
 def cat_chans():
     """
-    Catalog TV channels via Kodi request and store it in the database. Invalid aliases reported to stdout.
+    Catalog TV channels via Kodi request and store it in the database. Invalid aliases and channels
+    not linked to XMLTV are logged, see get_linkage().
     :return:
-    None
+    number of channels
     """
     result = []
+    phases = metrics.Phases('catalog')
     try:
         # Get channel groups
-        r = requests.post('{}/jsonrpc'.format(cfg.KODIURL),
-                          data='{"jsonrpc": "2.0", "id": 1, "method": "PVR.GetChannelGroups", '
-                               '"params": {"channeltype": "tv"}}', timeout=5)
-        if r.status_code == 200:
-            js = json.loads(r.content)
-            for group in js['result']['channelgroups']:
-                # Get channel group
-                gr = requests.post('{}/jsonrpc'.format(cfg.KODIURL),
-                                   data='{{"jsonrpc": "2.0", "id":1, "method": "PVR.GetChannels", '
-                                        '"params": {{"channelgroupid": {}}}}}'.format(group['channelgroupid']),
-                                   timeout=5)
-                if gr.status_code == 200:
-                    gjs = json.loads(gr.content)
-                    result = result + gjs["result"]["channels"]
-
-        # Check registered aliases for linking with reported channels
-        invalid_aliases = []
-        for al in aliases.ALIASES:
-            if len([x for x in result if x['label'].upper() == al.upper()]) == 0:
-                invalid_aliases.append(al)
-        if len(invalid_aliases) > 0:
-            print ('Followed aliases currently not linked with real channels')
-            print(u"; ".join(invalid_aliases))
-
-        xmlchannels = XMLChannel.query.all()
-        # ic(xmlchannels[0].label, xmlchannels[0].id)
-        # ic(xmlchannels[1].label, xmlchannels[1].id)
-        # ic(xmlchannels[2].label, xmlchannels[2].id)
-        print("Kodi reports {} channels vs {} channels in XMLTV program".format(len(result), len(xmlchannels)))
-
-        # Drop content of Channel
-        Channel.query.delete()
-        db.session.commit()
+        groups = kodi.get_channel_groups('tv')['channelgroups']
+        result, complete = fetch_channels(groups)
+        phases.mark('kodi')
 
         # Populate Channel with Kodi channels
-        for r in result:
-            channel = Channel(id=r['channelid'], label=r['label'])
-            db.session.add(channel)
+        store_channels(result, complete)
         db.session.commit()
+        phases.mark('store')
 
-        # Validate KODI channels with XML TV channels
-        from sqlalchemy import or_
-        alias2xmltv = {value: key for (key, value) in ALIASES_XMLTV.items()}
-        print("Following KODI channels are not linked to XMLTV programs:")
-        channels = [x for x in Channel.query.all()]
-        for chan in channels:
-            alias = ""
-            try:
-                alias = alias2xmltv[chan.label]
-            except KeyError:
-                pass
-            xmlchannels = [x for x in XMLChannel.query.filter(or_(XMLChannel.ulabel == chan.ulabel,
-                                                                  XMLChannel.ulabel == alias)).all()]
-            if len(xmlchannels) == 0:
-                print (u'\t{}'.format(chan.label))
-
-    except requests.exceptions.ConnectTimeout:
-        print("Kodi is not responding, exiting...")
-        exit(2)
+        # Resolve XMLTV channels to KODI channels
+        link_channels()
+        db.session.commit()
+        phases.mark('link')
+
+        build_channel_index()
+        phases.mark('index')
+        programs_cache.clear()
+        load_snapshot()
+        phases.mark('snapshot')
+
+        # Validate registered aliases and KODI channels with XML TV channels
+        report = get_linkage()
+        if report['aliases_unmatched']:
+            log.warning(u'Followed aliases currently not linked with real channels: %s',
+                        u"; ".join(report['aliases_unmatched']))
+        log.info("Kodi reports %s channels vs %s channels in XMLTV program",
+                 report['kodi']['channels'], report['xmltv']['channels'])
+        if report['kodi']['unmatched']:
+            log.info(u'Following KODI channels are not linked to XMLTV programs: %s',
+                     u'; '.join(report['kodi']['unmatched']))
+
+    except KodiError as e:
+        log.error("Kodi is not responding: %s", e)
+        db.session.rollback()
+        raise
+    return len(result)
 
 
 class Channel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     label = db.Column(db.String(128), nullable=False)
-    ulabel = db.Column(db.String(128), nullable=False)
+    ulabel = db.Column(db.String(128), nullable=False, index=True)
 
     def __repr__(self):
         return '<Channel %r>' % self.label
@@ -109,7 +143,7 @@ class Channel(db.Model):
 class XMLChannel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     label = db.Column(db.String(128), nullable=False)
-    ulabel = db.Column(db.String(128), nullable=False)
+    ulabel = db.Column(db.String(128), nullable=False, index=True)
 
     def __repr__(self):
         return '<Channel %r>' % self.label
@@ -134,6 +168,14 @@ class Program(db.Model):
     category = db.relationship('Category',
         backref=db.backref('programs', lazy=True))
 
+    # Refresh which stored the program last, see get_xmltv
+    loaded = db.Column(db.DateTime, nullable=True)
+
+    # Match get_programs predicates: future programs and programs on air of a category (past programs are
+    # pruned on refresh, so start < now leaves little more than programs on air), program identity for upsert
+    __table_args__ = (db.Index('ix_program_category_start', 'category_id', 'start'),
+                      db.Index('ux_program_channel_start', 'channel', 'start', unique=True))
+
     def __repr__(self):
         return '<Program %r>' % self.title
 
@@ -143,6 +185,27 @@ class Program(db.Model):
         self.utitle = self.title.upper()
 
 
+class ChannelLink(db.Model):
+    # XMLTV channel resolved to KODI channel, rebuilt by link_channels()
+    xmltv_id = db.Column(db.Integer, primary_key=True)
+    channel_id = db.Column(db.Integer, nullable=False)
+    label = db.Column(db.String(128), nullable=False)
+
+    def __repr__(self):
+        return '<ChannelLink %r>' % self.label
+
+
+class FeedState(db.Model):
+    # Validators of the last XMLTV download, for conditional requests
+    url = db.Column(db.String(512), primary_key=True)
+    etag = db.Column(db.String(256), nullable=True)
+    last_modified = db.Column(db.String(64), nullable=True)
+    loaded = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<FeedState %r>' % self.url
+
+
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), unique=True, nullable=False)
@@ -151,170 +214,591 @@ class Category(db.Model):
         return '<Category %r>' % self.name
 
 
-def get_xmltv():
+class ProgramLoader(object):
     """
-    Download XMLTV url and store channels and programs in the database.
-    :return:
-    None
+    Bulk loader of XMLTV programs: categories are resolved from an in-process map,
+    rows are upserted on (channel, start) with executemany and committed by the caller in one transaction.
+    """
+    chunk = 5000
+
+    def __init__(self, session, loaded=None):
+        from sqlalchemy.dialects.sqlite import insert
+        self.session = session
+        self.loaded = loaded or datetime.now()
+        self.categories = {x.name: x.id for x in Category.query.all()}
+        self.rows = []
+        self.count = 0
+        # First start of loaded programs per channel
+        self.first = {}
+        upsert = insert(Program.__table__)
+        self.upsert = upsert.on_conflict_do_update(
+            index_elements=['channel', 'start'],
+            set_={x: upsert.excluded[x] for x in ('title', 'utitle', 'stop', 'desc', 'category_id', 'loaded')})
+
+    def category_id(self, name):
+        try:
+            return self.categories[name]
+        except KeyError:
+            result = self.session.execute(Category.__table__.insert().values(name=name))
+            self.categories[name] = result.inserted_primary_key[0]
+            return self.categories[name]
+
+    def add(self, item):
+        if item['category'] is None:
+            return
+        # have to do custom stuff due lack of unicode upper in SQLite3
+        self.add_rows([(int(item['channel']), epg.parse_time(item['start']), epg.parse_time(item['stop']),
+                        item['title'], item['title'].upper(), item['desc'], item['category'])])
+
+    def add_rows(self, rows):
+        """
+        :param rows: epg.programme_row() tuples
+        """
+        first = self.first
+        for channel, start, stop, title, utitle, desc, category in rows:
+            if channel not in first or start < first[channel]:
+                first[channel] = start
+            self.rows.append({'channel': channel, 'title': title, 'utitle': utitle, 'start': start, 'stop': stop,
+                              'desc': desc, 'category_id': self.category_id(category), 'loaded': self.loaded})
+            if len(self.rows) >= self.chunk:
+                self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.session.execute(self.upsert, self.rows)
+            self.count += len(self.rows)
+            self.rows = []
+
+    def drop_replaced(self):
+        """
+        Delete programs the feed no longer has: stored earlier within the time range the feed covers.
+        :return:
+        number of deleted programs
+        """
+        deleted = 0
+        for channel, first in self.first.items():
+            deleted += Program.query.filter(Program.channel == channel,
+                                            Program.start >= first,
+                                            or_(Program.loaded == None, Program.loaded < self.loaded)).\
+                delete(synchronize_session=False)
+        return deleted
+
+
+def prune_programs(now=None, fts=True):
+    """
+    Delete programs which are over, with their entries of the full text index.
+    :param fts: False if rebuild_fts() follows, rows changed since the last rebuild do not match the index
     :return:
+    number of deleted programs
     """
-    # http://wiki.xmltv.org/index.php/Main_Page/xmltvfileformat.html
-    import urllib2
-    import gzip
-    import StringIO
-    import xmltv
-    url = cfg.TVGURL
+    now = now or datetime.now()
+    if fts and fts_ready():
+        # External content index forgets a row only given the indexed values
+        db.session.execute(db.text("INSERT INTO program_fts(program_fts, rowid, utitle, desc) "
+                                   "SELECT 'delete', id, utitle, desc FROM program WHERE stop < :now").
+                           bindparams(db.bindparam('now', type_=db.DateTime)), {'now': now})
+    return Program.query.filter(Program.stop < now).delete(synchronize_session=False)
 
-    # Download XMLTV source
-    out_file_path = url.split("/")[-1][:-3]
-    print('Downloading TV program from: {}'.format(url))
-    response = urllib2.urlopen(url)
-    compressed_file = StringIO.StringIO(response.read())
-    decompressed_file = gzip.GzipFile(fileobj=compressed_file)
 
-    # Extract XMLTV
-    with open(out_file_path, 'w') as outfile:
-        outfile.write(decompressed_file.read())
+# Linkage report of the last link_channels(), None until the first one
+linkage = None
 
-    # Print XMLTV header
-    xmltv_data = xmltv.read_data(open(out_file_path, 'r'))
-    ic(xmltv_data)
 
-    # Read xml channels
-    xmlchannels = xmltv.read_channels(open(out_file_path, 'r'))
-    print("Got {} channels from XMLTV source".format(len(xmlchannels)))
+def reconcile_channels():
+    """
+    :return:
+    (links, report) of Kodi and XMLTV channels in the database, see channels.reconcile()
+    """
+    return channels.reconcile(db.session.query(Channel.id, Channel.label).all(),
+                              db.session.query(XMLChannel.id, XMLChannel.label).all(),
+                              aliases.ALIASES, ALIASES_XMLTV)
 
-    # Drop content of XMLChannel
-    XMLChannel.query.delete()
-    db.session.commit()
 
-    # Populate XMLChannel with channels from XMLTV source
-    for xc in xmlchannels:
-        xmlchannel = XMLChannel(id=int(xc['id']), label=xc['display-name'][0][0].strip())
-        db.session.add(xmlchannel)
-    db.session.commit()
+def link_channels():
+    """
+    Rebuild ChannelLink from XMLChannel and Channel, applying ALIASES_XMLTV, and keep the linkage report.
+    Changes are left in the session, commit is up to the caller.
+    :return:
+    number of linked XMLTV channels
+    """
+    global linkage
+    links, report = reconcile_channels()
+    rows = [{'xmltv_id': xmltv_id, 'channel_id': channel_id, 'label': label}
+            for xmltv_id, (channel_id, label) in links.items()]
+    ChannelLink.query.delete()
+    if rows:
+        db.session.execute(ChannelLink.__table__.insert(), rows)
+    linkage = report
+    return len(rows)
+
+
+def get_linkage():
+    """
+    :return:
+    report of matched, alias matched and unmatched Kodi and XMLTV channels, see channels.reconcile()
+    """
+    global linkage
+    if linkage is None:
+        linkage = reconcile_channels()[1]
+    return linkage
 
-    programs = xmltv.read_programmes(open(out_file_path, 'r'))
-    chunk = 1024
-    index = 0
-    for pr in programs:
-        desc = ""
-        try:
-            desc = pr['desc'][0][0]
-        except KeyError:
-            pass
-        a_category = Category.query.filter(Category.name == pr['category'][0][0]).first()
-        if a_category:
-            p = Program(channel=int(pr['channel']),
-                    title=pr['title'][0][0],
-                    start=duparse(pr['start']),
-                    stop=duparse(pr['stop']),
-                    desc=desc,
-                    category_id=a_category.id)
-            db.session.add(p)
-        else:
-            py = Category(name=pr['category'][0][0])
-            Program(channel=int(pr['channel']),
-                    title=pr['title'][0][0],
-                    start=duparse(pr['start']),
-                    stop=duparse(pr['stop']),
-                    desc=desc,
-                    category=py)
-            db.session.add(py)
-        index += 1
-        if index % chunk == 0:
-            db.session.commit()
-    db.session.commit()
 
-    categories = [x.name for x in Category.query.all()]
-    ic(u', '.join(categories))
+def build_channel_index():
+    """
+    Rebuild alias index of spoken channel names from Channel table and registered aliases.
+    :return:
+    ChannelIndex
+    """
+    index = channels.ChannelIndex.build([(x.id, x.label) for x in Channel.query.all()],
+                                        aliases.ALIASES, ALIASES_XMLTV)
+    channels.set_index(index)
+    return index
 
 
+def get_xmltv():
+    """
+    Refresh channels and programs from XMLTV url. The feed is downloaded only if changed since the last
+    refresh, decompressed and parsed in a single streaming pass and merged into the database in one
+    transaction, so readers see either the old or the new program. Programs which are over are pruned.
+    :return:
+    number of loaded programs, 0 if the feed is not modified
+    """
+    url = cfg.TVGURL
+
+    phases = metrics.Phases('xmltv')
+    state = FeedState.query.get(url)
+    log.info('Downloading TV program from: %s', url)
+    response, feed = epg.open_feed(url, etag=state.etag if state else None,
+                                   last_modified=state.last_modified if state else None)
+    phases.mark('connect')
+    try:
+        if feed is None:
+            log.info('TV program is not modified since %s', state.loaded)
+            # Pruning keeps the full text index current, nothing to rebuild
+            pruned = prune_programs()
+            phases.mark('merge')
+            db.session.commit()
+            phases.mark('commit')
+            programs_cache.clear()
+            load_snapshot()
+            phases.mark('snapshot')
+            log.info('Pruned %s programs', pruned)
+            return 0
+
+        loader = ProgramLoader(db.session)
+        channels = []
+        workers = getattr(cfg, 'EPG_WORKERS', 1)
+        for kind, item in epg.iter_xmltv(feed) if workers <= 1 else epg.iter_xmltv_parallel(feed, workers):
+            if kind == 'programme':
+                loader.add(item)
+            elif kind == 'programmes':
+                loader.add_rows(item)
+            elif kind == 'channel':
+                label = item['display-name']
+                channels.append({'id': int(item['id']), 'label': label, 'ulabel': label.upper()})
+            else:
+                log.debug('XMLTV header: %s', item)
+        loader.flush()
+        # Download, decompression, parsing and loading are one streaming pass
+        phases.mark('parse')
+        replaced = loader.drop_replaced()
+        # Loaded programs are indexed by the rebuild below, the index is left alone until then
+        rebuild = bool(loader.count or replaced)
+        pruned = prune_programs(fts=not rebuild)
+        phases.mark('merge')
+        # Replace content of XMLChannel with channels from XMLTV source
+        XMLChannel.query.delete()
+        if channels:
+            db.session.execute(XMLChannel.__table__.insert(), channels)
+        link_channels()
+        phases.mark('channels')
+        if rebuild:
+            rebuild_fts()
+            phases.mark('fts')
+        if state is None:
+            state = FeedState(url=url)
+            db.session.add(state)
+        state.etag = response.headers.get('ETag')
+        state.last_modified = response.headers.get('Last-Modified')
+        state.loaded = loader.loaded
+        db.session.commit()
+        phases.mark('commit')
+        programs_cache.clear()
+        load_snapshot()
+        phases.mark('snapshot')
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        response.close()
+    log.info("Got %s channels and %s programs from XMLTV source, %s replaced and %s past programs dropped",
+             len(channels), loader.count, replaced, pruned)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(u'Categories: %s', u', '.join(x.name for x in Category.query.all()))
+    return loader.count
+
+
+# Results of get_programs, dropped when catalog or TV program changes
+programs_cache = TTLCache(maxsize=getattr(cfg, 'CACHE_SIZE', 256), ttl=getattr(cfg, 'CACHE_TTL', 60))
+metrics.programs_cache_entries.set_function(lambda: programs_cache.stats()['size'])
+metrics.programs_cache_hits.set_function(lambda: programs_cache.stats()['hits'])
+metrics.programs_cache_misses.set_function(lambda: programs_cache.stats()['misses'])
+metrics.programs_cache_invalidations.set_function(lambda: programs_cache.stats()['invalidations'])
+# Longer results are not cached to keep cache memory bounded
+CACHE_MAX_ITEMS = 5000
+# In-memory copy of current and future programs of linked channels, None if disabled or not loaded yet
+epg_snapshot = None
+
+
+def load_snapshot():
+    """
+    Rebuild in-memory EPG snapshot from the database if EPG_SNAPSHOT is enabled. With EPG_SNAPSHOT_FILE
+    the snapshot is written there and served from the file mapped to memory.
+    :return:
+    number of programs in snapshot
+    """
+    global epg_snapshot
+    path = getattr(cfg, 'EPG_SNAPSHOT_FILE', None)
+    if not getattr(cfg, 'EPG_SNAPSHOT', False) and not path:
+        return 0
+    links = {x.xmltv_id: u'{}/{}:'.format(x.channel_id, x.label) for x in ChannelLink.query.all()}
+    # Plain rows in table order, sorting by start is cheaper in memory than through an index
+    query = db.session.query(Category.name, Program.channel, Program.title, Program.start, Program.stop).\
+        join(Category, Category.id == Program.category_id).\
+        filter(Program.stop > datetime.now())
+    built = snapshot.EPGSnapshot.build(db.session.execute(query.statement), links)
+    if path:
+        snapshot.write(built, path)
+        built = snapshot.MappedSnapshot(path)
+    # The previous mapping is left to the garbage collector, requests in flight may still read it
+    epg_snapshot = built
+    return epg_snapshot.count
+
+
+def open_snapshot():
+    """
+    Serve EPG from EPG_SNAPSHOT_FILE of the last refresh, if any, without reading the database.
+    :return:
+    number of programs in snapshot, 0 if there is no file
+    """
+    global epg_snapshot
+    path = getattr(cfg, 'EPG_SNAPSHOT_FILE', None)
+    if not path or not os.path.isfile(path):
+        return 0
+    try:
+        epg_snapshot = snapshot.MappedSnapshot(path)
+    except ValueError as e:
+        log.warning(u'Snapshot is not used: %s', e)
+        return 0
+    return epg_snapshot.count
+
 
 def get_programs(category=None, filter_program=None, now=False):
-    ic(["get_programs", category, filter_program, now])
-    if category == None:
-        return [x.name for x in Category.query.all()]
-    filter_program_ = '' if filter_program is None else filter_program
-    category_id = Category.query.filter(Category.name == category).first().id
-    search_pattern = u"%{}%".format(filter_program_.upper())
+    """
+    Categories if category is None, otherwise programs of category with title containing filter_program:
+    on air if now, future programs otherwise. Results are cached for a minute at most and shared
+    between callers, do not modify them.
+    """
+    key = (category, filter_program or '', bool(now), int(time.time() // 60))
+    found, result = programs_cache.get(key)
+    if not found:
+        result = query_programs(category, filter_program, now)
+        if len(result) <= CACHE_MAX_ITEMS:
+            programs_cache.put(key, result)
+    return result
+
+
+def query_programs(category=None, filter_program=None, now=False):
+    log.debug('get_programs %s %s %s', category, filter_program, now)
+    # The session is removed here: teardown of run.py started as a script is bound to its own copy of reader
+    with reader.reading():
+        if category == None:
+            return [x.name for x in reader.query(Category.name).all()]
+        ts_now = datetime.now()
+        program_titles = [program_item(x, ts_now, now)
+                          for x in iter_programs(category, filter_program, now, ts_now)]
     if not now:
         # Filtered future programs of selected category
-        # offset = tzoffset(None, 10 * 3600)
-        ts_now = datetime.now()
-        # ic(ts_now)
-        programs = Program.query.filter(Program.category_id == category_id,
-                                        Program.utitle.like(search_pattern),
-                                        Program.start > ts_now).all()
-
-        # ic(programs[0].start)
-        program_titles = [{'channel': resolve_kodi_channel(x.channel),
-                           'title': x.title,
-                           'start': str(x.start),
-                           'stop': str(x.stop),
-                           'time_before_start':
-                               (x.start - ts_now).total_seconds()}
-                          for x in programs if resolve_kodi_channel(x.channel)]
-
-        for program_title in sorted(program_titles, key=lambda y: y['time_before_start']):
-            # print(program_title)
-            print (program_title['channel'] +
-                   " " + program_title['title'] + u" через " +
-                   str(int(program_title['time_before_start'] / 60)) + u' мин., в ' +
-                   str(program_title['start']))
-
-        return sorted(program_titles, key=lambda y: y['time_before_start'])
-
-    # Filtered current programs of selected category
-    ts_now = datetime.now()
-    # ic(ts_now)
-    programs = Program.query.filter(Program.category_id == category_id,
-                                    Program.utitle.like(search_pattern),
-                                    Program.start < ts_now,
-                                    Program.stop > ts_now).all()
-
-    program_titles = [{'channel': resolve_kodi_channel(x.channel),
-                       'title': x.title,
-                       'start': str(x.start),
-                       'stop': str(x.stop),
-                       'time_before_stop': (x.stop - ts_now).total_seconds()}
-                      for x in programs if resolve_kodi_channel(x.channel)]
-    for program_title in sorted(program_titles, key=lambda y: y['time_before_stop'], reverse=True):
-        # print(program_title)
-        print (program_title['channel'] +
-               " " + program_title['title'] + u" ещё " +
-               str(int(program_title['time_before_stop'] / 60)) + u' мин., до ' +
-               str(program_title['stop']))
-
-    return sorted(program_titles, key=lambda y: y['time_before_stop'], reverse=True)
-
-
-def resolve_kodi_channel(xmlChannelId):
-    # ic(xmlChannelId)
-    channelUlabel = XMLChannel.query.filter(XMLChannel.id == xmlChannelId).first().ulabel
-    # ic(channelUlabel)
-    alias = None
-    try:
-        alias = ALIASES_XMLTV[channelUlabel]
-    except KeyError:
-        pass
-    if alias is None:
-        channel = Channel.query.filter(Channel.ulabel == channelUlabel).first()
+        program_titles.sort(key=lambda y: y['time_before_start'])
+    else:
+        # Filtered current programs of selected category
+        program_titles.sort(key=lambda y: y['time_before_stop'], reverse=True)
+    log_programs(program_titles, now)
+    return program_titles
+
+
+def iter_programs(category, filter_program, now, ts_now, cursor=None):
+    """
+    Programs of category on linked KODI channels with title containing filter_program: on air at ts_now
+    if now, starting after it otherwise.
+    :param cursor: program key, programs before it may be skipped
+    :return:
+    iterator of (channel, title, start, stop) in no particular order
+    """
+    filter_program_ = '' if filter_program is None else filter_program
+    if epg_snapshot is not None:
+        if now:
+            return epg_snapshot.iter_on_air(category, filter_program_.upper(), ts_now)
+        return epg_snapshot.iter_upcoming(category, filter_program_.upper(), ts_now)
+    # Programs of selected category on linked KODI channels, single query
+    programs = reader.query(ChannelLink.channel_id, ChannelLink.label, Program.title, Program.start, Program.stop).\
+        join(ChannelLink, ChannelLink.xmltv_id == Program.channel).\
+        join(Category, Category.id == Program.category_id).\
+        filter(Category.name == category)
+    if len(filter_program_) >= 3 and fts_ready():
+        programs = programs.filter(Program.id.in_(search_programs(filter_program_)))
+    elif filter_program_:
+        programs = programs.filter(Program.utitle.like(u"%{}%".format(filter_program_.upper())))
+    if now:
+        programs = programs.filter(Program.start < ts_now, Program.stop > ts_now)
+    else:
+        programs = programs.filter(Program.start > ts_now)
+    if cursor is not None:
+        # Same start or stop as the cursor program are compared in Python
+        if now:
+            programs = programs.filter(Program.stop <= snapshot.from_seconds(-cursor[0]))
+        else:
+            programs = programs.filter(Program.start >= snapshot.from_seconds(cursor[0]))
+    return ((u'{}/{}:'.format(channel_id, label), title, start, stop)
+            for channel_id, label, title, start, stop in programs.yield_per(1000))
+
+
+def program_item(program, ts_now, now):
+    channel, title, start, stop = program
+    item = {'channel': channel, 'title': title, 'start': str(start), 'stop': str(stop)}
+    if now:
+        item['time_before_stop'] = (stop - ts_now).total_seconds()
     else:
-        channel = Channel.query.filter(Channel.ulabel == alias).first()
+        item['time_before_start'] = (start - ts_now).total_seconds()
+    return item
+
+
+def log_programs(program_titles, now):
+    if not programs_log.isEnabledFor(logging.DEBUG):
+        return
+    for program_title in program_titles:
+        if now:
+            programs_log.debug(u'%s %s ещё %s мин., до %s', program_title['channel'], program_title['title'],
+                               int(program_title['time_before_stop'] / 60), program_title['stop'])
+        else:
+            programs_log.debug(u'%s %s через %s мин., в %s', program_title['channel'], program_title['title'],
+                               int(program_title['time_before_start'] / 60), program_title['start'])
+
+
+# Fields of programs in /category responses
+PROGRAM_FIELDS = ('channel', 'title', 'start', 'stop', 'time_before_start', 'time_before_stop')
+
+
+def program_key(program, now):
+    """
+    Order of /category results: soonest start first, on air programs ending last first.
+    Channel and title break ties, so the key of the last program of a page is a cursor for the next one.
+    """
+    channel, title, start, stop = program
+    if now:
+        return -snapshot.to_seconds(stop), channel, title
+    return snapshot.to_seconds(start), channel, title
+
+
+# Seconds of the latest datetime, cursors beyond it are not program keys
+MAX_SECONDS = snapshot.to_seconds(datetime.max)
+
+
+def encode_cursor(key, now):
+    # Mode goes with the key: keys of programs on air and of future programs are not comparable
+    data = json.dumps([int(bool(now))] + list(key), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, now):
+    """
+    :return:
+    program key of encode_cursor()
+    :raises ValueError: cursor is malformed or was made for the other now
+    """
+    # Decoding errors are ValueError too
+    key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    if not isinstance(key, list) or len(key) != 4 or key[0] not in (0, 1) or isinstance(key[1], bool) or \
+            not isinstance(key[1], (int, float)) or not all(isinstance(x, str) for x in key[2:]):
+        raise ValueError('Bad cursor')
+    if key[0] != int(bool(now)):
+        raise ValueError('Cursor of {} programs'.format('future' if now else 'on air'))
+    # Seconds are negative for programs on air
+    seconds = -key[1] if now else key[1]
+    if not math.isfinite(seconds) or not 0 <= seconds <= MAX_SECONDS:
+        raise ValueError('Cursor out of range')
+    return tuple(key[1:])
+
+
+def page_arguments(args):
+    """
+    Pagination arguments of /category: limit - programs per page, cursor - returned with the previous page
+    of the same now, fields - comma separated PROGRAM_FIELDS to return.
+    :param args: query arguments, mapping
+    :return:
+    (limit, cursor key, fields), None for missing arguments
+    :raises ValueError: an argument is malformed
+    """
+    limit, cursor, fields = (None if args.get(x) in [None, "", "{value}"] else args.get(x)
+                             for x in ('limit', 'cursor', 'fields'))
+    now = args.get('now') == '1'
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+    if cursor is not None:
+        cursor = decode_cursor(cursor, now)
+    if fields is not None:
+        fields = tuple(x.strip() for x in fields.split(','))
+        if not set(fields) <= set(PROGRAM_FIELDS):
+            raise ValueError('Unknown field')
+    return limit, cursor, fields
+
+
+def get_program_page(category, filter_program=None, now=False, limit=None, cursor=None):
+    """
+    Page of get_programs() following the program with cursor key, limit programs at most.
+    Programs are selected while they are made, memory taken is bound by limit whatever the number of matches.
+    :return:
+    (programs, cursor of the next page or None if this page is the last)
+    """
+    if limit is None and cursor is None:
+        return get_programs(category, filter_program, now), None
+    key = (category, filter_program or '', bool(now), limit, cursor, int(time.time() // 60))
+    found, result = programs_cache.get(key)
+    if found:
+        return result
+    ts_now = datetime.now()
+    order = functools.partial(program_key, now=now)
+    with reader.reading():
+        programs = iter_programs(category, filter_program, now, ts_now, cursor)
+        if cursor is not None:
+            programs = (x for x in programs if order(x) > cursor)
+        if limit is None:
+            page = sorted(programs, key=order)
+        else:
+            # One more to know if there is a next page
+            page = heapq.nsmallest(limit + 1, programs, key=order)
+    next_cursor = None
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(order(page[-1]), now)
+    program_titles = [program_item(x, ts_now, now) for x in page]
+    log_programs(program_titles, now)
+    result = program_titles, next_cursor
+    if len(program_titles) <= CACHE_MAX_ITEMS:
+        programs_cache.put(key, result)
+    return result
+
+
+def dumps(value):
+    """
+    :return:
+    value as JSON, UTF-8 bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode('utf-8')
 
-    # ic(channel)
-    if channel is None:
-        return None
-    return u'{}/{}:'.format(channel.id, channel.label)
+
+def dump_programs(programs, fields=None, batch=256, **extra):
+    """
+    Encode {"value": programs, **extra} as JSON batch by batch of programs, the document is never held whole.
+    :param fields: PROGRAM_FIELDS to keep, None for all
+    :return:
+    iterator of bytes
+    """
+    yield b'{"value": ['
+    for i in range(0, len(programs), batch):
+        chunk = programs[i:i + batch]
+        if fields is not None:
+            chunk = [{x: item[x] for x in fields if x in item} for item in chunk]
+        # Strip brackets of the batch list
+        yield (b', ' if i else b'') + dumps(chunk)[1:-1]
+    yield b']'
+    for name, value in extra.items():
+        yield b', "' + name.encode('utf-8') + b'": ' + dumps(value)
+    yield b'}'
+
+
+# Full text index over program titles and descriptions, trigram tokenizer gives substring search
+# like LIKE '%...%' does (SQLite 3.34+). Kept in sync by rebuild_fts() after ingest and by prune_programs().
+PROGRAM_FTS = "CREATE VIRTUAL TABLE IF NOT EXISTS program_fts USING fts5(" \
+              "utitle, desc, content='program', content_rowid='id', tokenize='trigram')"
+_fts = {}
+
+
+def fts_ready():
+    """
+    Check whether program_fts exists in the database, result is cached per database.
+    :return:
+    bool
+    """
+    url = str(db.engine.url)
+    if url not in _fts:
+        _fts[url] = db.session.execute(db.text("SELECT count(*) FROM sqlite_master "
+                                               "WHERE name = 'program_fts'")).scalar() > 0
+    return _fts[url]
+
+
+def rebuild_fts():
+    if fts_ready():
+        db.session.execute(db.text("INSERT INTO program_fts(program_fts) VALUES('rebuild')"))
+
+
+def search_programs(text):
+    """
+    Subquery of Program ids with title containing text.
+    :param text: at least 3 characters, shorter strings do not match with trigram tokenizer
+    :return:
+    selectable of program ids
+    """
+    phrase = u'"{}"'.format(text.upper().replace('"', '""'))
+    return db.text("SELECT rowid FROM program_fts WHERE program_fts MATCH :phrase").\
+        bindparams(phrase=u'utitle: ' + phrase).columns(db.column('rowid'))
+
+
+def migrate_db():
+    """
+    Bring an existing database to the current schema: create missing indexes and the full text index.
+    :return:
+    None
+    """
+    from sqlalchemy.exc import OperationalError
+    storage.set_journal(db.session, getattr(cfg, 'DB_WAL', True))
+    columns = [x[1] for x in db.session.execute(db.text("PRAGMA table_info(program)"))]
+    if 'loaded' not in columns:
+        db.session.execute(db.text("ALTER TABLE program ADD COLUMN loaded DATETIME"))
+    if not db.session.execute(db.text("SELECT count(*) FROM sqlite_master "
+                                      "WHERE name = 'ux_program_channel_start'")).scalar():
+        # Programs used to be appended on every refresh, keep the latest copy of each
+        db.session.execute(db.text("DELETE FROM program WHERE id NOT IN "
+                                   "(SELECT max(id) FROM program GROUP BY channel, start)"))
+    db.session.commit()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    try:
+        created = not fts_ready()
+        db.session.execute(db.text(PROGRAM_FTS))
+        _fts.clear()
+        if created:
+            rebuild_fts()
+    except OperationalError as e:
+        log.warning(u'NB: full text search is not available, falling back to LIKE: %s', e)
+        db.session.rollback()
+    db.session.commit()
 
 
 def init_db():
     db.create_all()
     db.session.commit()
+    migrate_db()
 
 
 if __name__ == '__main__' and __package__ is None:
     __package__ = "helpers"
+    import logs
+    logs.setup(cfg)
     init_db()
     get_xmltv()
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# coding: utf-8
+# Kodi JSON-RPC client: https://kodi.wiki/view/JSON-RPC_API
+import asyncio
+import itertools
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class KodiError(Exception):
+    """
+    Kodi is not reachable, answered with HTTP error or with JSON-RPC error.
+    """
+    def __init__(self, message, code=None):
+        super(KodiError, self).__init__(message)
+        self.code = code
+
+
+class KodiMethods(object):
+    """
+    Typed JSON-RPC methods, shared by sync and async clients: each returns what call() returns.
+    """
+    def call(self, method, params=None, timeout=None):
+        raise NotImplementedError
+
+    def player_open(self, channelid, timeout=None):
+        return self.call('Player.Open', {'item': {'channelid': int(channelid)}}, timeout=timeout)
+
+    def player_get_item(self, playerid=1, properties=(), timeout=None):
+        return self.call('Player.GetItem', {'properties': list(properties), 'playerid': playerid},
+                         timeout=timeout)
+
+    def get_properties(self, properties, timeout=None):
+        return self.call('Application.GetProperties', {'properties': list(properties)}, timeout=timeout)
+
+    def set_volume(self, volume, timeout=None):
+        return self.call('Application.SetVolume', {'volume': int(volume)}, timeout=timeout)
+
+    def set_mute(self, mute='toggle', timeout=None):
+        return self.call('Application.SetMute', {'mute': mute}, timeout=timeout)
+
+    def shutdown(self, timeout=None):
+        return self.call('System.Shutdown', timeout=timeout)
+
+    def get_channel_groups(self, channeltype='tv', timeout=None):
+        return self.call('PVR.GetChannelGroups', {'channeltype': channeltype}, timeout=timeout)
+
+    def get_channels(self, channelgroupid, timeout=None):
+        return self.call('PVR.GetChannels', {'channelgroupid': channelgroupid}, timeout=timeout)
+
+
+def _request(request_id, method, params):
+    payload = {'jsonrpc': '2.0', 'id': request_id, 'method': method}
+    if params is not None:
+        payload['params'] = params
+    return payload
+
+
+def _result(js, method):
+    if 'error' in js:
+        error = js['error']
+        raise KodiError(u'{}: {}'.format(method, error.get('message')), error.get('code'))
+    return js.get('result')
+
+
+def _batch_results(js, calls, ids):
+    # Kodi may answer batch members in any order, match them by id
+    if not isinstance(js, list):
+        raise KodiError(u'batch: {}'.format(js.get('error', {}).get('message') if isinstance(js, dict) else js))
+    answers = {x.get('id'): x for x in js}
+    results = []
+    for (method, _), request_id in zip(calls, ids):
+        try:
+            results.append(_result(answers[request_id], method))
+        except KeyError:
+            metrics.kodi_errors.inc(method)
+            results.append(KodiError(u'{}: no answer in batch'.format(method)))
+        except KodiError as e:
+            metrics.kodi_errors.inc(method)
+            results.append(e)
+    return results
+
+
+class KodiClient(KodiMethods):
+    """
+    Blocking client with a keep-alive connection pool.
+    """
+    def __init__(self, url, timeout=5, pool_size=4):
+        self.url = '{}/jsonrpc'.format(url)
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self.session = requests.Session()
+        self.session.headers['Content-Type'] = 'application/json'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def call(self, method, params=None, timeout=None):
+        """
+        Issue JSON-RPC request.
+        :param method: JSON-RPC method like "Player.Open"
+        :param params: dict of method parameters
+        :param timeout: seconds, client default if None
+        :return:
+        "result" member of the response
+        """
+        data = json.dumps(_request(next(self._ids), method, params))
+        with metrics.kodi_call(method):
+            try:
+                r = self.session.post(self.url, data=data, timeout=timeout or self.timeout)
+            except requests.exceptions.RequestException as e:
+                raise KodiError(u'{}: {}'.format(method, e))
+            if r.status_code != 200:
+                raise KodiError(u'{}: HTTP {}'.format(method, r.status_code), r.status_code)
+            try:
+                js = r.json()
+            except ValueError:
+                raise KodiError(u'{}: malformed response'.format(method))
+            return _result(js, method)
+
+    def batch(self, calls, timeout=None):
+        """
+        Issue several JSON-RPC requests in one round-trip.
+        :param calls: list of (method, params)
+        :param timeout: seconds, client default if None
+        :return:
+        list of results in calls order, failed calls are given as KodiError instances
+        """
+        if not calls:
+            return []
+        ids = [next(self._ids) for _ in calls]
+        data = json.dumps([_request(i, method, params) for i, (method, params) in zip(ids, calls)])
+        with metrics.kodi_call('batch'):
+            try:
+                r = self.session.post(self.url, data=data, timeout=timeout or self.timeout)
+            except requests.exceptions.RequestException as e:
+                raise KodiError(u'batch: {}'.format(e))
+            if r.status_code != 200:
+                raise KodiError(u'batch: HTTP {}'.format(r.status_code), r.status_code)
+            try:
+                js = r.json()
+            except ValueError:
+                raise KodiError(u'batch: malformed response')
+            return _batch_results(js, calls, ids)
+
+    def parallel(self, calls, workers=4, timeout=None):
+        """
+        Issue JSON-RPC requests each in its own round-trip, up to workers at once. Unlike batch(),
+        which Kodi answers when its slowest member is done, a slow call delays only itself.
+        :param calls: list of (method, params)
+        :param workers: concurrent requests, keep within pool_size to reuse connections
+        :param timeout: seconds per call, client default if None
+        :return:
+        list of results in calls order, failed calls are given as KodiError instances
+        """
+        if not calls:
+            return []
+
+        def call(method_params):
+            try:
+                return self.call(method_params[0], method_params[1], timeout=timeout)
+            except KodiError as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(calls)))) as pool:
+            return list(pool.map(call, calls))
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncKodiClient(KodiMethods):
+    """
+    asyncio client on top of aiohttp, one pooled keep-alive session per event loop.
+    """
+    def __init__(self, url, timeout=5, limit=32):
+        if aiohttp is None:
+            raise ImportError('AsyncKodiClient requires aiohttp')
+        self.url = '{}/jsonrpc'.format(url)
+        self.timeout = timeout
+        self.limit = limit
+        self._ids = itertools.count(1)
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60),
+                headers={'Content-Type': 'application/json'})
+        return self._session
+
+    async def call(self, method, params=None, timeout=None):
+        data = json.dumps(_request(next(self._ids), method, params))
+        with metrics.kodi_call(method):
+            try:
+                async with self._get_session().post(
+                        self.url, data=data,
+                        timeout=aiohttp.ClientTimeout(total=timeout or self.timeout)) as r:
+                    if r.status != 200:
+                        raise KodiError(u'{}: HTTP {}'.format(method, r.status), r.status)
+                    js = await r.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                raise KodiError(u'{}: {!r}'.format(method, e))
+            return _result(js, method)
+
+    async def batch(self, calls, timeout=None):
+        if not calls:
+            return []
+        ids = [next(self._ids) for _ in calls]
+        data = json.dumps([_request(i, method, params) for i, (method, params) in zip(ids, calls)])
+        with metrics.kodi_call('batch'):
+            try:
+                async with self._get_session().post(
+                        self.url, data=data,
+                        timeout=aiohttp.ClientTimeout(total=timeout or self.timeout)) as r:
+                    if r.status != 200:
+                        raise KodiError(u'batch: HTTP {}'.format(r.status), r.status)
+                    js = await r.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                raise KodiError(u'batch: {!r}'.format(e))
+            return _batch_results(js, calls, ids)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
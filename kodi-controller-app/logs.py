@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# coding: utf-8
+# Logging of the server process: records are queued by the calling thread and written by a background
+# listener, so request threads never wait for console or file I/O
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_listener = None
+
+
+def setup(cfg):
+    """
+    Route records of all loggers through a queue to LOG_FILE, stdout if not set.
+    LOG_LEVEL applies to all loggers, LOG_LEVELS = {logger name: level} overrides it per module,
+    e.g. {'helpers.programs': 'DEBUG'} lists every program found by /category.
+    :return:
+    QueueListener, already started
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    path = getattr(cfg, 'LOG_FILE', None)
+    handler = logging.FileHandler(path, encoding='utf-8') if path else logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(getattr(cfg, 'LOG_LEVEL', 'INFO'))
+    for name, level in (getattr(cfg, 'LOG_LEVELS', None) or {}).items():
+        logging.getLogger(name).setLevel(level)
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    # Write out queued records on exit
+    atexit.register(_listener.stop)
+    return _listener
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# coding: utf-8
+# In-process metrics exposed in Prometheus text format:
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASE_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+# Statements per request
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.extend(self.samples(labels, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, **kwargs):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + kwargs.get('amount', 1)
+
+    def samples(self, labels, value):
+        return ['{}{} {}'.format(self.name, _labels(self.labels, labels), value)]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def set_function(self, func, *labels):
+        """
+        Read the value from func() at scrape time.
+        """
+        self.set(func, *labels)
+
+    def samples(self, labels, value):
+        if callable(value):
+            value = value()
+        return ['{}{} {}'.format(self.name, _labels(self.labels, labels), value)]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def samples(self, labels, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labels, labels, [('le', bound)]),
+                                                 cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, _labels(self.labels, labels), total))
+        lines.append('{}_count{} {}'.format(self.name, _labels(self.labels, labels), cumulative))
+        return lines
+
+
+request_seconds = Histogram('kodi_controller_request_seconds', 'Request latency by route.', ('route',))
+request_db_queries = Histogram('kodi_controller_request_db_queries', 'SQL statements per request by route.',
+                               ('route',), COUNT_BUCKETS)
+request_db_seconds = Histogram('kodi_controller_request_db_seconds', 'SQL time per request by route.', ('route',))
+kodi_call_seconds = Histogram('kodi_controller_kodi_call_seconds', 'Kodi JSON-RPC round-trip by method.',
+                              ('method',))
+kodi_errors = Counter('kodi_controller_kodi_errors_total', 'Failed Kodi JSON-RPC calls by method.', ('method',))
+db_queries = Counter('kodi_controller_db_queries_total', 'SQL statements executed.')
+db_query_seconds = Histogram('kodi_controller_db_query_seconds', 'SQL statement execution time.')
+ingest_phase_seconds = Histogram('kodi_controller_ingest_phase_seconds', 'Duration of refresh job phases.',
+                                 ('job', 'phase'), PHASE_BUCKETS)
+# Every queued command ends executed, failed or coalesced (replaced by a newer one before it was sent)
+commands = Counter('kodi_controller_commands_total', 'Queued Kodi commands by room, kind and outcome.',
+                   ('room', 'kind', 'outcome'))
+command_queue_depth = Gauge('kodi_controller_command_queue_depth', 'Kodi commands waiting by room.', ('room',))
+command_wait_seconds = Histogram('kodi_controller_command_wait_seconds', 'Time queued Kodi commands wait by kind.',
+                                 ('kind',))
+# Results cache of /category, set_function() of helpers reads its stats
+programs_cache_entries = Gauge('kodi_controller_programs_cache_entries', 'Entries in /category results cache.')
+programs_cache_hits = Gauge('kodi_controller_programs_cache_hits', 'Lookups answered by /category results cache.')
+programs_cache_misses = Gauge('kodi_controller_programs_cache_misses', 'Lookups missed by /category results cache.')
+programs_cache_invalidations = Gauge('kodi_controller_programs_cache_invalidations',
+                                     'Clears of /category results cache on catalog or TV program change.')
+
+
+def render():
+    """
+    :return:
+    all metrics in Prometheus text format
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def kodi_call(method):
+    """
+    Time Kodi JSON-RPC call and count its failure.
+    """
+    started = time.time()
+    try:
+        yield
+    except Exception:
+        kodi_errors.inc(method)
+        raise
+    finally:
+        kodi_call_seconds.observe(time.time() - started, method)
+
+
+# SQL statements of the request served by current thread, None when not tracked
+_local = threading.local()
+
+
+def db_begin():
+    _local.db = [0, 0.0]
+
+
+def db_end():
+    """
+    :return:
+    [statements, seconds] since db_begin() in current thread
+    """
+    usage = getattr(_local, 'db', None) or [0, 0.0]
+    _local.db = None
+    return usage
+
+
+def observe_request(route, seconds, db_usage):
+    request_seconds.observe(seconds, route)
+    request_db_queries.observe(db_usage[0], route)
+    request_db_seconds.observe(db_usage[1], route)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.time())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.time() - conn.info['metrics_started'].pop()
+    db_queries.inc()
+    db_query_seconds.observe(elapsed)
+    usage = getattr(_local, 'db', None)
+    if usage is not None:
+        usage[0] += 1
+        usage[1] += elapsed
+
+
+def _on_error(context):
+    # after_cursor_execute is not called for failed statements
+    if context.connection is not None and context.connection.info.get('metrics_started'):
+        context.connection.info['metrics_started'].pop()
+
+
+def instrument_db():
+    """
+    Count and time SQL statements of all SQLAlchemy engines.
+    """
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    if not event.contains(Engine, 'before_cursor_execute', _before_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_execute)
+        event.listen(Engine, 'handle_error', _on_error)
+
+
+class Phases(object):
+    """
+    Durations of consecutive phases of a refresh job: each mark() ends the phase started by the previous one.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.started = time.time()
+
+    def mark(self, phase):
+        now = time.time()
+        ingest_phase_seconds.observe(now - self.started, self.job, phase)
+        self.started = now
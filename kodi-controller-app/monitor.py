@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# coding: utf-8
+# Mirror of Kodi player state fed by JSON-RPC notifications on Kodi TCP port (9090 by default):
+# https://kodi.wiki/view/JSON-RPC_API#TCP
+import json
+import logging
+import socket
+import threading
+
+from kodi import KodiError
+
+log = logging.getLogger(__name__)
+
+
+class KodiState(object):
+    """
+    Thread-safe snapshot of Kodi state. Values are valid only while connected is True,
+    otherwise callers have to ask Kodi directly.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connected = False
+        self.values = {'channel': -1, 'label': "", 'volume': -1, 'muted': False}
+
+    def update(self, **values):
+        with self.lock:
+            self.values.update(values)
+
+    def get(self, name):
+        with self.lock:
+            return self.values[name]
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values, connected=self.connected)
+
+
+class KodiMonitor(threading.Thread):
+    """
+    Background subscriber to Kodi notifications. On every (re)connect the state is
+    resynchronized through JSON-RPC, then kept up to date from notifications.
+    """
+    def __init__(self, client, host, port, state, reconnect=5):
+        super(KodiMonitor, self).__init__(name='kodi-monitor')
+        self.daemon = True
+        self.client = client
+        self.address = (host, port)
+        self.state = state
+        self.reconnect = reconnect
+        self.stopped = threading.Event()
+        self.sock = None
+
+    def resync(self):
+        item, props = self.client.batch([('Player.GetItem', {'properties': [], 'playerid': 1}),
+                                         ('Application.GetProperties', {'properties': ['volume', 'muted']})])
+        if not isinstance(item, KodiError):
+            self.state.update(channel=item['item'].get('id', 0), label=item['item'].get('label', ""))
+        if not isinstance(props, KodiError):
+            self.state.update(volume=props['volume'], muted=props['muted'])
+
+    def on_notification(self, method, data):
+        if method in ('Player.OnPlay', 'Player.OnAVStart'):
+            item = data.get('item', {})
+            if 'title' in item or 'label' in item:
+                self.state.update(channel=item.get('id', 0), label=item.get('title', item.get('label', "")))
+            else:
+                self.resync()
+        elif method == 'Player.OnStop':
+            self.state.update(channel='0', label="")
+        elif method == 'Application.OnVolumeChanged':
+            self.state.update(volume=data['volume'], muted=data['muted'])
+
+    def listen(self):
+        decoder = json.JSONDecoder()
+        buf = ''
+        while not self.stopped.is_set():
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return
+            buf += chunk.decode('utf-8', 'replace')
+            while True:
+                buf = buf.lstrip()
+                if not buf:
+                    break
+                try:
+                    js, end = decoder.raw_decode(buf)
+                except ValueError:
+                    # Incomplete message, wait for more data
+                    break
+                buf = buf[end:]
+                if isinstance(js, dict) and 'method' in js:
+                    self.on_notification(js['method'], js.get('params', {}).get('data') or {})
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sock = socket.create_connection(self.address, timeout=self.reconnect)
+                self.sock.settimeout(None)
+                self.resync()
+                self.state.connected = True
+                log.info('Kodi notifications connected at %s:%s', *self.address)
+                self.listen()
+            except (socket.error, KodiError, ValueError) as e:
+                if self.state.connected:
+                    log.warning('Kodi notifications lost: %s', e)
+            finally:
+                self.state.connected = False
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+            self.stopped.wait(self.reconnect)
+
+    def stop(self):
+        self.stopped.set()
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# coding: utf-8
+# Kodi instances (rooms) of one server process: each with its own connection pool and state mirror,
+# EPG database and alias index are shared
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from commands import CommandQueue
+from kodi import KodiClient
+from monitor import KodiMonitor, KodiState
+
+
+class Room(object):
+    """
+    One Kodi instance: JSON-RPC client, state mirror, TV source and queue of volume and channel commands.
+    """
+    def __init__(self, name, url, timeout=5, tcp_port=None, pool_size=4, queue=True):
+        """
+        :param name: room name used in routes
+        :param url: Kodi web interface URL
+        :param timeout: Kodi JSON-RPC timeout, seconds
+        :param tcp_port: Kodi notifications port, None to poll Kodi on every request
+        :param pool_size: Kodi keep-alive connections
+        :param queue: send volume and channel changes through CommandQueue, False to send them while the request waits
+        """
+        self.name = name
+        self.url = url
+        self.tcp_port = tcp_port
+        self.kodi = KodiClient(url, timeout=timeout, pool_size=pool_size)
+        self.state = KodiState()
+        self.tv = {'source': 'one'}
+        self.monitor = None
+        self.commands = CommandQueue(name) if queue else None
+
+    def start_monitor(self):
+        if self.tcp_port and self.monitor is None:
+            self.monitor = KodiMonitor(self.kodi, urlparse(self.url).hostname, self.tcp_port, self.state)
+            self.monitor.start()
+
+    def set_volume(self, volume):
+        self.state.update(volume=self.kodi.set_volume(volume))
+
+
+class Rooms(object):
+    """
+    Rooms by name in configuration order, the first one is the default room.
+    """
+    def __init__(self, rooms):
+        self.rooms = OrderedDict((x.name, x) for x in rooms)
+        self.default = rooms[0]
+
+    def get(self, name=None):
+        """
+        :return:
+        Room, the default one if name is None, None if there is no such room
+        """
+        if name is None:
+            return self.default
+        return self.rooms.get(name)
+
+    def __iter__(self):
+        return iter(self.rooms.values())
+
+    def __len__(self):
+        return len(self.rooms)
+
+
+def from_config(cfg):
+    """
+    Rooms of KODIS = {name: url}, single room "default" of KODIURL if KODIS is not set.
+    """
+    timeout = getattr(cfg, 'KODITIMEOUT', 5)
+    tcp_port = getattr(cfg, 'KODITCPPORT', 9090)
+    # Catalog refresh fetches channel groups in parallel
+    pool_size = max(4, getattr(cfg, 'CATALOG_WORKERS', 4))
+    queue = getattr(cfg, 'COMMAND_QUEUE', True)
+    kodis = getattr(cfg, 'KODIS', None) or {'default': cfg.KODIURL}
+    return Rooms([Room(name, url, timeout, tcp_port, pool_size, queue) for name, url in kodis.items()])
@@ -1,25 +1,71 @@
 #!/usr/bin/python
 # coding: utf-8
-from flask import Flask, request
+from flask import Flask, Response, g, request
 from flask_sqlalchemy import SQLAlchemy
 from waitress import serve
-import requests
 import json
+import logging
+import time
 from datetime import datetime
-# from icecream import ic
 
 import config as cfg
-import aliases
+import channels
+import logs
+import metrics
+import storage
+from kodi import KodiError
+from rooms import from_config
 # import helpers
 
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///data/data.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = storage.engine_options()
+storage.tune(getattr(cfg, 'DB_MMAP_SIZE', 256 * 1024 * 1024))
 db = SQLAlchemy(app)
 db.app = app
+# Read-only connections of request handlers, db.session is left to refresh jobs and startup
+reader = storage.ReadOnlyDatabase(db, getattr(cfg, 'DB_READERS', 8))
+# Kodi instances by room, see KODIS in config.py.example
+rooms = from_config(cfg)
+# Default room: routes without room name, its Kodi is the source of channel catalog
+kodi = rooms.default.kodi
 # channels = []
-tv = {'mute': False, 'source': 'one'}
+# Background catalog and XMLTV refresh, started with the server
+refresh_worker = None
+metrics.instrument_db()
+# Named explicitly: run.py is imported as __main__ and as run
+log = logging.getLogger('run')
+
+
+@app.before_request
+def start_request():
+    g.started = time.time()
+    metrics.db_begin()
+
+
+@app.teardown_request
+def end_request(exc):
+    if 'started' in g:
+        metrics.observe_request(request.endpoint or 'unknown', time.time() - g.started, metrics.db_end())
+
+
+def room_route(rule):
+    """
+    Register handler of {cfg.SECRET}/{rule} for the default room and of {cfg.SECRET}/{room}/{rule}
+    for the named one, the handler gets Room.
+    """
+    def register(handler):
+        def view(name=None):
+            room = rooms.get(name)
+            if room is None:
+                return "Record not found", 400
+            return handler(room)
+        app.add_url_rule('/{}/{}'.format(cfg.SECRET, rule), handler.__name__, view, methods=['GET'])
+        app.add_url_rule('/{}/<name>/{}'.format(cfg.SECRET, rule), handler.__name__, view, methods=['GET'])
+        return handler
+    return register
 
 
 @app.route('/')
@@ -27,218 +73,317 @@ def entry_point():
     return 'Hello World!'
 
 
-# Rule: {server IP:PORT}/{cfg.SECRET}/channel?request={value} -> Virtual device / TV / Control canals
-@app.route('/{}/channel'.format(cfg.SECRET), methods=['GET'])
-def chan_point():
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/channel?request={value} -> Virtual device / TV / Control canals
+@room_route('channel')
+def chan_point(room):
     if request.args.get("request") in [None, "", "{value}"]:
-        chan = get_chan()
-        print("get channel: {}".format(chan))
+        chan = get_chan(room)
+        log.debug("get channel: %s", chan)
         return '{{"value": {}}}'.format(chan), 200
 
     chan = request.args.get("request")
-    print(u'command> channel {}'.format(chan))
-    r = requests.post('{}/jsonrpc'.format(cfg.KODIURL),
-                      data='{{"id": 1, "jsonrpc": "2.0", "method": "Player.Open", '
-                           '"params": {{"item": {{"channelid": {}}}}}}}'.format(chan))
-    if r.status_code == 200:
-        print("set channel {}".format(request.args.get("request")))
-        return '{{"value": {}}}'.format(request.args.get("request")), 200
-    else:
+    log.info(u'command> channel %s', chan)
+    try:
+        if room.commands is not None:
+            # Answered at once, a zap still waiting is dropped
+            room.commands.submit('channel', room.kodi.player_open, int(chan))
+        else:
+            room.kodi.player_open(chan)
+    except (KodiError, ValueError):
         return "Record not found", 400
+    log.info("set channel %s", request.args.get("request"))
+    return '{{"value": {}}}'.format(request.args.get("request")), 200
 
 
-# Rule: {server IP:PORT}/{cfg.SECRET}/label?request={in}
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/label?request={in}
 # NB: This rule NOT for use via virtual device
-@app.route('/{}/label'.format(cfg.SECRET), methods=['GET'])
-def label_point():
+@room_route('label')
+def label_point(room):
     if request.args.get("request") in [None, "", "{value}"]:
-        label = get_label()
-        print(u'get label: "{}"'.format(label))
+        label = get_label(room)
+        log.debug(u'get label: "%s"', label)
         return u'{{"value": "{}"}}'.format(label), 200
 
     label = request.args.get("request").upper()
     label = label.replace(u'ПОСТАВЬ КАНАЛ', '').lstrip()
-    print(u'command> label {}'.format(label))
+    log.info(u'command> label %s', label)
     if label != "":
-        # Collect aliases for label if any
-        label_aliases = [label]
-        for alias in aliases.ALIASES:
-            if label in aliases.ALIASES[alias]:
-                label_aliases.append(alias)
-                print (u'\t{}'.format(alias))
-
-        for _label in label_aliases:
-            from helpers import Channel
-            channel_id = [x.id for x in Channel.query.filter(Channel.ulabel == _label).all()]
-            if len(channel_id) > 0:
-                r = requests.post('{}/jsonrpc'.format(cfg.KODIURL),
-                                  data='{{"id": 1, "jsonrpc": "2.0", "method": "Player.Open", '
-                                       '"params": {{"item": {{"channelid": {}}}}}}}'.format(channel_id[0]))
-                if r.status_code == 200:
-                    print("set channel {}".format(channel_id[0]))
-                    return '{{"value": {}}}'.format(channel_id[0]), 200
-
-        print(u'NB: Consider register alias for "{}"'.format(label))
+        found = channels.get_index().resolve(label)
+        if found is not None:
+            channel_id, channel_label = found
+            log.info(u'\t%s', channel_label)
+            try:
+                if room.commands is not None:
+                    room.commands.submit('channel', room.kodi.player_open, channel_id)
+                else:
+                    room.kodi.player_open(channel_id)
+            except KodiError:
+                return "Record not found", 400
+            log.info("set channel %s", channel_id)
+            return '{{"value": {}}}'.format(channel_id), 200
+
+        log.warning(u'NB: Consider register alias for "%s"', label)
     return "Record not found", 400
 
 
-# Rule: {server IP:PORT}/{cfg.SECRET}/volume?request={value} -> Virtual device / TV / Volume
-@app.route('/{}/volume'.format(cfg.SECRET), methods=['GET'])
-def volume_point():
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/volume?request={value} -> Virtual device / TV / Volume
+@room_route('volume')
+def volume_point(room):
     if request.args.get("request") in [None, "", "{value}"]:
-        volume = get_volume()
-        print(u'get volume: {}'.format(volume))
+        volume = get_volume(room)
+        log.debug(u'get volume: %s', volume)
         return u'{{"value": {}}}'.format(volume), 200
 
     volume = request.args.get("request")
-    print(u'command> volume {}'.format(volume))
-    r = requests.post('{}/jsonrpc'.format(cfg.KODIURL),
-                      data='{{"jsonrpc": "2.0", "id": 1, "method": "Application.SetVolume", '
-                           '"params": {{"volume": {}}}}}'.format(volume))
-    if r.status_code == 200:
-        print("set volume {}".format(volume))
-        return '{{"value": {}}}'.format(volume), 200
-
-    return "Record not found", 400
+    log.info(u'command> volume %s', volume)
+    try:
+        if room.commands is not None:
+            # Answered at once, the latest volume of a burst wins
+            room.commands.submit('volume', room.set_volume, int(volume))
+        else:
+            room.set_volume(volume)
+    except (KodiError, ValueError):
+        return "Record not found", 400
+    log.info("set volume %s", volume)
+    return '{{"value": {}}}'.format(volume), 200
 
 
-# Rule: {server IP:PORT}/{cfg.SECRET}/power?request={value} -> Virtual device / TV / Power
-@app.route('/{}/power'.format(cfg.SECRET), methods=['GET'])
-def power_point():
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/power?request={value} -> Virtual device / TV / Power
+@room_route('power')
+def power_point(room):
     result = {}
     if request.args.get("request") in [None, "", "{value}"]:
         result['value'] = True
-        print(u'get power: true')
+        log.debug(u'get power: true')
         return json.dumps(result), 200
 
     power = request.args.get("request")
-    print(u'command> power {}'.format(power))
+    log.info(u'command> power %s', power)
     if power == "0":
-        r = requests.post('{}/jsonrpc'.format(cfg.KODIURL),
-                          data='{"jsonrpc": "2.0", "method": "System.Shutdown", "id": 1}')
-        if r.status_code == 200:
-            result['value'] = False
-            print("set power {}".format(power))
-            return json.dumps(result), 200
+        try:
+            room.kodi.shutdown()
+        except KodiError:
+            return "Record not found", 400
+        result['value'] = False
+        log.info("set power %s", power)
+        return json.dumps(result), 200
     if power == "1":
         result['value'] = True
-        print("set power {}".format(power))
+        log.info("set power %s", power)
         return json.dumps(result), 200
 
     return "Record not found", 400
 
 
-# Rule: {server IP:PORT}/{cfg.SECRET}/mute?request={value} -> Virtual device / TV / Mute
-@app.route('/{}/mute'.format(cfg.SECRET), methods=['GET'])
-def mute_point():
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/mute?request={value} -> Virtual device / TV / Mute
+@room_route('mute')
+def mute_point(room):
     if request.args.get("request") in [None, "", "{value}"]:
-        print(u'get mute: {}'.format("1" if tv['mute'] else "0"))
-        return u'{{"value": {}}}'.format("1" if tv['mute'] else "0"), 200
+        muted = get_mute(room)
+        log.debug(u'get mute: %s', "1" if muted else "0")
+        return u'{{"value": {}}}'.format("1" if muted else "0"), 200
 
     mute = request.args.get("request")
-    print(u'command> mute {}'.format(mute))
-    # Issue toggle only if need it
-    if mute != ("1" if tv['mute'] else "0"):
-        r = requests.post('{}/jsonrpc'.format(cfg.KODIURL),
-                          data='{"jsonrpc": "2.0", "method": "Application.SetMute", '
-                               '"params": {"mute": "toggle"}, "id": 1}'
-                          )
-        if r.status_code == 200:
-            js = json.loads(r.content)
-            tv['mute'] = js['result']
-            print("set mute {}".format(format("1" if tv['mute'] else "0")))
-            return '{{"value": {}}}'.format(format("1" if tv['mute'] else "0")), 200
-        else:
+    log.info(u'command> mute %s', mute)
+    # Issue mute only if need it
+    muted = get_mute(room)
+    if mute != ("1" if muted else "0"):
+        try:
+            muted = room.kodi.set_mute(mute == "1")
+        except KodiError:
             return "Record not found", 400
+        room.state.update(muted=muted)
+        log.info("set mute %s", "1" if muted else "0")
+        return '{{"value": {}}}'.format(format("1" if muted else "0")), 200
     else:
-        print("leave mute {}".format(format("1" if tv['mute'] else "0")))
-        return '{{"value": {}}}'.format(format("1" if tv['mute'] else "0")), 200
+        log.info("leave mute %s", "1" if muted else "0")
+        return '{{"value": {}}}'.format(format("1" if muted else "0")), 200
 
 
-# Rule: {server IP:PORT}/{cfg.SECRET}/source?request={value} -> Virtual device / TV / Source
-@app.route('/{}/source'.format(cfg.SECRET), methods=['GET'])
-def source_point():
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/source?request={value} -> Virtual device / TV / Source
+@room_route('source')
+def source_point(room):
     if request.args.get("request") in [None, "", "{value}"]:
-        print(u'get source: {}'.format(tv['source']))
-        return u'{{"value": "{}"}}'.format(tv['source']), 200
+        log.debug(u'get source: %s', room.tv['source'])
+        return u'{{"value": "{}"}}'.format(room.tv['source']), 200
 
     source = request.args.get("request")
-    print(u'command> source {}'.format(source))
+    log.info(u'command> source %s', source)
     # Issue source only if it's a valid source (1..10)
     if source in ['one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'ten']:
-        tv['source'] = source
-        return u'{{"value": "{}"}}'.format(tv['source']), 200
+        room.tv['source'] = source
+        return u'{{"value": "{}"}}'.format(room.tv['source']), 200
     else:
         return "Record not found", 400
 
 
-# Rule: {server IP:PORT}/{cfg.SECRET}/category?request={}&filter_program={}&now={0|1}
+# Rule: {server IP:PORT}/{cfg.SECRET}/category?request={}&filter_program={}&now={0|1}[&limit={}&cursor={}&fields={}]
+# With limit the response has "cursor" to pass for the next page, null on the last page
 # NB: This rule NOT for use via virtual device
 @app.route('/{}/category'.format(cfg.SECRET), methods=['GET'])
 def category_point():
     start_ts = datetime.now()
     result = {}
-    from helpers import get_programs
+    from helpers import dump_programs, get_program_page, get_programs, page_arguments, programs_cache
     if request.args.get("request") in [None, "", "{value}"]:
         categories = get_programs()
         result['value'] = categories
-        print(u'get categories: "{}"'.format(u', '.join(categories)))
+        log.debug(u'get categories: "%s"', u', '.join(categories))
         return json.dumps(result), 200
+    try:
+        limit, cursor, fields = page_arguments(request.args)
+    except ValueError:
+        return "Record not found", 400
     now = False
     if request.args.get("now") == '1':
         now = True
-    categories = get_programs(category=request.args.get("request"),
-                              filter_program=request.args.get("filter_program"),
-                              now=now)
-    result['value'] = categories
-    # ic(result)
-    print(u'get programs: "{}" in {} sec.'.format(len(categories), (datetime.now() - start_ts).total_seconds()))
+    categories, next_cursor = get_program_page(category=request.args.get("request"),
+                                               filter_program=request.args.get("filter_program"),
+                                               now=now, limit=limit, cursor=cursor)
+    log.debug(u'get programs: "%s" in %s sec., cache %s', len(categories),
+              (datetime.now() - start_ts).total_seconds(), programs_cache.stats())
+    extra = {} if limit is None else {'cursor': next_cursor}
+    # Streamed in chunks, waitress sends them as they are encoded
+    return Response(dump_programs(categories, fields, **extra), mimetype='text/html')
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}[/{room}]/status -> channel, label, volume and mute in one Kodi round-trip
+# NB: This rule NOT for use via virtual device
+@room_route('status')
+def status_point(room):
+    if room.state.connected:
+        values = room.state.snapshot()
+        result = {'channel': values['channel'], 'label': values['label'],
+                  'volume': values['volume'], 'mute': "1" if values['muted'] else "0"}
+        log.debug(u'get status: %s', result)
+        return json.dumps(result), 200
+    try:
+        item, props = room.kodi.batch([('Player.GetItem', {'properties': [], 'playerid': 1}),
+                                       ('Application.GetProperties', {'properties': ['volume', 'muted']})])
+    except KodiError:
+        return "Record not found", 400
+    result = {'channel': -1, 'label': "", 'volume': -1, 'mute': "0"}
+    if not isinstance(item, KodiError):
+        result['channel'] = item['item'].get('id', 0)
+        result['label'] = item['item'].get('label', "")
+    if not isinstance(props, KodiError):
+        result['volume'] = props['volume']
+        result['mute'] = "1" if props['muted'] else "0"
+    log.debug(u'get status: %s', result)
     return json.dumps(result), 200
 
 
-# Return current playing channel id or -1
-def get_chan():
-    r = requests.post('{}/jsonrpc'.format(cfg.KODIURL),
-                      data='{"id": "OnPlayGetItem", "jsonrpc": "2.0", "method": "Player.GetItem", '
-                           '"params": {"properties": [], "playerid": 1}}')
-    if r.status_code == 200:
-        js = json.loads(r.content)
-        try:
-            chan_id = js["result"]["item"]["id"]
-        except KeyError:
-            chan_id = '0'
+# Rule: {server IP:PORT}/{cfg.SECRET}/refresh[?request={catalog|xmltv|all}] -> statistics of background catalog
+# and XMLTV refresh, after running the requested jobs at once
+# NB: This rule NOT for use via virtual device
+@app.route('/{}/refresh'.format(cfg.SECRET), methods=['GET'])
+def refresh_point():
+    if refresh_worker is None:
+        return "Record not found", 400
+    name = request.args.get("request")
+    if name not in [None, "", "{value}"]:
+        if name != 'all' and name not in refresh_worker.stats():
+            return "Record not found", 400
+        if not refresh_worker.run_now(None if name == 'all' else name):
+            return "Refresh in progress", 503
+    return json.dumps(refresh_worker.stats()), 200
 
-        return chan_id
-    else:
+
+# Rule: {server IP:PORT}/{cfg.SECRET}/linkage -> matched, alias matched and unmatched Kodi and XMLTV channels
+# NB: This rule NOT for use via virtual device
+@app.route('/{}/linkage'.format(cfg.SECRET), methods=['GET'])
+def linkage_point():
+    from helpers import get_linkage
+    return json.dumps(get_linkage()), 200
+
+
+# Rule: {server IP:PORT}/{cfg.SECRET}/metrics -> request, Kodi, database and refresh metrics for Prometheus
+# NB: This rule NOT for use via virtual device
+@app.route('/{}/metrics'.format(cfg.SECRET), methods=['GET'])
+def metrics_point():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+# Return current playing channel id or -1
+def get_chan(room):
+    if room.state.connected:
+        return room.state.get('channel')
+    try:
+        item = room.kodi.player_get_item()
+    except KodiError:
         return -1
+    try:
+        return item["item"]["id"]
+    except KeyError:
+        return '0'
 
 
 # Return current playing channel label or ""
-def get_label():
-    r = requests.post('{}/jsonrpc'.format(cfg.KODIURL),
-                      data='{"id": "OnPlayGetItem", "jsonrpc": "2.0", "method": "Player.GetItem", '
-                           '"params": {"properties": [], "playerid": 1}}')
-    if r.status_code == 200:
-        js = json.loads(r.content)
-        return js["result"]["item"]["label"]
-    else:
+def get_label(room):
+    if room.state.connected:
+        return room.state.get('label')
+    try:
+        return room.kodi.player_get_item()["item"]["label"]
+    except (KodiError, KeyError):
         return ""
 
 
 # Return current volume or "-1"
-def get_volume():
-    r = requests.post('{}/jsonrpc'.format(cfg.KODIURL),
-                      data='{"jsonrpc": "2.0", "method": "Application.GetProperties", '
-                           '"params": {"properties": ["volume"]}, "id": 1}')
-    if r.status_code == 200:
-        js = json.loads(r.content)
-        return js["result"]["volume"]
-    else:
+def get_volume(room):
+    if room.state.connected:
+        return room.state.get('volume')
+    try:
+        return room.kodi.get_properties(["volume"])["volume"]
+    except (KodiError, KeyError):
         return "-1"
 
 
+# Return True if Kodi is muted
+def get_mute(room):
+    if room.state.connected:
+        return room.state.get('muted')
+    try:
+        return room.kodi.get_properties(["muted"])["muted"]
+    except (KodiError, KeyError):
+        return False
+
+
+def start_services():
+    """
+    Start Kodi state mirror and background refresh, used by run.py and aserver.py entry points.
+    """
+    global refresh_worker
+    import helpers
+    from scheduler import Job, RefreshWorker
+    for room in rooms:
+        room.start_monitor()
+    with app.app_context():
+        helpers.init_db()
+        # Serve from the last good catalog until the first refresh completes
+        helpers.build_channel_index()
+        if not helpers.open_snapshot():
+            helpers.load_snapshot()
+    jobs = [Job('catalog', helpers.cat_chans, getattr(cfg, 'CATALOG_REFRESH', 3600))]
+    if getattr(cfg, 'EPG_REFRESH', 6 * 3600):
+        jobs.append(Job('xmltv', helpers.get_xmltv, getattr(cfg, 'EPG_REFRESH', 6 * 3600)))
+    refresh_worker = RefreshWorker(app, jobs, cleanup=helpers.db.session.remove)
+    refresh_worker.start()
+
+
+def stop_services(timeout=30):
+    """
+    Stop background refresh on server exit, a job in progress is given timeout seconds to commit.
+    """
+    if refresh_worker is not None:
+        refresh_worker.stop()
+        refresh_worker.join(timeout)
+
+
 if __name__ == '__main__' and __package__ is None:
     __package__ = "run"
-    from helpers import cat_chans
-    cat_chans()
-    serve(app, host='0.0.0.0', port=cfg.PORT)
+    logs.setup(cfg)
+    start_services()
+    try:
+        serve(app, host='0.0.0.0', port=cfg.PORT)
+    finally:
+        stop_services()
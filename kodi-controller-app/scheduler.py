@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# coding: utf-8
+# Periodic background jobs of the server process: Kodi channel catalog and XMLTV refresh
+import logging
+import threading
+import time
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+
+class Job(object):
+    """
+    Periodic job with exponential backoff on failures and statistics of runs.
+    """
+    def __init__(self, name, func, interval, backoff=60, max_backoff=3600):
+        """
+        :param name: job name
+        :param func: callable returning number of processed rows
+        :param interval: seconds between successful runs
+        :param backoff: seconds before the first retry of a failed run, doubled on every next failure
+        :param max_backoff: retry delay limit, seconds
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.due = 0.0
+        self.failures = 0
+        self.stats = {'runs': 0, 'failures': 0, 'last_run': None, 'last_success': None,
+                      'last_duration': None, 'last_rows': None, 'last_error': None}
+
+    def delay(self):
+        if self.failures == 0:
+            return self.interval
+        return min(self.backoff * 2 ** (self.failures - 1), self.max_backoff)
+
+
+class RefreshWorker(threading.Thread):
+    """
+    Runs jobs on a daemon thread while the server keeps serving. Jobs never overlap,
+    neither with each other nor with a refresh started by run_now().
+    """
+    def __init__(self, app, jobs, cleanup=None):
+        """
+        :param app: Flask application, jobs run in its context
+        :param jobs: list of Job, run in order when due at the same time
+        :param cleanup: callable run after every job, e.g. db.session.remove
+        """
+        super(RefreshWorker, self).__init__(name='refresh-worker')
+        self.daemon = True
+        self.app = app
+        self.jobs = jobs
+        self.cleanup = cleanup
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+    def execute(self, job):
+        started = time.time()
+        job.stats['last_run'] = datetime.now().isoformat()
+        try:
+            with self.app.app_context():
+                rows = job.func()
+        except Exception as e:
+            job.failures += 1
+            job.stats['failures'] += 1
+            job.stats['last_error'] = u'{}: {}'.format(type(e).__name__, e)
+            log.exception(u'Refresh %s failed, retry in %s sec.: %s', job.name, job.delay(), e)
+        else:
+            job.failures = 0
+            job.stats['last_success'] = job.stats['last_run']
+            job.stats['last_rows'] = rows
+            job.stats['last_error'] = None
+        finally:
+            if self.cleanup is not None:
+                self.cleanup()
+            job.stats['runs'] += 1
+            job.stats['last_duration'] = time.time() - started
+            job.due = time.time() + job.delay()
+        log.info(u'Refresh %s took %.1f sec., %s rows', job.name, job.stats['last_duration'], job.stats['last_rows'])
+
+    def run_now(self, name=None):
+        """
+        Run jobs (all or named one) immediately in the calling thread.
+        :return:
+        False if another refresh is in progress
+        """
+        if not self.lock.acquire(False):
+            return False
+        try:
+            for job in self.jobs:
+                if name is None or job.name == name:
+                    self.execute(job)
+        finally:
+            self.lock.release()
+        return True
+
+    def run(self):
+        while not self.stopped:
+            now = time.time()
+            for job in self.jobs:
+                if job.due <= now and not self.stopped:
+                    with self.lock:
+                        self.execute(job)
+            next_due = min(job.due for job in self.jobs)
+            self.wakeup.wait(max(1.0, next_due - time.time()))
+            self.wakeup.clear()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def stats(self):
+        return {job.name: dict(job.stats, failures_in_row=job.failures) for job in self.jobs}
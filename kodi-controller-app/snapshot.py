@@ -0,0 +1,263 @@
+#!/usr/bin/python
+# coding: utf-8
+# In-memory columnar EPG snapshot for "on air now" and "starting next" lookups,
+# optionally written to a file mapped to memory by the server
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_seconds(ts):
+    # Naive local datetimes as stored in the database, no timezone conversion
+    return (ts - EPOCH).total_seconds()
+
+
+def from_seconds(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+
+class ChannelPrograms(object):
+    """
+    Programs of one channel in one category as parallel arrays sorted by start.
+    """
+    __slots__ = ('starts', 'stops', 'titles')
+
+    def __init__(self):
+        self.starts = array('d')
+        self.stops = array('d')
+        self.titles = array('l')
+
+    def sort(self):
+        order = sorted(range(len(self.starts)), key=self.starts.__getitem__)
+        self.starts = array('d', (self.starts[i] for i in order))
+        self.stops = array('d', (self.stops[i] for i in order))
+        self.titles = array('l', (self.titles[i] for i in order))
+
+
+class EPGSnapshot(object):
+    """
+    Programs of linked channels grouped by category and channel, titles interned in one table.
+    Built once after every refresh and read-only afterwards, so it is shared by request threads without locks.
+    """
+    def __init__(self):
+        self.categories = {}
+        self.titles = []
+        self.channels = {}
+        self.count = 0
+
+    @classmethod
+    def build(cls, rows, links):
+        """
+        :param rows: iterable of (category name, xmltv channel id, title, start, stop) in any order
+        :param links: {xmltv channel id: Kodi channel as "id/label:"}
+        :return:
+        EPGSnapshot
+        """
+        snapshot = cls()
+        title_ids = {}
+        for category, channel, title, start, stop in rows:
+            if channel not in links:
+                continue
+            title_id = title_ids.get(title)
+            if title_id is None:
+                title_id = title_ids[title] = len(snapshot.titles)
+                snapshot.titles.append(title)
+            programs = snapshot.categories.setdefault(category, {}).get(channel)
+            if programs is None:
+                programs = snapshot.categories[category][channel] = ChannelPrograms()
+            programs.starts.append(to_seconds(start))
+            programs.stops.append(to_seconds(stop))
+            programs.titles.append(title_id)
+            snapshot.count += 1
+        for by_channel in snapshot.categories.values():
+            for programs in by_channel.values():
+                programs.sort()
+        snapshot.channels = dict(links)
+        return snapshot
+
+    def _program(self, channel, programs, i):
+        return (self.channels[channel], self.titles[programs.titles[i]],
+                from_seconds(programs.starts[i]), from_seconds(programs.stops[i]))
+
+    def _matches(self, programs, i, pattern):
+        return not pattern or pattern in self.titles[programs.titles[i]].upper()
+
+    def on_air(self, category, pattern, ts):
+        """
+        Programs with start < ts < stop.
+        :param category: category name
+        :param pattern: upper case substring of title, '' for any
+        :param ts: datetime
+        :return:
+        list of (channel, title, start, stop)
+        """
+        return list(self.iter_on_air(category, pattern, ts))
+
+    def iter_on_air(self, category, pattern, ts):
+        """
+        Same as on_air(), programs are made one at a time as they are consumed.
+        """
+        now = to_seconds(ts)
+        for channel, programs in self.categories.get(category, {}).items():
+            i = bisect_left(programs.starts, now) - 1
+            if i >= 0 and programs.stops[i] > now and self._matches(programs, i, pattern):
+                yield self._program(channel, programs, i)
+
+    def upcoming(self, category, pattern, ts, limit=None):
+        """
+        Programs with start > ts, at most limit per channel.
+        :param limit: 1 for programs starting next, None for all
+        :return:
+        list of (channel, title, start, stop)
+        """
+        return list(self.iter_upcoming(category, pattern, ts, limit))
+
+    def iter_upcoming(self, category, pattern, ts, limit=None):
+        """
+        Same as upcoming(), programs are made one at a time as they are consumed.
+        """
+        now = to_seconds(ts)
+        for channel, programs in self.categories.get(category, {}).items():
+            first = bisect_right(programs.starts, now)
+            last = len(programs.starts) if limit is None else min(first + limit, len(programs.starts))
+            for i in range(first, last):
+                if self._matches(programs, i, pattern):
+                    yield self._program(channel, programs, i)
+
+
+# Binary snapshot file: header, string table, categories, channels of categories, then programs as columns.
+# Native byte order, the file is written and read on the same host
+MAGIC = b'KEPG'
+VERSION = 1
+HEADER = struct.Struct('=4sIIIII')
+ALIGN = 8
+
+
+def _pad(out, position):
+    padding = -position % ALIGN
+    out.write(b'\0' * padding)
+    return position + padding
+
+
+def write(snapshot, path):
+    """
+    Write EPGSnapshot to path for MappedSnapshot, replacing the file atomically: mapped readers of the old
+    file keep reading it until they reopen.
+    :return:
+    file size in bytes
+    """
+    strings = []
+    string_ids = {}
+
+    def intern(text):
+        string_id = string_ids.get(text)
+        if string_id is None:
+            string_id = string_ids[text] = len(strings)
+            strings.append(text.encode('utf-8'))
+        return string_id
+
+    categories = array('I')
+    channels = array('I')
+    starts = array('d')
+    stops = array('d')
+    titles = array('I')
+    for category, by_channel in snapshot.categories.items():
+        categories.extend((intern(category), len(channels) // 3, len(by_channel)))
+        for channel, programs in by_channel.items():
+            channels.extend((intern(snapshot.channels[channel]), len(starts), len(programs.starts)))
+            starts.extend(programs.starts)
+            stops.extend(programs.stops)
+            titles.extend(intern(snapshot.titles[x]) for x in programs.titles)
+    offsets = array('I', [0])
+    for data in strings:
+        offsets.append(offsets[-1] + len(data))
+
+    temp = '{}.tmp'.format(path)
+    with open(temp, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, VERSION, len(strings), len(categories) // 3, len(channels) // 3, len(starts)))
+        position = _pad(out, HEADER.size)
+        for section in (offsets, b''.join(strings), categories, channels, starts, stops, titles):
+            data = section.tobytes() if isinstance(section, array) else section
+            out.write(data)
+            position = _pad(out, position + len(data))
+    os.replace(temp, path)
+    return position
+
+
+class MappedSnapshot(object):
+    """
+    Snapshot file written by write() mapped to memory. Program columns are read in place and strings are
+    decoded on access, so opening takes no time whatever the size and the pages are shared between processes.
+    Same lookups as EPGSnapshot.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_strings, n_categories, n_channels, self.count = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not an EPG snapshot of version {}'.format(path, VERSION))
+        view = memoryview(self.mm)
+        position = HEADER.size + -HEADER.size % ALIGN
+
+        def section(size, fmt=None):
+            nonlocal position
+            data = view[position:position + size]
+            position += size + -size % ALIGN
+            return data.cast(fmt) if fmt else data
+
+        self.offsets = section(4 * (n_strings + 1), 'I')
+        self.strings = section(self.offsets[-1])
+        categories = section(4 * 3 * n_categories, 'I')
+        self.entries = section(4 * 3 * n_channels, 'I')
+        self.starts = section(8 * self.count, 'd')
+        self.stops = section(8 * self.count, 'd')
+        self.title_ids = section(4 * self.count, 'I')
+        self.categories = {self.string(categories[i * 3]): (categories[i * 3 + 1], categories[i * 3 + 2])
+                           for i in range(n_categories)}
+
+    def string(self, string_id):
+        return str(self.strings[self.offsets[string_id]:self.offsets[string_id + 1]], 'utf-8')
+
+    def _channels(self, category):
+        first, n = self.categories.get(category, (0, 0))
+        entries = self.entries
+        for i in range(first * 3, (first + n) * 3, 3):
+            yield entries[i], entries[i + 1], entries[i + 1] + entries[i + 2]
+
+    def _program(self, label_id, i, title=None):
+        return (self.string(label_id), title if title is not None else self.string(self.title_ids[i]),
+                from_seconds(self.starts[i]), from_seconds(self.stops[i]))
+
+    def on_air(self, category, pattern, ts):
+        return list(self.iter_on_air(category, pattern, ts))
+
+    def iter_on_air(self, category, pattern, ts):
+        now = to_seconds(ts)
+        for label_id, first, last in self._channels(category):
+            i = bisect_left(self.starts, now, first, last) - 1
+            if i >= first and self.stops[i] > now:
+                title = self.string(self.title_ids[i])
+                if not pattern or pattern in title.upper():
+                    yield self._program(label_id, i, title)
+
+    def upcoming(self, category, pattern, ts, limit=None):
+        return list(self.iter_upcoming(category, pattern, ts, limit))
+
+    def iter_upcoming(self, category, pattern, ts, limit=None):
+        now = to_seconds(ts)
+        for label_id, first, last in self._channels(category):
+            start = bisect_right(self.starts, now, first, last)
+            for i in range(start, last if limit is None else min(start + limit, last)):
+                title = self.string(self.title_ids[i])
+                if not pattern or pattern in title.upper():
+                    yield self._program(label_id, i, title)
+
+    def close(self):
+        for name in ('offsets', 'strings', 'entries', 'starts', 'stops', 'title_ids'):
+            getattr(self, name).release()
+        self.mm.close()
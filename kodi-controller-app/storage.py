@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# coding: utf-8
+# SQLite storage: WAL journal lets request handlers read while the refresh job writes,
+# handlers read through their own pool of read-only connections, the refresh job keeps the writer one
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import Pool, QueuePool
+
+# Applied to every SQLite connection, see tune()
+PRAGMAS = [('synchronous', 'NORMAL'),
+           ('temp_store', 'MEMORY'),
+           # Negative is KiB
+           ('cache_size', -64000),
+           ('busy_timeout', 5000),
+           # WAL file is truncated to this size after checkpoints, big ingest would leave it huge
+           ('journal_size_limit', 64 * 1024 * 1024),
+           ('mmap_size', 256 * 1024 * 1024)]
+
+_pragmas = list(PRAGMAS)
+
+
+def _on_connect(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in _pragmas:
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+    finally:
+        cursor.close()
+
+
+def tune(mmap_size=None):
+    """
+    Set PRAGMAS on every SQLite connection opened from now on.
+    :param mmap_size: bytes of database file mapped to memory, 0 to read with system calls
+    """
+    global _pragmas
+    _pragmas = [(name, mmap_size if name == 'mmap_size' and mmap_size is not None else value)
+                for name, value in PRAGMAS]
+    if not event.contains(Pool, 'connect', _on_connect):
+        event.listen(Pool, 'connect', _on_connect)
+
+
+def set_journal(session, wal=True):
+    """
+    Switch journal of the database, the mode is kept in the database file.
+    :return:
+    journal mode in effect
+    """
+    return session.execute(text('PRAGMA journal_mode={}'.format('WAL' if wal else 'DELETE'))).scalar()
+
+
+def engine_options():
+    """
+    :return:
+    SQLALCHEMY_ENGINE_OPTIONS for the writer engine: one connection kept open for the refresh job,
+    startup and scripts may borrow more
+    """
+    return {'poolclass': QueuePool, 'pool_size': 1, 'max_overflow': 4,
+            'connect_args': {'check_same_thread': False}}
+
+
+class ReadOnlyDatabase(object):
+    """
+    Pool of read-only connections to the database of a Flask-SQLAlchemy instance and thread-local sessions
+    over it. The engine follows SQLALCHEMY_DATABASE_URI, read inside reading() or call remove() when done.
+    """
+    def __init__(self, db, pool_size=8):
+        """
+        :param db: flask_sqlalchemy.SQLAlchemy
+        :param pool_size: read-only connections kept open, as many more are opened under load
+        """
+        self.db = db
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.path = None
+        self.engine = None
+        self.session = scoped_session(sessionmaker())
+
+    def get_engine(self):
+        path = self.db.engine.url.database
+        if self.engine is not None and path == self.path:
+            return self.engine
+        with self.lock:
+            if self.engine is None or path != self.path:
+                if not path or path == ':memory:':
+                    # Nothing to share with another connection, read through the writer
+                    engine = self.db.engine
+                else:
+                    engine = create_engine('sqlite:///file:{}?mode=ro&uri=true'.format(path),
+                                           poolclass=QueuePool, pool_size=self.pool_size,
+                                           max_overflow=self.pool_size, connect_args={'check_same_thread': False})
+                if self.engine is not None and self.engine is not self.db.engine:
+                    self.engine.dispose()
+                self.session.remove()
+                self.session.configure(bind=engine)
+                self.engine, self.path = engine, path
+        return self.engine
+
+    def query(self, *entities):
+        self.get_engine()
+        return self.session.query(*entities)
+
+    def execute(self, statement, params=None):
+        self.get_engine()
+        return self.session.execute(statement, params)
+
+    def remove(self):
+        self.session.remove()
+
+    @contextmanager
+    def reading(self):
+        """
+        Session of the current thread for the block, removed at its end so the connection goes back to the pool.
+        """
+        try:
+            yield self
+        finally:
+            self.session.remove()
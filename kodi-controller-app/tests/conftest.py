@@ -0,0 +1,113 @@
+# coding: utf-8
+# Run from the repository root or kodi-controller-app: python -m pytest
+import gzip
+import importlib.machinery
+import importlib.util
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+APP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP)
+
+# config.py belongs to the installation, tests run with the shipped example whatever it is
+_loader = importlib.machinery.SourceFileLoader('config', os.path.join(APP, 'config.py.example'))
+config = importlib.util.module_from_spec(importlib.util.spec_from_loader('config', _loader))
+_loader.exec_module(config)
+# Nothing listens for Kodi notifications in tests
+config.KODITCPPORT = None
+sys.modules['config'] = config
+
+CHANNELS = 6
+PROGRAMS = 60
+CATEGORIES = 3
+# Programs are 30 minutes long, channels start at the same times
+BASE = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=6)
+
+
+def write_feed(path, channels=CHANNELS, programs=PROGRAMS, categories=CATEGORIES, base=BASE):
+    """
+    Gzip XMLTV feed: channels "1".."channels", programs of channel c are "Передача {p} & {c}"
+    in category "Категория {(c + p) % categories}".
+    """
+    with gzip.open(path, 'wb') as out:
+        out.write(u'<?xml version="1.0" encoding="utf-8"?>\n<tv generator-info-name="tests">\n'.encode('utf-8'))
+        for c in range(channels):
+            out.write(u'<channel id="{0}"><display-name lang="ru">Канал {0}</display-name></channel>\n'
+                      .format(c + 1).encode('utf-8'))
+        for c in range(channels):
+            for p in range(programs):
+                start = base + timedelta(minutes=30 * p)
+                stop = start + timedelta(minutes=30)
+                out.write(u'<programme start="{}" stop="{}" channel="{}"><title lang="ru">Передача {} &amp; {}'
+                          u'</title><desc lang="ru">Описание</desc><category lang="ru">Категория {}</category>'
+                          u'</programme>\n'.format(start.strftime('%Y%m%d%H%M%S +0300'),
+                                                   stop.strftime('%Y%m%d%H%M%S +0300'), c + 1, p, c,
+                                                   (c + p) % categories).encode('utf-8'))
+        out.write(b'</tv>\n')
+    return path
+
+
+@pytest.fixture(scope='session')
+def feed(tmp_path_factory):
+    return write_feed(str(tmp_path_factory.mktemp('feed') / 'xmltv.xml.gz'))
+
+
+@pytest.fixture(scope='session')
+def epg(tmp_path_factory, feed):
+    """
+    Application on a scratch database with the feed loaded and every channel linked to Kodi channel
+    of the same number, inside application context.
+    """
+    import run
+    import epg as xmltv
+    import helpers
+    run.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(tmp_path_factory.mktemp('db') / 'data.db')
+    with run.app.app_context():
+        helpers.init_db()
+        loader = helpers.ProgramLoader(helpers.db.session)
+        with gzip.open(feed, 'rb') as f:
+            for kind, item in xmltv.iter_xmltv(f):
+                if kind == 'programme':
+                    loader.add(item)
+        loader.flush()
+        helpers.db.session.execute(helpers.ChannelLink.__table__.insert(),
+                                   [{'xmltv_id': c + 1, 'channel_id': c + 1, 'label': u'Канал {}'.format(c + 1)}
+                                    for c in range(CHANNELS)])
+        helpers.db.session.commit()
+        helpers.rebuild_fts()
+        helpers.db.session.commit()
+        helpers.programs_cache.clear()
+        yield helpers
+
+
+class FrozenDatetime(datetime):
+    # Inside a program: BASE + 6 h + 10 min
+    @classmethod
+    def now(cls, tz=None):
+        return cls.combine(BASE.date(), BASE.time()) + timedelta(hours=6, minutes=10)
+
+
+@pytest.fixture
+def frozen(monkeypatch, epg):
+    """
+    helpers see the same now for the whole test.
+    """
+    monkeypatch.setattr(epg, 'datetime', FrozenDatetime)
+    epg.programs_cache.clear()
+    return FrozenDatetime.now()
+
+
+@pytest.fixture(params=['sqlite', 'snapshot'])
+def source(request, monkeypatch, epg):
+    """
+    Programs answered from SQLite or from the in-memory snapshot.
+    """
+    if request.param == 'snapshot':
+        monkeypatch.setattr(epg.cfg, 'EPG_SNAPSHOT', True, raising=False)
+        epg.load_snapshot()
+    yield request.param
+    epg.epg_snapshot = None
+    epg.programs_cache.clear()
@@ -0,0 +1,70 @@
+# coding: utf-8
+# Kodi channel catalog fetched from fake Kodi by groups
+import pytest
+
+import fakekodi
+from kodi import KodiClient, KodiError
+
+
+@pytest.fixture
+def fake(monkeypatch, epg):
+    server, url = fakekodi.start(groups=3, channels=9)
+    monkeypatch.setattr(epg, 'kodi', KodiClient(url))
+    yield server.kodi
+    server.shutdown()
+    epg.Channel.query.delete()
+    epg.db.session.commit()
+
+
+def fail_group(monkeypatch, fake, *failed):
+    group_channels = fake.group_channels
+
+    def channels(channelgroupid):
+        if channelgroupid in failed:
+            raise ValueError('Invalid channelgroupid')
+        return group_channels(channelgroupid)
+    monkeypatch.setattr(fake, 'group_channels', channels)
+
+
+def stored(epg):
+    return {x.id: x.label for x in epg.Channel.query.all()}
+
+
+def test_fetch_channels_skips_failed_group(monkeypatch, epg, fake):
+    channels, complete = epg.fetch_channels(fake.groups)
+    assert complete
+    assert sorted(x['channelid'] for x in channels) == list(range(1, 10))
+
+    fail_group(monkeypatch, fake, 2)
+    channels, complete = epg.fetch_channels(fake.groups)
+    assert not complete
+    assert sorted(x['channelid'] for x in channels) == [2, 3, 5, 6, 8, 9]
+
+    fail_group(monkeypatch, fake, 1, 3)
+    with pytest.raises(KodiError):
+        epg.fetch_channels(fake.groups)
+
+
+def test_failed_group_keeps_its_channels(monkeypatch, epg, fake):
+    epg.store_channels(epg.fetch_channels(fake.groups)[0])
+    epg.db.session.commit()
+    assert sorted(stored(epg)) == list(range(1, 10))
+
+    # Group 2 (channels 1, 4, 7) fails: its channels stay, the others are relabeled
+    for x in fake.channels:
+        x['label'] = u'Новый {}'.format(x['channelid'])
+    fail_group(monkeypatch, fake, 2)
+    epg.store_channels(*epg.fetch_channels(fake.groups))
+    epg.db.session.commit()
+    channels = stored(epg)
+    assert sorted(channels) == list(range(1, 10))
+    assert channels[1] == u'Канал 1'
+    assert channels[2] == u'Новый 2'
+    assert epg.Channel.query.get(2).ulabel == u'НОВЫЙ 2'
+
+    # A complete refresh drops channels Kodi no longer has
+    monkeypatch.delattr(fake, 'group_channels')
+    del fake.channels[6:]
+    epg.store_channels(*epg.fetch_channels(fake.groups))
+    epg.db.session.commit()
+    assert sorted(stored(epg)) == list(range(1, 7))
@@ -0,0 +1,121 @@
+# coding: utf-8
+# Command queue: bursts reach Kodi as the last command of each kind, in order of submission
+import threading
+
+import pytest
+
+from commands import CommandQueue
+
+
+class Recorder(object):
+    """
+    Command target that holds the first call until released, so later commands wait in the queue.
+    """
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, kind, value):
+        self.calls.append((kind, value))
+        self.started.set()
+        assert self.release.wait(5)
+
+
+@pytest.fixture
+def recorder():
+    recorder = Recorder()
+    yield recorder
+    recorder.release.set()
+
+
+def busy(queue, recorder):
+    # First command runs and blocks the queue
+    queue.submit('volume', recorder, 'volume', 0)
+    assert recorder.started.wait(5)
+
+
+def test_burst_coalesces_to_last_value_per_kind(recorder):
+    queue = CommandQueue('test-burst')
+    busy(queue, recorder)
+    for volume in range(1, 11):
+        queue.submit('volume', recorder, 'volume', volume)
+    for channel in (5, 6, 7):
+        queue.submit('channel', recorder, 'channel', channel)
+    assert queue.stats()['depth'] == 2
+    recorder.release.set()
+    assert queue.join_pending(5)
+    assert recorder.calls == [('volume', 0), ('volume', 10), ('channel', 7)]
+    stats = queue.stats()
+    assert (stats['submitted'], stats['coalesced'], stats['executed'], stats['failed'], stats['depth']) == \
+        (14, 11, 3, 0, 0)
+
+
+def test_replaced_command_moves_to_the_end(recorder):
+    queue = CommandQueue('test-order')
+    busy(queue, recorder)
+    queue.submit('volume', recorder, 'volume', 1)
+    queue.submit('channel', recorder, 'channel', 2)
+    queue.submit('volume', recorder, 'volume', 3)
+    recorder.release.set()
+    assert queue.join_pending(5)
+    assert recorder.calls == [('volume', 0), ('channel', 2), ('volume', 3)]
+
+
+def test_rooms_do_not_coalesce_each_other(recorder):
+    other = Recorder()
+    other.release.set()
+    first, second = CommandQueue('test-room-1'), CommandQueue('test-room-2')
+    busy(first, recorder)
+    first.submit('volume', recorder, 'volume', 1)
+    second.submit('volume', other, 'volume', 2)
+    assert second.join_pending(5)
+    assert other.calls == [('volume', 2)]
+    recorder.release.set()
+    assert first.join_pending(5)
+    assert recorder.calls == [('volume', 0), ('volume', 1)]
+
+
+def test_failed_command_does_not_stop_the_queue():
+    from kodi import KodiError
+    done = []
+
+    def fail():
+        raise KodiError('Player.Open: Invalid params')
+
+    queue = CommandQueue('test-failure')
+    queue.submit('channel', fail)
+    assert queue.join_pending(5)
+    queue.submit('channel', done.append, 7)
+    assert queue.join_pending(5)
+    assert done == [7]
+    assert (queue.stats()['failed'], queue.stats()['executed']) == (1, 1)
+
+
+def test_route_burst_leaves_kodi_at_last_value():
+    import fakekodi
+    import run
+    import config as cfg
+    from rooms import Room
+
+    server, url = fakekodi.start(latency=0.02)
+    room = Room('test-route', url)
+    try:
+        run.rooms.rooms[room.name] = room
+        client = run.app.test_client()
+        for volume in range(20):
+            r = client.get('/{}/{}/volume?request={}'.format(cfg.SECRET, room.name, volume))
+            assert (r.status_code, r.get_data(as_text=True)) == (200, '{{"value": {}}}'.format(volume))
+        for channel in (3, 4, 5):
+            assert client.get('/{}/{}/channel?request={}'.format(cfg.SECRET, room.name, channel)).status_code == 200
+        assert client.get('/{}/{}/volume?request=x'.format(cfg.SECRET, room.name)).status_code == 400
+        assert room.commands.join_pending(5)
+        assert server.kodi.state['volume'] == 19
+        assert server.kodi.state['channel']['channelid'] == 5
+        assert room.state.get('volume') == 19
+        stats = room.commands.stats()
+        assert stats['submitted'] == 23 and stats['executed'] + stats['coalesced'] == 23
+        assert server.kodi.calls == stats['executed']
+    finally:
+        del run.rooms.rooms[room.name]
+        server.shutdown()
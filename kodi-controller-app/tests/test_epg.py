@@ -0,0 +1,49 @@
+# coding: utf-8
+# XMLTV split into chunks for worker processes: every <programme> exactly once, in feed order
+import gzip
+import io
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import epg
+
+
+def expected_rows(data):
+    return [x for x in map(epg.programme_row, ET.fromstring(data).iter('programme')) if x is not None]
+
+
+@pytest.fixture(scope='module')
+def data(feed):
+    with gzip.open(feed, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100, 4096, 1 << 20])
+def test_split_feed_keeps_every_programme_once(data, chunk_size):
+    chunks = list(epg.split_feed(io.BytesIO(data), chunk_size))
+    head = ET.fromstring(chunks[0])
+    assert not head.findall('programme')
+    assert len(head.findall('channel')) > 0
+    rows = [row for chunk in chunks[1:] for row in epg.parse_chunk(chunk)]
+    assert rows == expected_rows(data)
+    # Every programme cut at its start, none split between chunks
+    assert sum(chunk.count(b'<programme ') for chunk in chunks[1:]) == data.count(b'<programme ')
+
+
+def test_split_feed_without_programmes():
+    data = b'<?xml version="1.0" encoding="utf-8"?>\n<tv><channel id="1"><display-name>1</display-name></channel></tv>\n'
+    chunks = list(epg.split_feed(io.BytesIO(data), 10))
+    assert len(chunks) == 1
+    assert ET.fromstring(chunks[0]).find('channel').get('id') == '1'
+
+
+def test_parallel_parse_equals_serial(data):
+    kinds = []
+    rows = []
+    for kind, item in epg.iter_xmltv_parallel(io.BytesIO(data), 2, 4096):
+        kinds.append(kind)
+        if kind == 'programmes':
+            rows.extend(item)
+    assert kinds[0] == 'tv' and 'channel' in kinds
+    assert rows == expected_rows(data)
@@ -0,0 +1,118 @@
+# coding: utf-8
+# XMLTV refresh end to end: feed over local HTTP into a database of its own
+import functools
+import os
+import threading
+from datetime import datetime, timedelta
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import CHANNELS, PROGRAMS
+
+
+class Handler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def ingest(tmp_path, monkeypatch, feed, epg):
+    """
+    Application on an empty scratch database with TVGURL serving the test feed, which starts 6 hours ago,
+    and Kodi channels named as XMLTV ones.
+    """
+    import run
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=os.path.dirname(feed)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(epg.cfg, 'TVGURL', 'http://127.0.0.1:{}/{}'.format(server.server_address[1],
+                                                                           os.path.basename(feed)))
+    epg.db.session.remove()
+    monkeypatch.setitem(run.app.config, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///{}'.format(tmp_path / 'data.db'))
+    epg.init_db()
+    epg.db.session.add_all(epg.Channel(id=c + 1, label=u'Канал {}'.format(c + 1)) for c in range(CHANNELS))
+    epg.db.session.commit()
+    yield epg
+    epg.db.session.remove()
+    monkeypatch.undo()
+    epg.programs_cache.clear()
+    server.shutdown()
+
+
+def check_fts(epg):
+    # rank 1 compares the index with the content table
+    epg.db.session.execute(epg.db.text("INSERT INTO program_fts(program_fts, rank) VALUES('integrity-check', 1)"))
+
+
+def test_refresh_with_past_programs(monkeypatch, ingest):
+    epg = ingest
+    now = datetime.now()
+    # Programs of the first 6 hours are over
+    assert epg.get_xmltv() == CHANNELS * PROGRAMS
+    check_fts(epg)
+    left = epg.Program.query.count()
+    assert left == epg.Program.query.filter(epg.Program.stop >= now).count() < CHANNELS * PROGRAMS
+    found = epg.db.session.execute(epg.search_programs(u'Передача 30 &')).fetchall()
+    assert len(found) == CHANNELS
+
+    # Not modified feed: 2 hours later past programs are pruned with their index entries
+    class Later(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now + timedelta(hours=2)
+    monkeypatch.setattr(epg, 'datetime', Later)
+    assert epg.get_xmltv() == 0
+    check_fts(epg)
+    assert epg.Program.query.count() == left - CHANNELS * 4
+    assert epg.db.session.execute(epg.search_programs(u'Передача 30 &')).fetchall() == found
+
+
+def test_reads_during_ingest(monkeypatch, ingest):
+    # Readers see the old or the new program while the refresh job writes, never an error
+    import run
+    epg = ingest
+    epg.get_xmltv()
+    # Full ingest again: forget the feed validators
+    epg.FeedState.query.delete()
+    epg.db.session.commit()
+    # Nothing is kept, every read goes to SQL
+    monkeypatch.setattr(epg.programs_cache, 'maxsize', 0)
+    stopped = threading.Event()
+    reads = []
+    loaded = []
+    errors = []
+
+    def read(number):
+        with run.app.app_context():
+            while not stopped.is_set():
+                try:
+                    programs = epg.query_programs(u'Категория {}'.format(number % 3), u'ПЕРЕДАЧА', number % 2 == 1)
+                    reads.append(len(programs))
+                except Exception as e:
+                    errors.append(e)
+
+    def load():
+        with run.app.app_context():
+            try:
+                loaded.append(epg.get_xmltv())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                epg.db.session.remove()
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        writer = threading.Thread(target=load)
+        writer.start()
+        writer.join()
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+    assert errors == []
+    assert loaded == [CHANNELS * PROGRAMS]
+    assert reads and all(reads)
+    # No connection of the readers is left checked out
+    assert epg.reader.get_engine().pool.checkedout() == 0
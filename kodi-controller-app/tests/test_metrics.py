@@ -0,0 +1,24 @@
+# coding: utf-8
+# /metrics in Prometheus text format
+import re
+
+
+def sample(text, name):
+    found = re.search(r'^{} (\S+)$'.format(name), text, re.M)
+    return found and float(found.group(1))
+
+
+def test_programs_cache_is_scraped(frozen, epg):
+    import run
+    client = run.app.test_client()
+    path = '/{}/metrics'.format(epg.cfg.SECRET)
+    before = client.get(path).get_data(as_text=True)
+    epg.get_programs(u'Категория 1')
+    epg.get_programs(u'Категория 1')
+    epg.programs_cache.clear()
+    after = client.get(path).get_data(as_text=True)
+    assert '# TYPE kodi_controller_programs_cache_hits gauge' in after
+    for name, change in (('hits', 1), ('misses', 1), ('invalidations', 1)):
+        name = 'kodi_controller_programs_cache_' + name
+        assert sample(after, name) - sample(before, name) == change
+    assert sample(after, 'kodi_controller_programs_cache_entries') == 0
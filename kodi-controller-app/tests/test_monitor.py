@@ -0,0 +1,50 @@
+# coding: utf-8
+# Kodi state mirror fed by notifications of fake Kodi
+import time
+
+import pytest
+
+import fakekodi
+from kodi import KodiClient
+from monitor import KodiMonitor, KodiState
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+@pytest.fixture
+def kodi():
+    server, url = fakekodi.start()
+    listener = fakekodi.start_notifications(server.kodi)
+    state = KodiState()
+    monitor = KodiMonitor(KodiClient(url), '127.0.0.1', listener.getsockname()[1], state, reconnect=0.1)
+    monitor.start()
+    assert wait_for(lambda: state.connected)
+    yield server.kodi, KodiClient(url), state
+    monitor.stop()
+    server.shutdown()
+
+
+def test_state_follows_changes_made_by_other_clients(kodi):
+    fake, remote, state = kodi
+    remote.player_open(7)
+    assert wait_for(lambda: state.get('channel') == 7)
+    assert state.get('label') == u'Канал 7'
+    remote.set_volume(11)
+    remote.set_mute(True)
+    assert wait_for(lambda: state.get('volume') == 11 and state.get('muted') is True)
+
+
+def test_changes_while_disconnected_are_resynced(kodi):
+    fake, remote, state = kodi
+    fake.disconnect()
+    assert wait_for(lambda: not state.connected)
+    remote.set_volume(22)
+    remote.player_open(9)
+    assert wait_for(lambda: state.connected and state.get('volume') == 22 and state.get('channel') == 9)
@@ -0,0 +1,118 @@
+# coding: utf-8
+# /category pages: in order, no gaps or duplicates, ties split between pages, bad cursors rejected
+import base64
+import json
+
+import pytest
+
+import config as cfg
+
+
+def walk(epg, category, filter_program, now, limit):
+    pages, cursor = [], None
+    while True:
+        page, next_cursor = epg.get_program_page(category, filter_program, now, limit,
+                                                 epg.decode_cursor(cursor, now) if cursor else None)
+        pages.append(page)
+        if next_cursor is None:
+            return pages
+        cursor = next_cursor
+
+
+def row(item):
+    return item['channel'], item['title'], item['start'], item['stop']
+
+
+@pytest.mark.parametrize('now', [False, True])
+@pytest.mark.parametrize('filter_program', [None, u'ПЕРЕДАЧА 1'])
+@pytest.mark.parametrize('limit', [1, 3, 1000])
+def test_pages_follow_whole_result(epg, frozen, source, now, filter_program, limit):
+    whole = epg.get_programs(u'Категория 1', filter_program, now)
+    assert whole
+    pages = walk(epg, u'Категория 1', filter_program, now, limit)
+    walked = [x for page in pages for x in page]
+    assert all(len(page) == limit for page in pages[:-1]) and 0 < len(pages[-1]) <= limit
+    # Same programs, none twice
+    assert len(set(map(row, walked))) == len(walked)
+    assert sorted(map(row, walked)) == sorted(map(row, whole))
+    # In /category order, channels starting at the same time are split between pages of 1 and 3
+    field = 'stop' if now else 'start'
+    assert [x[field] for x in walked] == [x[field] for x in whole]
+    assert walked == sorted(walked, key=lambda x: (-x['time_before_stop'] if now else x['time_before_start'],
+                                                   x['channel'], x['title']))
+
+
+def test_page_equals_top_of_whole_result(epg, frozen, source):
+    page, cursor = epg.get_program_page(u'Категория 2', None, False, 4)
+    whole = sorted(epg.get_programs(u'Категория 2', None, False),
+                   key=lambda x: (x['time_before_start'], x['channel'], x['title']))
+    assert page == whole[:4]
+    assert epg.decode_cursor(cursor, False) == epg.program_key(
+        (whole[3]['channel'], whole[3]['title'], epg.datetime.strptime(whole[3]['start'], '%Y-%m-%d %H:%M:%S'),
+         None), False)
+
+
+def test_cursor_round_trip(epg):
+    key = (1700000000.0, u'1/Канал 1:', u'Передача 1 & 0')
+    assert epg.decode_cursor(epg.encode_cursor(key, False), False) == key
+    on_air = (-1700000000.0,) + key[1:]
+    assert epg.decode_cursor(epg.encode_cursor(on_air, True), True) == on_air
+
+
+def cursor(value):
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+@pytest.mark.parametrize('value, now', [
+    ('[0,NaN,"a","b"]', False), ('[0,Infinity,"a","b"]', False), ('[1,-Infinity,"a","b"]', True),
+    ('[0,1e20,"a","b"]', False), ('[1,-1e20,"a","b"]', True), ('[0,-5,"a","b"]', False), ('[1,5,"a","b"]', True),
+    ('[0,true,"a","b"]', False), ('[0,5,"a"]', False), ('[2,5,"a","b"]', False), ('{"a":1}', False),
+    # Cursor of the other now
+    ('[1,-1700000000,"a","b"]', False), ('[0,1700000000,"a","b"]', True)])
+def test_bad_cursor_is_rejected(epg, value, now):
+    with pytest.raises(ValueError):
+        epg.decode_cursor(cursor(value), now)
+
+
+@pytest.mark.parametrize('text', ['zzz', u'курсор', '!!!!', ''])
+def test_garbage_cursor_is_rejected(epg, text):
+    with pytest.raises(ValueError):
+        epg.decode_cursor(text, False)
+
+
+@pytest.fixture
+def client(epg, frozen):
+    import run
+    return run.app.test_client()
+
+
+def get(client, query):
+    return client.get(u'/{}/category?request=Категория 1{}'.format(cfg.SECRET, query))
+
+
+@pytest.mark.parametrize('now', ['0', '1'])
+def test_route_pages(client, epg, now):
+    whole = json.loads(get(client, '&now=' + now).get_data(as_text=True))['value']
+    walked, next_cursor = [], None
+    while True:
+        r = get(client, '&now={}&limit=2&fields=channel,start,stop{}'.format(
+            now, '&cursor=' + next_cursor if next_cursor else ''))
+        assert r.status_code == 200
+        body = json.loads(r.get_data(as_text=True))
+        assert all(set(x) == {'channel', 'start', 'stop'} for x in body['value'])
+        walked.extend(body['value'])
+        next_cursor = body['cursor']
+        if next_cursor is None:
+            break
+    assert sorted((x['channel'], x['start']) for x in walked) == sorted((x['channel'], x['start']) for x in whole)
+
+
+def test_route_rejects_bad_arguments(client, epg):
+    page = json.loads(get(client, '&limit=1').get_data(as_text=True))
+    assert page['cursor']
+    # Cursor of future programs used for programs on air
+    assert get(client, '&now=1&limit=1&cursor=' + page['cursor']).status_code == 400
+    for query in ('&limit=0', '&limit=x', '&fields=foo', '&cursor=zzz', '&limit=1&cursor=' + cursor('[0,NaN,"a","b"]'),
+                  '&limit=1&cursor=' + cursor('[0,1e20,"a","b"]')):
+        r = get(client, query)
+        assert (r.status_code, r.get_data(as_text=True)) == (400, 'Record not found'), query
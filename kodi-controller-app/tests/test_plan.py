@@ -0,0 +1,38 @@
+# coding: utf-8
+# Program queries of /category must be answered through indexes, never by a scan of the program table
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@pytest.fixture
+def statements(epg):
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM program' in statement and not statement.startswith('EXPLAIN'):
+            captured.append((statement, parameters))
+
+    # Requests read through helpers.reader, an engine of its own
+    event.listen(Engine, 'before_cursor_execute', capture)
+    yield captured
+    event.remove(Engine, 'before_cursor_execute', capture)
+
+
+def plan(epg, statement, parameters):
+    return [row[-1] for row in epg.db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement,
+                                                                           parameters)]
+
+
+@pytest.mark.parametrize('now', [False, True])
+@pytest.mark.parametrize('filter_program', [None, u'ПЕРЕДАЧА 1', u'ПЕ'])
+def test_program_queries_use_indexes(epg, statements, now, filter_program):
+    epg.programs_cache.clear()
+    epg.get_programs(u'Категория 1', filter_program, now)
+    epg.get_program_page(u'Категория 1', filter_program, now, limit=5)
+    assert statements, 'no program query captured'
+    for statement, parameters in statements:
+        steps = plan(epg, statement, parameters)
+        assert not [x for x in steps if x.startswith('SCAN program') and 'INDEX' not in x], (statement, steps)
+        assert [x for x in steps if x.startswith('SEARCH program USING INDEX ix_program_category_start')], \
+            (statement, steps)
@@ -0,0 +1,20 @@
+# coding: utf-8
+# Pruning past programs keeps the full text index in step without a rebuild
+from datetime import timedelta
+
+from conftest import BASE, CHANNELS
+
+
+def test_prune_drops_full_text_entries(epg):
+    db = epg.db
+    try:
+        # Programs 0..2 are over, program 3 stops at the moment
+        assert epg.prune_programs(BASE + timedelta(hours=2)) == CHANNELS * 3
+        # rank 1 compares the index with the content table
+        db.session.execute(db.text("INSERT INTO program_fts(program_fts, rank) VALUES('integrity-check', 1)"))
+        found = db.session.execute(epg.search_programs(u'Передача 2 &')).fetchall()
+        assert found == []
+        found = db.session.execute(epg.search_programs(u'Передача 3 &')).fetchall()
+        assert len(found) == CHANNELS
+    finally:
+        db.session.rollback()
@@ -0,0 +1,66 @@
+# coding: utf-8
+# Background refresh: on demand through /refresh and stopped on exit
+import json
+import threading
+import time
+
+import pytest
+
+from scheduler import Job, RefreshWorker
+
+
+@pytest.fixture
+def worker(monkeypatch, epg):
+    import run
+    calls = []
+    release = threading.Event()
+    release.set()
+
+    def job(name):
+        def func():
+            calls.append(name)
+            release.wait(5)
+            return len(calls)
+        return func
+    # Due in an hour, the worker thread only runs them on demand
+    jobs = [Job('catalog', job('catalog'), 3600), Job('xmltv', job('xmltv'), 3600)]
+    for x in jobs:
+        x.due = time.time() + 3600
+    refresh = RefreshWorker(run.app, jobs)
+    monkeypatch.setattr(run, 'refresh_worker', refresh)
+    refresh.start()
+    yield refresh, calls, release
+    release.set()
+    run.stop_services(5)
+    assert not refresh.is_alive()
+
+
+def get(path):
+    import run
+    import config as cfg
+    return run.app.test_client().get('/{}/refresh{}'.format(cfg.SECRET, path))
+
+
+def test_refresh_on_demand(worker):
+    refresh, calls, release = worker
+    r = get('')
+    assert r.status_code == 200 and calls == []
+    r = get('?request=xmltv')
+    assert r.status_code == 200 and calls == ['xmltv']
+    assert json.loads(r.get_data(as_text=True))['xmltv']['last_rows'] == 1
+    assert get('?request=all').status_code == 200
+    assert calls == ['xmltv', 'catalog', 'xmltv']
+    assert get('?request=unknown').status_code == 400
+
+
+def test_refresh_in_progress(worker):
+    refresh, calls, release = worker
+    release.clear()
+    running = threading.Thread(target=refresh.run_now)
+    running.start()
+    while not calls:
+        time.sleep(0.001)
+    assert get('?request=catalog').status_code == 503
+    release.set()
+    running.join()
+    assert calls == ['catalog', 'xmltv']
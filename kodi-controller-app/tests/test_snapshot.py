@@ -0,0 +1,63 @@
+# coding: utf-8
+# EPG snapshot answers /category as SQLite does
+import pytest
+
+import snapshot
+from conftest import CATEGORIES, FrozenDatetime
+
+FILTERS = [None, u'ПЕРЕДАЧА 1', u'ПЕ', u'& 3', u'НЕТ ТАКОЙ']
+CASES = [(u'Категория {}'.format(c), now, f) for c in range(CATEGORIES) for now in (False, True) for f in FILTERS]
+
+
+def programs(epg, current, category, now, filter_program):
+    epg.epg_snapshot = current
+    try:
+        return sorted(epg.iter_programs(category, filter_program, now, FrozenDatetime.now()))
+    finally:
+        epg.epg_snapshot = None
+
+
+@pytest.fixture(scope='module')
+def built(epg):
+    links = {x.xmltv_id: u'{}/{}:'.format(x.channel_id, x.label) for x in epg.ChannelLink.query.all()}
+    query = epg.db.session.query(epg.Category.name, epg.Program.channel, epg.Program.title, epg.Program.start,
+                                 epg.Program.stop).join(epg.Category, epg.Category.id == epg.Program.category_id)
+    return snapshot.EPGSnapshot.build(epg.db.session.execute(query.statement), links)
+
+
+@pytest.fixture(scope='module')
+def mapped(built, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('snapshot') / 'epg.snapshot')
+    snapshot.write(built, path)
+    mapped = snapshot.MappedSnapshot(path)
+    yield mapped
+    mapped.close()
+
+
+@pytest.mark.parametrize('category, now, filter_program', CASES)
+def test_snapshot_answers_as_sqlite(epg, built, category, now, filter_program):
+    expected = programs(epg, None, category, now, filter_program)
+    if filter_program is None:
+        assert expected
+    assert programs(epg, built, category, now, filter_program) == expected
+
+
+@pytest.mark.parametrize('category, now, filter_program', CASES)
+def test_mapped_snapshot_answers_as_sqlite(epg, mapped, category, now, filter_program):
+    assert programs(epg, mapped, category, now, filter_program) == programs(epg, None, category, now, filter_program)
+
+
+def test_mapped_snapshot_next_programs(built, mapped):
+    ts = FrozenDatetime.now()
+    assert mapped.count == built.count
+    for c in range(CATEGORIES):
+        category = u'Категория {}'.format(c)
+        assert sorted(mapped.upcoming(category, u'', ts, 1)) == sorted(built.upcoming(category, u'', ts, 1))
+    assert mapped.on_air(u'Нет такой', u'', ts) == []
+
+
+def test_snapshot_file_of_other_version_is_refused(tmp_path):
+    path = tmp_path / 'epg.snapshot'
+    path.write_bytes(b'XXXX' + b'\0' * 64)
+    with pytest.raises(ValueError):
+        snapshot.MappedSnapshot(str(path))